@@ -0,0 +1,434 @@
+"""
+Benchmark do ciclo do monitor (run_check) sem tocar na API real.
+
+Sobe um Mercado Livre fake local (/items, /items?ids=, /sites/MLB/search, /oauth/token)
+com latência, taxa de erro e 429 configuráveis, troca o Telegram por um sink em memória
+e roda ciclos completos sobre tabelas sintéticas.
+
+    python bench.py                                   # 100, 1k e 10k itens
+    python bench.py --sizes 1000 --latency 0.05 --error-rate 0.01 --rate-429 0.01
+    python bench.py --save bench_baseline.json        # grava o resultado
+    python bench.py --baseline bench_baseline.json    # gate: sai com 1 se regrediu
+
+Reporta por tamanho: itens/s, p50/p99 do tempo de ciclo, chamadas de API por item,
+alertas e pico de memória.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from typing import Optional, List, Dict, Any
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import resource  # não existe no Windows
+except ImportError:
+    resource = None
+
+
+# =========================
+# Fake Mercado Livre
+# =========================
+class FakeML:
+    """
+    Servidor HTTP/1.1 mínimo (keep-alive) que imita os endpoints do ML usados pelo main.py.
+    Roda numa thread com loop próprio pra não disputar o loop do monitor.
+    """
+
+    def __init__(self, latency: float, error_rate: float, rate_429: float, churn: float,
+                 offers: int, my_seller_id: int, sortable: bool = True, seller_items: int = 300, seed: int = 42):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.churn = churn
+        self.offers = offers
+        self.my_seller_id = my_seller_id
+        self.sortable = sortable
+        self.seller_items = seller_items
+        self.rng = random.Random(seed)
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self.port = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.ready = threading.Event()
+
+    # ---- dados sintéticos ----
+    def add_item(self, item_id: str, price: float, catalog_product_id: Optional[str]) -> None:
+        self.items[item_id] = {"price": price, "catalog_product_id": catalog_product_id}
+
+    def _price(self, item_id: str) -> float:
+        it = self.items[item_id]
+        if self.rng.random() < self.churn:  # simula concorrente mexendo no preço
+            it["price"] = round(it["price"] * self.rng.uniform(0.9, 1.1), 2)
+        return it["price"]
+
+    def _item_body(self, item_id: str) -> Dict[str, Any]:
+        it = self.items[item_id]
+        # payload "cheio" como o da API real (fotos, atributos...) pra medir parse/memória
+        return {
+            "id": item_id,
+            "site_id": "MLB",
+            "title": f"Produto sintético {item_id}",
+            "price": self._price(item_id),
+            "seller_id": self.my_seller_id if it["catalog_product_id"] else 1000 + hash(item_id) % 5000,
+            "catalog_product_id": it["catalog_product_id"],
+            "currency_id": "BRL",
+            "available_quantity": 10,
+            "pictures": [{"id": f"{i}", "url": f"http://img/{item_id}/{i}.jpg", "size": "500x500"} for i in range(8)],
+            "attributes": [{"id": f"ATTR_{i}", "name": f"Atributo {i}", "value_name": "x" * 20} for i in range(25)],
+            "shipping": {"mode": "me2", "free_shipping": True, "tags": ["fulfillment"]},
+        }
+
+    @staticmethod
+    def _select(body: Dict[str, Any], attributes: Optional[str]) -> Dict[str, Any]:
+        if not attributes:
+            return body
+        keys = attributes.split(",")
+        return {k: body[k] for k in keys if k in body}
+
+    def _seller_results(self, seller_id: str) -> List[Dict[str, Any]]:
+        # inventário determinístico do seller: metade em catálogos que monitoramos, metade anúncios nossos "espelhados"
+        rng = random.Random(seller_id)
+        cats = sorted({it["catalog_product_id"] for it in self.items.values() if it["catalog_product_id"]})
+        listings = sorted(k for k, it in self.items.items() if not it["catalog_product_id"])
+        results = []
+        for i in range(self.seller_items):
+            if cats and i % 2 == 0:
+                cat = rng.choice(cats)
+                base = next(it["price"] for it in self.items.values() if it["catalog_product_id"] == cat)
+                results.append({"id": f"MLB8{rng.randrange(10 ** 8):08d}", "catalog_product_id": cat,
+                                "price": round(base * rng.uniform(0.85, 1.25), 2)})
+            elif listings:
+                item_id = rng.choice(listings)
+                results.append({"id": item_id, "catalog_product_id": None,
+                                "price": round(self.items[item_id]["price"] * rng.uniform(0.85, 1.25), 2)})
+        return [dict(r, seller={"id": int(seller_id)}, title="Anúncio do seller", thumbnail="http://img/x.jpg")
+                for r in results]
+
+    def _search(self, q: Dict[str, str]) -> Dict[str, Any]:
+        if q.get("seller_id"):
+            results = self._seller_results(q["seller_id"])
+            offset, limit = int(q.get("offset", 0)), int(q.get("limit", 50))
+            page = results[offset:offset + limit]
+            if q.get("attributes"):
+                keys = [k.split(".", 1)[1] for k in q["attributes"].split(",") if k.startswith("results.")]
+                page = [{k: r[k] for k in keys if k in r} for r in page]
+            return {"paging": {"total": len(results), "offset": offset, "limit": limit}, "results": page}
+        cat = q.get("catalog_product_id", "")
+        rng = random.Random(cat)
+        base = next((it["price"] for it in self.items.values() if it["catalog_product_id"] == cat), 100.0)
+        results = [{
+            "id": f"MLB9{rng.randrange(10 ** 8):08d}",
+            "price": round(base * rng.uniform(0.85, 1.25), 2),
+            "seller": {"id": self.my_seller_id if i == 0 else 2000 + rng.randrange(10 ** 6)},
+            "title": f"Oferta {i} de {cat}",
+            "thumbnail": "http://img/x.jpg",
+            "attributes": [{"id": f"ATTR_{j}", "value_name": "y" * 20} for j in range(10)],
+        } for i in range(self.offers)]
+        sort = "relevance"
+        if self.sortable and q.get("sort") == "price_asc":
+            sort = "price_asc"
+            results.sort(key=lambda r: r["price"])
+        offset, limit = int(q.get("offset", 0)), int(q.get("limit", 50))
+        page = results[offset:offset + limit]
+        if q.get("attributes"):  # results.id,results.price,... seleciona campos de cada resultado
+            keys = [k.split(".", 1)[1] for k in q["attributes"].split(",") if k.startswith("results.")]
+            page = [{k: r[k] for k in keys if k in r} for r in page]
+        return {"paging": {"total": len(results), "offset": offset, "limit": limit}, "sort": {"id": sort},
+                "results": page}
+
+    # ---- HTTP ----
+    def _route(self, method: str, target: str) -> (int, Dict[str, str], Any):
+        url = urlsplit(target)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        if path == "/oauth/token" and method == "POST":
+            name = "oauth"
+        elif path == "/items" and "ids" in q:
+            name = "items_multiget"
+        elif path.startswith("/items/"):
+            name = "items"
+        elif path.startswith("/sites/") and path.endswith("/search"):
+            name = "search"
+        else:
+            return 404, {}, {"message": "not found"}
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+        roll = self.rng.random()
+        if roll < self.rate_429:
+            return 429, {"Retry-After": "1"}, {"message": "too many requests"}
+        if roll < self.rate_429 + self.error_rate:
+            return 500, {}, {"message": "internal error"}
+
+        if name == "oauth":
+            return 200, {}, {"access_token": "bench", "refresh_token": "bench", "expires_in": 21600}
+        if name == "items_multiget":
+            out = []
+            for item_id in q["ids"].split(","):
+                if item_id in self.items:
+                    out.append({"code": 200, "body": self._select(self._item_body(item_id), q.get("attributes"))})
+                else:
+                    out.append({"code": 404, "body": {"message": f"Item with id {item_id} not found",
+                                                      "error": "not_found", "status": 404}})
+            return 200, {}, out
+        if name == "items":
+            item_id = path.rsplit("/", 1)[1]
+            if item_id not in self.items:
+                return 404, {}, {"message": "not found"}
+            return 200, {}, self._select(self._item_body(item_id), q.get("attributes"))
+        return 200, {}, self._search(q)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                length = 0
+                if_none_match = None
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    if k.strip().lower() == "content-length":
+                        length = int(v.strip())
+                    elif k.strip().lower() == "if-none-match":
+                        if_none_match = v.strip()
+                if length:
+                    await reader.readexactly(length)
+
+                if self.latency:
+                    await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+                status, headers, payload = self._route(method, target)
+                body = json.dumps(payload).encode("utf-8")
+                if status == 200 and method == "GET":
+                    # ETag como o do ML: corpo igual -> 304 sem corpo pra quem revalida
+                    headers["ETag"] = '"' + hashlib.md5(body).hexdigest() + '"'
+                    if if_none_match == headers["ETag"]:
+                        self.calls["not_modified"] = self.calls.get("not_modified", 0) + 1
+                        status, body = 304, b""
+                head = f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                head += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+                writer.write(head.encode("latin-1") + b"\r\n" + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self) -> None:
+        def run():
+            self.loop = asyncio.new_event_loop()
+            server = self.loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+            self.port = server.sockets[0].getsockname()[1]
+            self.ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        self.ready.wait()
+
+
+# =========================
+# Fake Telegram
+# =========================
+class FakeBot:
+    def __init__(self):
+        self.messages = 0
+
+    async def send_message(self, chat_id, text, disable_web_page_preview=False):
+        self.messages += 1
+
+
+# =========================
+# Bench
+# =========================
+def percentile(values: List[float], q: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+async def bench_size(main, fake: FakeML, bot: FakeBot, n: int, cycles: int, catalog_share: float,
+                     catalog_group: int, trace_memory: bool, watch_sellers: int = 0,
+                     tenants: int = 1) -> Dict[str, Any]:
+    rng = random.Random(n)
+    main.db_close()
+    main.DB_FILE = os.path.join(tempfile.mkdtemp(prefix="bench_"), "tracker.db")
+    main.init_db()
+    main.reset_history_cache()
+
+    conn = main.db()
+    rows = []
+    for i in range(n):
+        item_id = f"MLB{1_000_000_000 + n * 10 + i}"
+        catalog = rng.random() < catalog_share
+        cat_id = f"MLB{20_000_000 + n * 10 + i // catalog_group}" if catalog else None
+        price = round(rng.uniform(20, 500), 2)
+        fake.add_item(item_id, price, cat_id)
+        rows.append((item_id, f"Produto {i}", price, 1.0, "catalog" if catalog else "listing",
+                     fake.my_seller_id if catalog else None, cat_id, 0))
+    conn.executemany("""
+        INSERT INTO tracked_items (item_id, title, my_price, undercut_reais, mode,
+                                   my_seller_id, catalog_product_id, next_check_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    # outros chats acompanhando os mesmos itens: chamadas ao ML não devem crescer com isso
+    conn.executemany("""
+        INSERT INTO tenant_items (chat_id, item_id, my_price, undercut_reais, created_at) VALUES (?, ?, ?, ?, 0)
+    """, [(str(1000 + t), r[0], round(r[2] * rng.uniform(0.9, 1.1), 2), 1.0) for t in range(1, tenants) for r in rows])
+    conn.executemany("INSERT INTO watched_sellers (seller_id, nickname, added_at) VALUES (?, ?, 0)",
+                     [(5_000_000 + i, f"rival{i}") for i in range(watch_sellers)])
+    conn.commit()
+
+    app = SimpleNamespace(bot=bot)
+    durations: List[float] = []
+    checked_total = 0
+    calls_before = dict(fake.calls)
+    alerts_before = bot.messages
+    if trace_memory:
+        tracemalloc.start()
+
+    for _ in range(cycles):
+        conn.execute("UPDATE tracked_items SET next_check_at=0")
+        conn.execute("UPDATE watched_sellers SET next_scan_at=0")
+        conn.commit()
+        main.STORE.load(conn)
+        main.ML_CACHE.clear()  # ciclos reais ficam a POLL_MIN_SECONDS+ de distância, além do TTL
+        t0 = time.perf_counter()
+        checked, _overran = await main.run_check(app)
+        durations.append(time.perf_counter() - t0)
+        checked_total += checked
+
+    peak_trace = None
+    if trace_memory:
+        peak_trace = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    await asyncio.sleep(main.ALERT_COALESCE_SECONDS + 0.2)  # deixa o dispatcher esvaziar a fila
+    calls = {k: v - calls_before.get(k, 0) for k, v in fake.calls.items()}
+    total_calls = sum(v for k, v in calls.items() if k != "not_modified")  # 304 já conta na chamada
+    return {
+        "items": n,
+        "cycles": cycles,
+        "items_per_second": checked_total / sum(durations) if sum(durations) else 0.0,
+        "cycle_p50_s": percentile(durations, 0.50),
+        "cycle_p99_s": percentile(durations, 0.99),
+        "api_calls_per_item": total_calls / checked_total if checked_total else 0.0,
+        "api_calls": calls,
+        "alerts_sent": bot.messages - alerts_before,
+        "peak_traced_mb": peak_trace,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], max_regression: float) -> List[str]:
+    by_size = {b["items"]: b for b in baseline}
+    failures = []
+    for r in results:
+        b = by_size.get(r["items"])
+        if not b:
+            continue
+        if r["items_per_second"] < b["items_per_second"] * (1 - max_regression):
+            failures.append(f"{r['items']} itens: throughput {r['items_per_second']:.1f}/s "
+                            f"< baseline {b['items_per_second']:.1f}/s")
+        if r["api_calls_per_item"] > b["api_calls_per_item"] * 1.05:
+            failures.append(f"{r['items']} itens: {r['api_calls_per_item']:.3f} chamadas/item "
+                            f"> baseline {b['api_calls_per_item']:.3f}")
+    return failures
+
+
+async def run(args) -> int:
+    fake = FakeML(args.latency, args.error_rate, args.rate_429, args.churn, args.offers, my_seller_id=777,
+                  sortable=not args.no_sort, seller_items=args.seller_items)
+    fake.start()
+
+    # config do main.py via env, antes do import (constantes são lidas no import)
+    os.environ.update({
+        "ML_API_BASE": f"http://127.0.0.1:{fake.port}",
+        "ML_APP_ID": "bench", "ML_CLIENT_SECRET": "bench", "ML_REFRESH_TOKEN": "bench",
+        "ML_RATE_ITEMS": str(args.rate), "ML_RATE_SEARCH": str(args.rate), "ML_RATE_OAUTH": "0",
+        "ML_CONCURRENCY": str(args.concurrency),
+        "ML_BACKOFF_BASE": "0.05",
+        "CYCLE_BUDGET_SECONDS": "1e9",
+        "ALERT_COALESCE_SECONDS": "0.2",
+        "TG_RATE_GLOBAL": "0", "TG_RATE_GROUP": "0", "TG_RATE_PRIVATE": "0",
+        "TELEGRAM_BOT_TOKEN": "bench", "TELEGRAM_CHAT_ID": "1",
+        "METRICS_PORT": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    bot = FakeBot()
+    main.ALERTS.start(SimpleNamespace(bot=bot))
+    results = []
+    try:
+        for n in args.sizes:
+            r = await bench_size(main, fake, bot, n, args.cycles, args.catalog_share, args.catalog_group,
+                                 args.trace_memory, args.watch_sellers, args.tenants)
+            results.append(r)
+            mem = f"{r['peak_traced_mb']:.1f} MB (traced)" if r["peak_traced_mb"] is not None else \
+                f"{r['peak_rss_mb']:.1f} MB (rss)" if r["peak_rss_mb"] is not None else "—"
+            print(f"{n:>6} itens | {r['items_per_second']:8.1f} itens/s | p50 {r['cycle_p50_s']:.2f}s "
+                  f"| p99 {r['cycle_p99_s']:.2f}s | {r['api_calls_per_item']:.3f} chamadas/item "
+                  f"| alertas {r['alerts_sent']} | mem {mem}")
+            print(f"         chamadas: {r['api_calls']}")
+    finally:
+        await main.ALERTS.stop()
+        await main.ml_close_client()
+        main.db_close()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures = compare(results, json.load(f), args.max_regression)
+        for msg in failures:
+            print("REGRESSÃO:", msg)
+        return 1 if failures else 0
+    return 0
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark do monitor contra um ML fake local")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    ap.add_argument("--cycles", type=int, default=5, help="ciclos completos por tamanho")
+    ap.add_argument("--latency", type=float, default=0.03, help="latência média do fake (s)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fração de respostas 500")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="fração de respostas 429")
+    ap.add_argument("--churn", type=float, default=0.05, help="chance de o preço mudar a cada leitura")
+    ap.add_argument("--offers", type=int, default=20, help="ofertas por produto de catálogo")
+    ap.add_argument("--no-sort", action="store_true", help="fake ignora sort=price_asc (testa a varredura completa)")
+    ap.add_argument("--catalog-share", type=float, default=0.5, help="fração de itens em modo catalog")
+    ap.add_argument("--catalog-group", type=int, default=3, help="itens por catalog_product_id")
+    ap.add_argument("--tenants", type=int, default=1, help="chats acompanhando cada item (1 = só o dono)")
+    ap.add_argument("--watch-sellers", type=int, default=0, help="sellers vigiados (/watchseller) por tamanho")
+    ap.add_argument("--seller-items", type=int, default=300, help="anúncios no inventário de cada seller vigiado")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--rate", type=float, default=0, help="ML_RATE_ITEMS/SEARCH (0 = sem limite)")
+    ap.add_argument("--trace-memory", action="store_true", help="pico via tracemalloc (deixa mais lento)")
+    ap.add_argument("--save", help="grava o resultado em JSON")
+    ap.add_argument("--baseline", help="compara com um JSON salvo e falha se regrediu")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="queda de throughput tolerada")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
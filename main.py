@@ -1,15 +1,34 @@
+import io
 import os
 import re
+import csv
+import json
+import math
+import tempfile
 import time
+import random
+import asyncio
 import sqlite3
-from typing import Optional, Tuple, List, Dict, Any
+import heapq
+import zlib
+import signal
+import socket
+import subprocess
+import sys
+from array import array
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Optional, Tuple, List, Dict, Any, Set, FrozenSet, Callable, Awaitable
 from pathlib import Path
+from email.utils import parsedate_to_datetime
 
-import requests
+import httpx
+import numpy as np
 from dotenv import load_dotenv
 
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError, TelegramError
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
 
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
@@ -36,13 +55,118 @@ print("REFRESH:", os.getenv("ML_REFRESH_TOKEN"))
 # =========================
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "").strip()
+# Multi-tenant: cada chat cadastrado (/tenant add, a partir do CHAT_ID) tem os próprios itens,
+# preços e margens. Desligado, todo comando age como o CHAT_ID (um seller só, como sempre foi).
+MULTI_TENANT = os.getenv("MULTI_TENANT", "0") == "1"
+
+CHECK_INTERVAL_SECONDS = int(os.getenv("CHECK_INTERVAL_SECONDS", "180"))  # intervalo inicial de cada item
+
+# Polling adaptativo: itens em UNDERCUT ou com preço mexendo caem pra POLL_MIN_SECONDS;
+# itens estáveis vão espaçando (x POLL_BACKOFF) até o teto do item (padrão POLL_MAX_SECONDS).
+POLL_MIN_SECONDS = int(os.getenv("POLL_MIN_SECONDS", "60"))
+POLL_MAX_SECONDS = int(os.getenv("POLL_MAX_SECONDS", "1800"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "1.5"))
+SCHEDULER_TICK_SECONDS = int(os.getenv("SCHEDULER_TICK_SECONDS", "15"))
+
+# Orçamento de tempo por ciclo: ao estourar, para e continua de onde parou no próximo tick
+CYCLE_BUDGET_SECONDS = float(os.getenv("CYCLE_BUDGET_SECONDS", "120"))
+CYCLE_CHUNK_SIZE = int(os.getenv("CYCLE_CHUNK_SIZE", "200"))  # itens por fatia do ciclo
+
+# Saída de alertas no Telegram
+ALERT_COALESCE_SECONDS = float(os.getenv("ALERT_COALESCE_SECONDS", "3"))  # janela do digest
+TG_MAX_MESSAGE = 4096
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "10"))  # itens por página do /list
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+TG_RATE_GLOBAL = float(os.getenv("TG_RATE_GLOBAL", "25"))  # msg/s (limite do Telegram ~30)
+TG_RATE_GROUP = float(os.getenv("TG_RATE_GROUP", "0.32"))  # msg/s por grupo (~20/min)
+TG_RATE_PRIVATE = float(os.getenv("TG_RATE_PRIVATE", "1"))  # msg/s por chat privado
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+# Sharding do monitor: MONITOR_WORKERS > 0 faz este processo rodar só o bot e subir
+# N workers (python main.py worker) que dividem as partições via lease no SQLite.
+# Os limites de taxa do ML/Telegram continuam sendo o total: ver RATE_SHARES.
+MONITOR_WORKERS = int(os.getenv("MONITOR_WORKERS", "0"))
+SHARD_PARTITIONS = int(os.getenv("SHARD_PARTITIONS", "64"))
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "30"))
+LEASE_HEARTBEAT_SECONDS = float(os.getenv("LEASE_HEARTBEAT_SECONDS", "10"))
+
+# Métricas: METRICS_PORT > 0 liga o endpoint Prometheus local (workers usam as portas seguintes)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Webhook de notificações do ML: WEBHOOK_PORT > 0 liga o receptor (URL de callback do app no ML)
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "0"))
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/ml/notifications")
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "2"))  # junta rajadas do mesmo item
+WEBHOOK_TOPICS = ("items", "items_prices", "price_suggestion")
+# itens listing (o preço monitorado é o do próprio anúncio notificado) que recebem notificação
+# caem pra uma varredura lenta de reconciliação; catalog e UNDERCUT seguem no polling normal
+WEBHOOK_RECONCILE_SECONDS = int(os.getenv("WEBHOOK_RECONCILE_SECONDS", "3600"))
+WEBHOOK_TRUST_SECONDS = int(os.getenv("WEBHOOK_TRUST_SECONDS", "86400"))  # sem notificação há mais que isso: volta ao polling normal
+
+# Retenção do histórico de preços: bruto -> min/max por hora -> min/max por dia
+HISTORY_RAW_DAYS = int(os.getenv("HISTORY_RAW_DAYS", "7"))
+HISTORY_HOURLY_DAYS = int(os.getenv("HISTORY_HOURLY_DAYS", "90"))
+HISTORY_DAILY_DAYS = int(os.getenv("HISTORY_DAILY_DAYS", "0"))  # 0 = guarda pra sempre
+HISTORY_RETENTION_INTERVAL = int(os.getenv("HISTORY_RETENTION_INTERVAL", "3600"))
+# itens que o ML recusa (404/403, anúncio pausado/fechado): retry com backoff exponencial
+ITEM_FAIL_BACKOFF_BASE = int(os.getenv("ITEM_FAIL_BACKOFF_BASE", "300"))
+ITEM_FAIL_BACKOFF_MAX = int(os.getenv("ITEM_FAIL_BACKOFF_MAX", "86400"))
+ITEM_FAIL_NOTIFY_AFTER = int(os.getenv("ITEM_FAIL_NOTIFY_AFTER", "3"))  # falhas seguidas até avisar no Telegram
+ITEM_DEAD_STATUSES = ("paused", "closed", "inactive", "under_review")
 
-CHECK_INTERVAL_SECONDS = int(os.getenv("CHECK_INTERVAL_SECONDS", "180"))
 DEFAULT_UNDERCUT_REAIS = float(os.getenv("DEFAULT_UNDERCUT_REAIS", "1.00"))
 
 HTTP_TIMEOUT = 20
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+ML_POOL_SIZE = int(os.getenv("ML_POOL_SIZE", "20"))  # conexões keep-alive com api.mercadolibre.com
+ML_KEEPALIVE_SECONDS = float(os.getenv("ML_KEEPALIVE_SECONDS", "60"))
+ML_MAX_RETRIES = int(os.getenv("ML_MAX_RETRIES", "3"))  # retries em 5xx / falha de conexão
+ML_BACKOFF_BASE = float(os.getenv("ML_BACKOFF_BASE", "0.5"))
+ML_BACKOFF_MAX = float(os.getenv("ML_BACKOFF_MAX", "10"))
+
+# Rate limit por endpoint do ML (req/s máximo; 0 = sem limite). Cai pela metade a cada 429
+# e volta a subir ML_RATE_STEP req/s por resposta saudável (AIMD).
+ML_RATE_ITEMS = float(os.getenv("ML_RATE_ITEMS", "10"))
+ML_RATE_SEARCH = float(os.getenv("ML_RATE_SEARCH", "5"))
+ML_RATE_OAUTH = float(os.getenv("ML_RATE_OAUTH", "1"))
+ML_RATE_MIN = float(os.getenv("ML_RATE_MIN", "0.2"))
+ML_RATE_STEP = float(os.getenv("ML_RATE_STEP", "0.05"))
+ML_CONCURRENCY = int(os.getenv("ML_CONCURRENCY", "8"))  # requisições simultâneas ao ML por ciclo
+ML_BREAKER_THRESHOLD = int(os.getenv("ML_BREAKER_THRESHOLD", "5"))  # falhas seguidas que abrem o circuito (0 = desliga)
+ML_BREAKER_COOLDOWN = float(os.getenv("ML_BREAKER_COOLDOWN", "60"))  # segundos com o circuito aberto
+ML_MULTIGET_MAX = 20  # limite da API em /items?ids=
+
+# As taxas acima (ML e Telegram) são o total da conta, mas cada processo tem seus próprios
+# buckets e semáforo: com MONITOR_WORKERS=N o bot e os N workers (que herdam o mesmo env)
+# ficam cada um com 1/(N+1) de cada taxa e de ML_CONCURRENCY, senão o efetivo vira (N+1)x.
+RATE_SHARES = MONITOR_WORKERS + 1 if MONITOR_WORKERS > 0 else 1
+if RATE_SHARES > 1:
+    ML_RATE_ITEMS /= RATE_SHARES
+    ML_RATE_SEARCH /= RATE_SHARES
+    ML_RATE_OAUTH /= RATE_SHARES
+    ML_RATE_MIN /= RATE_SHARES
+    ML_RATE_STEP /= RATE_SHARES
+    ML_CONCURRENCY = max(1, ML_CONCURRENCY // RATE_SHARES)
+    TG_RATE_GLOBAL /= RATE_SHARES
+    TG_RATE_GROUP /= RATE_SHARES
+    TG_RATE_PRIVATE /= RATE_SHARES
+ML_SEARCH_PAGE_MAX = 50  # limite da API em /sites/{site}/search
+# cache de respostas GET: TTL por endpoint (0 = sem cache), menor que POLL_MIN_SECONDS
+ML_CACHE_TTL_ITEMS = float(os.getenv("ML_CACHE_TTL_ITEMS", "20"))
+ML_CACHE_TTL_SEARCH = float(os.getenv("ML_CACHE_TTL_SEARCH", "20"))
+ML_CACHE_MAX_BYTES = int(os.getenv("ML_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "10"))  # página da busca ordenada por preço
+CATALOG_MAX_PAGES = int(os.getenv("CATALOG_MAX_PAGES", "20"))  # teto de páginas por catálogo por ciclo
+SELLER_SCAN_INTERVAL_SECONDS = int(os.getenv("SELLER_SCAN_INTERVAL_SECONDS", os.getenv("CHECK_INTERVAL_SECONDS", "180")))
+SELLER_SCAN_MAX_PAGES = int(os.getenv("SELLER_SCAN_MAX_PAGES", "20"))  # 20 x 50 = 1000 (teto de offset da busca)
+ML_TRIM_PAYLOADS = os.getenv("ML_TRIM_PAYLOADS", "1") == "1"  # pede só os campos usados (?attributes=)
 DB_FILE = "tracker.db"
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))  # cache de páginas do SQLite
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
 SITE_ID = "MLB"  # Brasil
+ML_API_BASE = os.getenv("ML_API_BASE", "https://api.mercadolibre.com").rstrip("/")  # bench.py aponta pro fake local
 
 
 # =========================
@@ -52,7 +176,10 @@ ML_APP_ID = os.getenv("ML_APP_ID", "").strip()
 ML_CLIENT_SECRET = os.getenv("ML_CLIENT_SECRET", "").strip()
 ML_ACCESS_TOKEN = os.getenv("ML_ACCESS_TOKEN", "").strip()
 ML_REFRESH_TOKEN = os.getenv("ML_REFRESH_TOKEN", "").strip()
-ML_TOKEN_EXPIRES_AT = 0  # calculado em runtime
+ML_USER_ID = os.getenv("ML_USER_ID", "").strip()  # vazio = sai do sufixo dos tokens (APP_USR-...-<user_id>)
+ML_TOKEN_EXPIRES_AT = 0  # calculado em runtime (ou lido do token store no banco)
+ML_TOKEN_SAFETY_SECONDS = 120  # token que vence em menos que isso já é tratado como vencido
+ML_TOKEN_REFRESH_AHEAD = int(os.getenv("ML_TOKEN_REFRESH_AHEAD", "900"))  # refresh em background antes de vencer
 
 
 COMMON_HEADERS = {
@@ -64,10 +191,34 @@ COMMON_HEADERS = {
 # =========================
 # DB
 # =========================
-def db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+_db_conn: Optional[sqlite3.Connection] = None
+
+
+def db() -> sqlite3.Connection:
+    """
+    Conexão única e de vida longa (não feche!). WAL + synchronous=NORMAL deixam o commit
+    barato (sem fsync por transação) e o cache de statements reaproveita os SQL preparados.
+    """
+    global _db_conn
+    if _db_conn is None:
+        # timeout: com workers em vários processos, espera o lock de escrita em vez de falhar
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256, timeout=DB_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        conn.create_function("shard_of", 1, shard_of, deterministic=True)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _db_conn = conn
+    return _db_conn
+
+
+def db_close() -> None:
+    global _db_conn
+    if _db_conn is not None:
+        _db_conn.commit()
+        _db_conn.close()
+        _db_conn = None
 
 
 def init_db():
@@ -89,37 +240,440 @@ def init_db():
         last_seen_price REAL,
         last_alert_price REAL,
         last_state TEXT,     -- "OK" | "UNDERCUT"
-        updated_at INTEGER
+        updated_at INTEGER,
+
+        poll_interval INTEGER,       -- intervalo atual (s), adaptativo
+        max_poll_interval INTEGER,   -- teto do intervalo pra esse item (s)
+        next_check_at INTEGER,       -- próximo horário de checagem (epoch)
+        changed_at INTEGER,          -- última alteração feita por comando (workers sincronizam por aqui)
+
+        fail_count INTEGER NOT NULL DEFAULT 0,    -- falhas seguidas do item no ML (cache negativo)
+        fail_reason TEXT,                         -- ex: "404 not_found", "status paused"
+        failing_since INTEGER,
+        fail_notified INTEGER NOT NULL DEFAULT 0, -- 1 = aviso de "item sem monitoramento" já enviado
+
+        pushed_at INTEGER,           -- última notificação do ML (webhook) que tocou esse item
+
+        chat_id TEXT                 -- tenant dono da linha (preço/margem/estado acima são dele)
+    )
+    """)
+    # bancos antigos: adiciona colunas novas
+    _add_column_if_missing(cur, "tracked_items", "poll_interval", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "max_poll_interval", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "next_check_at", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "changed_at", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "fail_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cur, "tracked_items", "fail_reason", "TEXT")
+    _add_column_if_missing(cur, "tracked_items", "failing_since", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "fail_notified", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cur, "tracked_items", "pushed_at", "INTEGER")
+    _add_column_if_missing(cur, "tracked_items", "chat_id", "TEXT")
+    cur.execute("UPDATE tracked_items SET chat_id=? WHERE chat_id IS NULL", (CHAT_ID,))  # linhas de antes dos tenants
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracked_items_mode ON tracked_items(mode)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracked_items_catalog ON tracked_items(catalog_product_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracked_items_state ON tracked_items(last_state)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracked_items_changed ON tracked_items(changed_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tracked_items_chat ON tracked_items(chat_id)")
+
+    # tenants (chats) cadastrados; o CHAT_ID do .env é o admin e não precisa de linha
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tenants (
+        chat_id TEXT PRIMARY KEY,
+        name TEXT,
+        default_undercut REAL,          -- margem do /add sem undercut (NULL = DEFAULT_UNDERCUT_REAIS)
+        created_at INTEGER NOT NULL
+    )
+    """)
+    # outro chat monitorando um item que já tem dono: só o preço/margem/estado dele.
+    # O item continua sendo buscado uma vez por ciclo e o resultado é avaliado pra cada assinatura.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_items (
+        chat_id TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        my_price REAL NOT NULL,
+        undercut_reais REAL NOT NULL,
+        last_state TEXT NOT NULL DEFAULT 'OK',
+        last_alert_price REAL,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER,
+        PRIMARY KEY (chat_id, item_id)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tenant_items_item ON tenant_items(item_id)")
+    # regras de preço por chat: item_id '*' = padrão do chat; a do item sobrescreve chave a chave
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS price_rules (
+        chat_id TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        spec TEXT NOT NULL,             -- ex: "margem=5% piso=90 teto=150 ignorar=123,456 histerese=0.50"
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (chat_id, item_id)
+    )
+    """)
+    if not MULTI_TENANT and CHAT_ID:
+        _rehome_to_admin(cur)
+
+    # histórico append-only: cada linha é um "run" de preço igual (first_seen_at..last_seen_at)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS price_observations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_id TEXT NOT NULL,          -- nosso item monitorado
+        competitor_item_id TEXT,
+        competitor_seller_id INTEGER,
+        price REAL NOT NULL,
+        first_seen_at INTEGER NOT NULL,
+        last_seen_at INTEGER NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_price_observations_item ON price_observations(item_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_price_observations_last_seen ON price_observations(last_seen_at)")
+
+    # histórico antigo reduzido a min/max por hora e por dia
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS price_rollups (
+        item_id TEXT NOT NULL,
+        granularity TEXT NOT NULL,      -- 'hour' | 'day'
+        bucket_start INTEGER NOT NULL,  -- epoch do início da hora/dia (UTC)
+        min_price REAL NOT NULL,
+        max_price REAL NOT NULL,
+        samples INTEGER NOT NULL,
+        PRIMARY KEY (item_id, granularity, bucket_start)
+    )
+    """)
+    # sharding: cada partição (crc32(item_id) % SHARD_PARTITIONS) tem um lease de um worker
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS shard_leases (
+        shard INTEGER PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS monitor_workers (
+        worker_id TEXT PRIMARY KEY,
+        started_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL,
+        metrics TEXT                    -- snapshot JSON do METRICS do worker (lido pelo /stats e /status)
+    )
+    """)
+    _add_column_if_missing(cur, "monitor_workers", "metrics", "TEXT")
+    # modo seller: concorrentes vigiados pelo inventário inteiro (/watchseller)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS watched_sellers (
+        seller_id INTEGER PRIMARY KEY,
+        nickname TEXT,
+        added_at INTEGER NOT NULL,
+        last_scan_at INTEGER,
+        items_seen INTEGER,
+        next_scan_at INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    # último alerta por (seller vigiado, item nosso): evita repetir o mesmo preço a cada varredura
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS seller_alerts (
+        seller_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        competitor_item_id TEXT,
+        price REAL NOT NULL,
+        alerted_at INTEGER NOT NULL,
+        PRIMARY KEY (seller_id, item_id)
     )
     """)
+    # lápides do /remove: workers tiram o item da memória no próximo sync
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS removed_items (
+        item_id TEXT PRIMARY KEY,
+        removed_at INTEGER NOT NULL
+    )
+    """)
+    # token store do OAuth do ML: uma linha só, gravada de uma vez (access + refresh + expiração).
+    # Credencial viva: o tracker.db fica fora do git (.gitignore), como o .env.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ml_tokens (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        access_token TEXT,
+        refresh_token TEXT,
+        expires_at INTEGER NOT NULL DEFAULT 0,
+        env_refresh_token TEXT,     -- ML_REFRESH_TOKEN do .env que originou a linha
+        updated_at INTEGER,
+        refresh_owner TEXT,         -- processo renovando agora (evita dois refresh com o mesmo refresh_token)
+        refresh_until REAL NOT NULL DEFAULT 0
+    )
+    """)
+    cur.executemany("INSERT OR IGNORE INTO shard_leases (shard) VALUES (?)",
+                    [(i,) for i in range(SHARD_PARTITIONS)])
+    cur.execute("DELETE FROM shard_leases WHERE shard >= ?", (SHARD_PARTITIONS,))
     conn.commit()
-    conn.close()
+
+
+def _add_column_if_missing(cur, table: str, column: str, decl: str) -> None:
+    cols = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# =========================
+# Metrics
+# =========================
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CYCLE_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # último = +Inf
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        # estimativa pelo limite superior do bucket (suficiente pra ver regressão)
+        if not self.total:
+            return None
+        target, acc = q * self.total, 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """
+    Métricas em memória do processo: contadores, gauges e histogramas com labels.
+    Lidas pelo /stats e, se METRICS_PORT > 0, servidas em formato Prometheus.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        self.gauges[(name, tuple(sorted((k, str(v)) for k, v in labels.items())))] = value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def counter(self, name: str, **match: Any) -> float:
+        # soma os contadores `name` cujos labels batem com match
+        want = {k: str(v) for k, v in match.items()}
+        return sum(v for (n, labels), v in self.counters.items()
+                   if n == name and all(dict(labels).get(k) == w for k, w in want.items()))
+
+    def gauge(self, name: str, **labels: Any) -> float:
+        return self.gauges.get((name, tuple(sorted((k, str(v)) for k, v in labels.items()))), 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        # forma serializável (JSON) pra outro processo somar com merge()
+        return {
+            "counters": [[n, labels, v] for (n, labels), v in self.counters.items()],
+            "gauges": [[n, labels, v] for (n, labels), v in self.gauges.items()],
+            "histograms": [[n, labels, list(h.buckets), h.counts, h.sum] for (n, labels), h in self.histograms.items()],
+        }
+
+    def merge(self, snap: Dict[str, Any]) -> None:
+        # contadores e histogramas somam; gauges somam, menos os de GAUGES_MAX (pior caso)
+        for n, labels, v in snap.get("counters", []):
+            key = (n, tuple(tuple(kv) for kv in labels))
+            self.counters[key] = self.counters.get(key, 0) + v
+        for n, labels, v in snap.get("gauges", []):
+            key = (n, tuple(tuple(kv) for kv in labels))
+            old = self.gauges.get(key)
+            self.gauges[key] = v if old is None else (max(old, v) if n in GAUGES_MAX else old + v)
+        for n, labels, buckets, counts, total_sum in snap.get("histograms", []):
+            key = (n, tuple(tuple(kv) for kv in labels))
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(tuple(buckets))
+            if len(hist.counts) != len(counts):
+                continue  # buckets diferentes (versão diferente do worker): não dá pra somar
+            hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+            hist.total += sum(counts)
+            hist.sum += total_sum
+
+    def render_prometheus(self) -> str:
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            items = labels + extra
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+        lines: List[str] = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            seen = set()
+            for (name, labels), value in sorted(store.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} {kind}")
+                    seen.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+        seen = set()
+        for (name, labels), hist in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            acc = 0
+            for bound, c in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                acc += c
+                lines.append(f"{name}_bucket{fmt(labels, (('le', str(bound)),))} {acc}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+            lines.append(f"{name}_count{fmt(labels)} {hist.total}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+# gauges que não fazem sentido somados entre processos: o agregado fica com o maior
+GAUGES_MAX = {"cycle_last_seconds", "ml_circuit_open"}
+
+
+def refresh_gauges() -> None:
+    # gauges calculados na hora da leitura
+    now = int(time.time())
+    st = CYCLES.stats
+    METRICS.set("scheduler_overdue_items", SCHEDULER.overdue(now))
+    METRICS.set("scheduler_tracked_items", len(SCHEDULER.due))
+    METRICS.set("store_tracked_items", len(STORE))
+    METRICS.set("ml_cache_bytes", ML_CACHE.size)
+    METRICS.set("ml_cache_entries", len(ML_CACHE.entries))
+    METRICS.set("alerts_queue_size", ALERTS.queue.qsize())
+    for key in ("started", "finished", "skipped", "overruns"):
+        METRICS.set(f"cycles_{key}", st[key])
+    METRICS.set("cycles_running", 1 if CYCLES.running else 0)
+    METRICS.set("cycle_last_seconds", st["last_duration"] or 0)
+    METRICS.set("cycle_last_items", st["last_items"])
+    for name, breaker in ML_BREAKERS.items():
+        METRICS.set("ml_circuit_open", 1 if breaker.is_open() else 0, endpoint=name)
+
+
+def monitor_metrics(conn) -> Metrics:
+    """
+    Métricas pro /stats e /status. Com workers quem roda os ciclos e chama o ML são
+    eles: soma as do bot com o último snapshot de cada worker vivo (monitor_workers).
+    """
+    refresh_gauges()
+    if not MONITOR_WORKERS:
+        return METRICS
+    total = Metrics()
+    total.merge(METRICS.snapshot())
+    for r in conn.execute("SELECT metrics FROM monitor_workers WHERE heartbeat_at >= ? AND metrics IS NOT NULL",
+                          (time.time() - LEASE_TTL_SECONDS,)):
+        try:
+            total.merge(json.loads(r["metrics"]))
+        except (ValueError, TypeError):
+            continue
+    return total
+
+
+async def _metrics_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            refresh_gauges()
+            body, status = METRICS.render_prometheus().encode("utf-8"), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def start_metrics_server(port: int) -> None:
+    global _metrics_server
+    if port <= 0 or _metrics_server is not None:
+        return
+    _metrics_server = await asyncio.start_server(_metrics_http, METRICS_HOST, port)
+    print(f"Métricas Prometheus em http://{METRICS_HOST}:{port}/metrics")
 
 
 # =========================
 # Mercado Livre OAuth helpers
 # =========================
-def _persist_tokens_to_env(access_token: str, refresh_token: str) -> None:
-    # Atualiza ML_ACCESS_TOKEN e ML_REFRESH_TOKEN no .env
-    env_file = env_path
-    lines = env_file.read_text(encoding="utf-8").splitlines()
+_token_lock = asyncio.Lock()  # single-flight do refresh dentro do processo
+_token_owner = f"{socket.gethostname()}:{os.getpid()}"
 
-    def upsert(key: str, value: str, arr: List[str]) -> List[str]:
-        found = False
-        out: List[str] = []
-        for line in arr:
-            if line.startswith(f"{key}="):
-                out.append(f"{key}={value}")
-                found = True
-            else:
-                out.append(line)
-        if not found:
-            out.append(f"{key}={value}")
-        return out
 
-    lines = upsert("ML_ACCESS_TOKEN", access_token, lines)
-    lines = upsert("ML_REFRESH_TOKEN", refresh_token, lines)
-    env_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+def load_token_store() -> None:
+    """
+    Carrega o token salvo no banco. Banco vazio, ou ML_REFRESH_TOKEN do .env trocado
+    (app autorizado de novo), semeia a linha a partir do .env com expiração 0.
+    """
+    global ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, ML_TOKEN_EXPIRES_AT
+    conn = db()
+    row = conn.execute("SELECT * FROM ml_tokens WHERE id=1").fetchone()
+    env_refresh = os.getenv("ML_REFRESH_TOKEN", "").strip()
+    if row is None or (env_refresh and row["env_refresh_token"] != env_refresh):
+        conn.execute("""
+            INSERT INTO ml_tokens (id, access_token, refresh_token, expires_at, env_refresh_token, updated_at)
+            VALUES (1, ?, ?, 0, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                access_token=excluded.access_token, refresh_token=excluded.refresh_token,
+                expires_at=0, env_refresh_token=excluded.env_refresh_token, updated_at=excluded.updated_at
+        """, (os.getenv("ML_ACCESS_TOKEN", "").strip(), env_refresh, env_refresh, int(time.time())))
+        conn.commit()
+        row = conn.execute("SELECT * FROM ml_tokens WHERE id=1").fetchone()
+    ML_ACCESS_TOKEN = row["access_token"] or ""
+    ML_REFRESH_TOKEN = row["refresh_token"] or ""
+    ML_TOKEN_EXPIRES_AT = row["expires_at"] or 0
+
+
+def save_token_store(access_token: str, refresh_token: str, expires_at: int) -> None:
+    conn = db()
+    conn.execute("""
+        UPDATE ml_tokens
+        SET access_token=?, refresh_token=?, expires_at=?, updated_at=?, refresh_owner=NULL, refresh_until=0
+        WHERE id=1
+    """, (access_token, refresh_token, expires_at, int(time.time())))
+    conn.commit()
+
+
+def _claim_token_refresh() -> bool:
+    # um processo por vez troca o refresh_token (o ML rotaciona: o antigo para de valer)
+    conn = db()
+    now = time.time()
+    cur = conn.execute("""
+        UPDATE ml_tokens SET refresh_owner=?, refresh_until=?
+        WHERE id=1 AND (refresh_owner IS NULL OR refresh_owner=? OR refresh_until < ?)
+    """, (_token_owner, now + HTTP_TIMEOUT * 2, _token_owner, now))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def _release_token_refresh() -> None:
+    conn = db()
+    conn.execute("UPDATE ml_tokens SET refresh_owner=NULL, refresh_until=0 WHERE id=1 AND refresh_owner=?",
+                 (_token_owner,))
+    conn.commit()
+
+
+def token_is_fresh() -> bool:
+    return bool(ML_ACCESS_TOKEN) and time.time() < ML_TOKEN_EXPIRES_AT - ML_TOKEN_SAFETY_SECONDS
 
 
 def ml_headers() -> dict:
@@ -128,87 +682,582 @@ def ml_headers() -> dict:
 
 
 
-def ml_refresh_access_token() -> bool:
+async def ml_refresh_access_token(seen_token: Optional[str] = None) -> bool:
     """
-    Renova access_token usando refresh_token.
-    Atualiza ML_ACCESS_TOKEN em memória e no .env (pra você não perder).
+    Renova access_token usando refresh_token e grava os dois + expiração no token store.
+    Single-flight: quem chega com o refresh em andamento espera e usa o token novo
+    (seen_token = token que o chamador viu falhar/vencer). Entre processos (workers),
+    o claim em ml_tokens garante que só um usa o refresh_token; os outros leem o resultado.
     """
     global ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, ML_TOKEN_EXPIRES_AT
 
-    if not ML_APP_ID or not ML_CLIENT_SECRET or not ML_REFRESH_TOKEN:
-        print("ML OAuth: faltando ML_APP_ID / ML_CLIENT_SECRET / ML_REFRESH_TOKEN (verifique .env)")
-        return False
+    seen = ML_ACCESS_TOKEN if seen_token is None else seen_token
+    async with _token_lock:
+        load_token_store()
+        if ML_ACCESS_TOKEN != seen and token_is_fresh():
+            return True  # outra task/processo já renovou enquanto esperávamos
+
+        if not ML_APP_ID or not ML_CLIENT_SECRET or not ML_REFRESH_TOKEN:
+            print("ML OAuth: faltando ML_APP_ID / ML_CLIENT_SECRET / ML_REFRESH_TOKEN (verifique .env)")
+            return False
+
+        if not _claim_token_refresh():
+            # outro processo está renovando: espera ele gravar
+            deadline = time.monotonic() + HTTP_TIMEOUT * 2
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+                load_token_store()
+                if ML_ACCESS_TOKEN != seen and token_is_fresh():
+                    return True
+            print("ML OAuth: refresh de outro processo não terminou a tempo")
+            return False
+
+        try:
+            url = f"{ML_API_BASE}/oauth/token"
+            data = {
+                "grant_type": "refresh_token",
+                "client_id": ML_APP_ID,
+                "client_secret": ML_CLIENT_SECRET,
+                "refresh_token": ML_REFRESH_TOKEN,
+            }
+
+            r = await ml_request("POST", url, data=data, auth=False, endpoint="oauth")
+            if r.status_code != 200:
+                METRICS.inc("ml_token_refresh_total", result="error")
+                print("Falha ao renovar token ML:", r.status_code, r.text[:300])
+                return False
+            METRICS.inc("ml_token_refresh_total", result="ok")
+
+            payload = r.json()
+            ML_ACCESS_TOKEN = payload.get("access_token", ML_ACCESS_TOKEN)
+            ML_REFRESH_TOKEN = payload.get("refresh_token", ML_REFRESH_TOKEN)  # pode rotacionar
+            ML_TOKEN_EXPIRES_AT = int(time.time()) + int(payload.get("expires_in", 21600))
+            save_token_store(ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, ML_TOKEN_EXPIRES_AT)
+            return True
+        finally:
+            _release_token_refresh()
+
+
+async def ml_ensure_token() -> None:
+    if ML_TOKEN_EXPIRES_AT == 0:
+        load_token_store()  # restart: token salvo ainda vale, sem chamada de OAuth
+    if not token_is_fresh():
+        await ml_refresh_access_token()
+
+
+async def token_refresh_loop() -> None:
+    # renova em background ML_TOKEN_REFRESH_AHEAD segundos antes de vencer,
+    # pra nenhuma chamada do ciclo ficar esperando o OAuth
+    while True:
+        try:
+            load_token_store()
+            wait = ML_TOKEN_EXPIRES_AT - ML_TOKEN_REFRESH_AHEAD - time.time()
+            if wait > 0 and ML_ACCESS_TOKEN:
+                await asyncio.sleep(min(wait, 300))  # relê o store: outro processo pode ter renovado
+                continue
+            ok = await ml_refresh_access_token()
+            await asyncio.sleep(60 if ok else 30)  # nunca mais que 1 refresh proativo por minuto
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Erro no refresh do token ML:", e)
+            await asyncio.sleep(30)
 
-    url = "https://api.mercadolibre.com/oauth/token"
-    data = {
-        "grant_type": "refresh_token",
-        "client_id": ML_APP_ID,
-        "client_secret": ML_CLIENT_SECRET,
-        "refresh_token": ML_REFRESH_TOKEN,
-    }
 
-    r = requests.post(url, data=data, timeout=HTTP_TIMEOUT)
-    if r.status_code != 200:
-        print("Falha ao renovar token ML:", r.status_code, r.text[:300])
-        return False
+# =========================
+# ML HTTP client
+# =========================
+_ml_client: Optional[httpx.AsyncClient] = None
+
+
+def ml_client() -> httpx.AsyncClient:
+    # Cliente HTTP assíncrono compartilhado: pool keep-alive, sem novo handshake TLS por chamada
+    global _ml_client
+    if _ml_client is None:
+        _ml_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=ML_POOL_SIZE,
+                max_keepalive_connections=ML_POOL_SIZE,
+                keepalive_expiry=ML_KEEPALIVE_SECONDS,
+            ),
+        )
+    return _ml_client
+
+
+async def ml_close_client(_app=None) -> None:
+    global _ml_client
+    if _ml_client is not None:
+        await _ml_client.aclose()
+        _ml_client = None
+
+
+class TokenBucket:
+    """
+    Token bucket assíncrono com taxa adaptativa (AIMD).
+    on_throttle() corta a taxa pela metade e respeita Retry-After;
+    on_success() devolve a taxa aos poucos até max_rate.
+    """
+
+    def __init__(self, name: str, max_rate: float):
+        self.name = name
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = max(1.0, max_rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        if self.max_rate <= 0:
+            return
+        async with self.lock:  # fila FIFO: quem chegou primeiro sai primeiro
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self) -> None:
+        if self.max_rate > 0 and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + ML_RATE_STEP)
+
+    def on_throttle(self, retry_after: Optional[float]) -> None:
+        if self.max_rate <= 0:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = max(min(ML_RATE_MIN, self.max_rate), self.rate / 2)
+        self.tokens = 0.0
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        print(f"ML 429 em {self.name}: taxa reduzida para {self.rate:.2f} req/s"
+              + (f", pausa de {retry_after:.0f}s" if retry_after else ""))
+
+
+ML_RATE_LIMITERS: Dict[str, TokenBucket] = {
+    "items": TokenBucket("items", ML_RATE_ITEMS),
+    "search": TokenBucket("search", ML_RATE_SEARCH),
+    "oauth": TokenBucket("oauth", ML_RATE_OAUTH),
+}
+
+
+class MLUnavailable(Exception):
+    """Circuito do endpoint aberto: a chamada nem sai."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por endpoint do ML. ML_BREAKER_THRESHOLD falhas seguidas (5xx ou
+    conexão, já depois dos retries) abrem o circuito por ML_BREAKER_COOLDOWN segundos:
+    nesse tempo ml_request levanta MLUnavailable sem chamar a API. Passado o cooldown,
+    uma chamada de teste passa (half-open); sucesso fecha, falha reabre.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probing = False
+
+    def is_open(self) -> bool:
+        return 0 < ML_BREAKER_THRESHOLD <= self.failures and time.monotonic() < self.opened_until
+
+    def allow(self) -> bool:
+        if ML_BREAKER_THRESHOLD <= 0 or self.failures < ML_BREAKER_THRESHOLD:
+            return True
+        if self.probing or time.monotonic() < self.opened_until:
+            return False
+        self.probing = True  # só uma chamada de teste por vez
+        return True
+
+    def on_success(self) -> None:
+        if ML_BREAKER_THRESHOLD > 0 and self.failures >= ML_BREAKER_THRESHOLD:
+            print(f"ML {self.name}: circuito fechado, API respondendo de novo")
+            METRICS.set("ml_circuit_open", 0, endpoint=self.name)
+        self.failures = 0
+        self.probing = False
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if 0 < ML_BREAKER_THRESHOLD <= self.failures:
+            self.opened_until = time.monotonic() + ML_BREAKER_COOLDOWN
+            METRICS.inc("ml_circuit_opened_total", endpoint=self.name)
+            METRICS.set("ml_circuit_open", 1, endpoint=self.name)
+            print(f"ML {self.name}: {self.failures} falhas seguidas, circuito aberto por {ML_BREAKER_COOLDOWN:.0f}s")
+
+
+ML_BREAKERS: Dict[str, CircuitBreaker] = {name: CircuitBreaker(name) for name in ML_RATE_LIMITERS}
+
+
+class CacheEntry:
+    __slots__ = ("response", "expires_at", "size", "etag", "last_modified")
+
+    def __init__(self, response: httpx.Response, expires_at: float):
+        self.response = response
+        self.expires_at = expires_at
+        self.size = len(response.content)
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+
+CacheKey = Tuple[str, str, Tuple[Tuple[str, str], ...]]
 
-    payload = r.json()
-    ML_ACCESS_TOKEN = payload.get("access_token", ML_ACCESS_TOKEN)
-    ML_REFRESH_TOKEN = payload.get("refresh_token", ML_REFRESH_TOKEN)  # pode rotacionar
 
-    expires_in = int(payload.get("expires_in", 21600))
-    ML_TOKEN_EXPIRES_AT = int(time.time()) + max(60, expires_in - 120)  # renova 2 min antes
+class ResponseCache:
+    """
+    Cache em processo das respostas GET 200 do ML, chave = endpoint + url + params (sem o token).
+    TTL por endpoint, LRU limitado por ML_CACHE_MAX_BYTES e single-flight: misses
+    simultâneos da mesma chave esperam uma chamada só. Entrada vencida com ETag ou
+    Last-Modified é revalidada com If-None-Match / If-Modified-Since (304 renova o TTL).
+    """
 
+    def __init__(self, max_bytes: int, ttls: Dict[str, float]):
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        self.size = 0
+        self.inflight: Dict[CacheKey, asyncio.Future] = {}
+
+    @staticmethod
+    def key(endpoint: str, url: str, params: Optional[Dict[str, Any]]) -> CacheKey:
+        return endpoint, url, tuple(sorted((k, str(v)) for k, v in (params or {}).items() if k != "access_token"))
+
+    def ttl(self, endpoint: str) -> float:
+        return self.ttls.get(endpoint, 0)
+
+    def _drop(self, key: CacheKey) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _store(self, key: CacheKey, response: httpx.Response, ttl: float) -> None:
+        self._drop(key)
+        entry = CacheEntry(response, time.monotonic() + ttl)
+        if entry.size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _old, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            METRICS.inc("ml_cache_evictions_total")
+
+    def get(self, key: CacheKey) -> Optional[httpx.Response]:
+        # consulta sem buscar: resposta ainda no TTL ou None (conta hit/miss)
+        entry = self.entries.get(key)
+        if entry is None or entry.expires_at <= time.monotonic():
+            METRICS.inc("ml_cache_total", endpoint=key[0], result="miss")
+            return None
+        self.entries.move_to_end(key)
+        METRICS.inc("ml_cache_total", endpoint=key[0], result="hit")
+        return entry.response
+
+    def put(self, key: CacheKey, response: httpx.Response) -> None:
+        self._store(key, response, self.ttl(key[0]))
+
+    def invalidate(self, tokens: List[str]) -> int:
+        # remove entradas cujo url/params citam algum desses ids (item ou catálogo)
+        stale = [k for k in self.entries if any(t in k[1] or any(t in v for _p, v in k[2]) for t in tokens)]
+        for k in stale:
+            self._drop(k)
+        return len(stale)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    async def fetch(
+        self, key: CacheKey, fetch: Callable[[Dict[str, str]], Awaitable[httpx.Response]]
+    ) -> httpx.Response:
+        endpoint = key[0]
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self.entries.move_to_end(key)
+            METRICS.inc("ml_cache_total", endpoint=endpoint, result="hit")
+            return entry.response
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            METRICS.inc("ml_cache_total", endpoint=endpoint, result="coalesced")
+            return await asyncio.shield(pending)
+
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # ninguém esperando: sem warning
+        self.inflight[key] = fut
+        try:
+            conditional: Dict[str, str] = {}
+            if entry is not None and entry.etag:
+                conditional["If-None-Match"] = entry.etag
+            if entry is not None and entry.last_modified:
+                conditional["If-Modified-Since"] = entry.last_modified
+            r = await fetch(conditional)
+            if r.status_code == 304 and entry is not None:
+                METRICS.inc("ml_cache_total", endpoint=endpoint, result="revalidated")
+                # a entrada pode ter saído durante o await (invalidate/LRU/clear): grava de novo
+                r = entry.response
+                self._store(key, r, self.ttl(endpoint))
+            else:
+                METRICS.inc("ml_cache_total", endpoint=endpoint, result="miss")
+                if r.status_code == 200:
+                    self._store(key, r, self.ttl(endpoint))
+                else:
+                    self._drop(key)
+            fut.set_result(r)
+            return r
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+
+ML_CACHE = ResponseCache(ML_CACHE_MAX_BYTES, {"items": ML_CACHE_TTL_ITEMS, "search": ML_CACHE_TTL_SEARCH})
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After pode vir em segundos ou como data HTTP
+    if not value:
+        return None
     try:
-        _persist_tokens_to_env(ML_ACCESS_TOKEN, ML_REFRESH_TOKEN)
-    except Exception as e:
-        print("Aviso: não consegui atualizar .env automaticamente:", e)
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-    return True
 
+ML_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# falhas em que a requisição não chegou a ser enviada: seguras de repetir em qualquer método
+ML_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
 
-def ml_ensure_token() -> None:
-    global ML_TOKEN_EXPIRES_AT
-    if ML_TOKEN_EXPIRES_AT == 0:
-        # força refresh no start para ter expiração controlada
-        ml_refresh_access_token()
-        return
-    if int(time.time()) >= ML_TOKEN_EXPIRES_AT:
-        ml_refresh_access_token()
+
+def ml_backoff(attempt: int) -> float:
+    # backoff exponencial com "full jitter"
+    return random.uniform(0, min(ML_BACKOFF_MAX, ML_BACKOFF_BASE * (2 ** attempt)))
+
+
+async def ml_request(
+    method: str,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    data: Optional[Dict[str, Any]] = None,
+    auth: bool = True,
+    endpoint: str = "items",
+) -> httpx.Response:
+    """
+    Toda chamada ao ML passa por aqui.
+    GET de endpoint com TTL > 0 passa antes pelo ML_CACHE (hit não gasta quota).
+    """
+    if method == "GET" and ML_CACHE.ttl(endpoint) > 0:
+        return await ML_CACHE.fetch(
+            ML_CACHE.key(endpoint, url, params),
+            lambda headers: _ml_send(method, url, params, data, auth, endpoint, headers),
+        )
+    return await _ml_send(method, url, params, data, auth, endpoint)
+
+
+async def _ml_send(
+    method: str,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    data: Optional[Dict[str, Any]] = None,
+    auth: bool = True,
+    endpoint: str = "items",
+    extra_headers: Optional[Dict[str, str]] = None,
+) -> httpx.Response:
+    """
+    Chamada de verdade ao ML.
+    endpoint escolhe o rate limiter ("items" | "search" | "oauth").
+    auth=True: injeta access_token e, em 401/403, renova o token e repete 1x.
+    5xx, 429 e falhas de conexão são repetidos até ML_MAX_RETRIES vezes com backoff.
+    Métodos não idempotentes (POST) só repetem quando a requisição comprovadamente não
+    saiu (falha ao conectar) ou em 429: timeout de leitura/5xx pode já ter sido processado.
+    Com o circuito do endpoint aberto levanta MLUnavailable sem chamar a API.
+    """
+    breaker = ML_BREAKERS[endpoint]
+    if auth:
+        # antes do allow(): se o refresh do token falhar, não sobra chamada de teste presa
+        await ml_ensure_token()
+    if not breaker.allow():
+        raise MLUnavailable(endpoint)
+    probe = breaker.probing  # esta é a chamada de teste do half-open
+    try:
+        return await _ml_attempts(method, url, params, data, auth, endpoint, extra_headers, breaker)
+    finally:
+        if probe:
+            # saída sem on_success/on_failure (exceção, cancelamento): libera o próximo teste
+            breaker.probing = False
+
+
+async def _ml_attempts(
+    method: str,
+    url: str,
+    params: Optional[Dict[str, Any]],
+    data: Optional[Dict[str, Any]],
+    auth: bool,
+    endpoint: str,
+    extra_headers: Optional[Dict[str, str]],
+    breaker: CircuitBreaker,
+) -> httpx.Response:
+    limiter = ML_RATE_LIMITERS[endpoint]
+    idempotent = method.upper() in ML_IDEMPOTENT_METHODS
+    refreshed = False
+    attempt = 0
+    while True:
+        p = dict(params or {})
+        if auth and ML_ACCESS_TOKEN:
+            p["access_token"] = ML_ACCESS_TOKEN
+
+        await limiter.acquire()
+        t0 = time.monotonic()
+        try:
+            headers = ml_headers()
+            if extra_headers:
+                headers.update(extra_headers)  # If-None-Match / If-Modified-Since do cache
+            r = await ml_client().request(method, url, params=p, data=data, headers=headers)
+        except httpx.TransportError as e:
+            METRICS.observe("ml_request_seconds", time.monotonic() - t0, endpoint=endpoint)
+            METRICS.inc("ml_responses_total", endpoint=endpoint, status="conn_error")
+            if attempt >= ML_MAX_RETRIES or not (idempotent or isinstance(e, ML_UNSENT_ERRORS)):
+                breaker.on_failure()
+                raise
+            METRICS.inc("ml_retries_total", endpoint=endpoint, reason="conn_error")
+            print(f"ML {method} {url}: falha de conexão ({e!r}), tentativa {attempt + 1}/{ML_MAX_RETRIES}")
+        else:
+            METRICS.observe("ml_request_seconds", time.monotonic() - t0, endpoint=endpoint)
+            METRICS.inc("ml_responses_total", endpoint=endpoint, status=r.status_code)
+            # Se token expirou/invalidou, tenta refresh e repete 1x
+            if auth and r.status_code in (401, 403) and not refreshed:
+                refreshed = True
+                METRICS.inc("ml_retries_total", endpoint=endpoint, reason="auth")
+                await ml_refresh_access_token(seen_token=p.get("access_token"))
+                continue
+            if r.status_code == 429:
+                # o próprio limiter segura a próxima tentativa (Retry-After / taxa reduzida)
+                limiter.on_throttle(parse_retry_after(r.headers.get("Retry-After")))
+                if attempt >= ML_MAX_RETRIES:
+                    breaker.probing = False
+                    return r
+                METRICS.inc("ml_retries_total", endpoint=endpoint, reason="429")
+                attempt += 1
+                continue
+            if r.status_code < 500:
+                limiter.on_success()
+                breaker.on_success()
+                return r
+            if attempt >= ML_MAX_RETRIES or not idempotent:
+                breaker.on_failure()
+                return r
+            METRICS.inc("ml_retries_total", endpoint=endpoint, reason="5xx")
+            print(f"ML {method} {url}: erro {r.status_code}, tentativa {attempt + 1}/{ML_MAX_RETRIES}")
+
+        await asyncio.sleep(ml_backoff(attempt))
+        attempt += 1
 
 
 # =========================
 # Mercado Livre API
 # =========================
+# Campos que cada chamada pede via ?attributes= (o ML manda só isso, não o item inteiro
+# com fotos/atributos/shipping). ML_TRIM_PAYLOADS=0 volta a pedir o payload completo.
+ITEM_FIELDS = ("id", "title", "price", "seller_id", "catalog_product_id", "status")
+OFFER_FIELDS = ("id", "price", "seller")
+SELLER_FIELDS = ("id", "price", "catalog_product_id")
+
+
+class ItemInfo:
+    """O pedaço do /items/{id} que o bot usa."""
+    __slots__ = ("id", "title", "price", "seller_id", "catalog_product_id", "status")
+
+    def __init__(self, id=None, title=None, price=None, seller_id=None, catalog_product_id=None, status=None):
+        self.id = id
+        self.title = title
+        self.price = price
+        self.seller_id = seller_id
+        self.catalog_product_id = catalog_product_id
+        self.status = status
+
+
+NO_ITEM = ItemInfo()
+
+
+class Offer:
+    """Uma oferta do catálogo (resultado do /search)."""
+    __slots__ = ("id", "price", "seller_id")
+
+    def __init__(self, id: Optional[str], price: float, seller_id: Optional[int]):
+        self.id = id
+        self.price = price
+        self.seller_id = seller_id
+
+
+class SellerListing:
+    """Um anúncio do inventário de um seller vigiado (resultado do /search?seller_id=)."""
+    __slots__ = ("id", "price", "catalog_product_id")
+
+    def __init__(self, id: str, price: float, catalog_product_id: Optional[str]):
+        self.id = id
+        self.price = price
+        self.catalog_product_id = catalog_product_id
+
+
+class CatalogPage:
+    """Uma página do /search: ofertas, total de resultados e se veio ordenada por preço."""
+    __slots__ = ("offers", "total", "price_sorted")
+
+    def __init__(self, offers: List[Offer], total: int, price_sorted: bool):
+        self.offers = offers
+        self.total = total
+        self.price_sorted = price_sorted
+
+
+def ml_attributes(fields: Tuple[str, ...], prefix: str = "") -> Dict[str, str]:
+    if not ML_TRIM_PAYLOADS or not fields:
+        return {}
+    return {"attributes": ",".join(prefix + f for f in fields)}
+
+
 def extract_item_id(text: str) -> Optional[str]:
     t = text.strip()
     m = re.search(r"(MLB\d{6,})", t.upper())
     return m.group(1) if m else None
 
 
-def ml_get_item(item_id: str) -> Tuple[Optional[str], Optional[float], Optional[int], Optional[str]]:
-    ml_ensure_token()
-
-    url = f"https://api.mercadolibre.com/items/{item_id}"
-    params = {"access_token": ML_ACCESS_TOKEN} if ML_ACCESS_TOKEN else {}
+def item_cache_key(item_id: str, fields: Tuple[str, ...]) -> CacheKey:
+    # mesma chave pro GET /items/{id} e pra cada item do multiget: o cache é por item
+    return ML_CACHE.key("items", f"{ML_API_BASE}/items/{item_id}", ml_attributes(fields))
 
-    r = requests.get(url, params=params, timeout=HTTP_TIMEOUT, headers=ml_headers())
 
-    # Se token expirou/invalidou, tenta refresh e repete 1x
-    if r.status_code in (401, 403):
-        ml_refresh_access_token()
-        params = {"access_token": ML_ACCESS_TOKEN} if ML_ACCESS_TOKEN else {}
-        r = requests.get(url, params=params, timeout=HTTP_TIMEOUT, headers=ml_headers())
+async def ml_get_item(item_id: str, fields: Tuple[str, ...] = ITEM_FIELDS) -> ItemInfo:
+    url = f"{ML_API_BASE}/items/{item_id}"
+    r = await ml_request("GET", url, params=ml_attributes(fields) or None)
 
     if r.status_code != 200:
         print(f"ML /items erro {r.status_code} para {item_id}: {r.text[:200]}")
-        return None, None, None, None
+        return NO_ITEM
 
-    data = r.json()
-    title = data.get("title")
+    return _parse_item(r.json())
+
+
+def _parse_item(data: Dict[str, Any]) -> ItemInfo:
     price = data.get("price")
     seller_id = data.get("seller_id")
-    catalog_product_id = data.get("catalog_product_id")
 
     try:
         price = float(price) if price is not None else None
@@ -220,32 +1269,198 @@ def ml_get_item(item_id: str) -> Tuple[Optional[str], Optional[float], Optional[
     except:
         seller_id = None
 
-    return title, price, seller_id, catalog_product_id
+    return ItemInfo(data.get("id"), data.get("title"), price, seller_id, data.get("catalog_product_id"),
+                    data.get("status"))
 
 
-def ml_search_by_catalog(catalog_product_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-    ml_ensure_token()
+async def ml_get_items(
+    item_ids: List[str], fields: Tuple[str, ...] = ITEM_FIELDS, errors: Optional[Dict[str, str]] = None
+) -> Dict[str, ItemInfo]:
+    """
+    Multiget /items?ids=A,B,C (no máximo ML_MULTIGET_MAX ids por chamada).
+    Devolve {item_id: ItemInfo}. Itens que vierem com erro no lote ficam de fora do dict;
+    se errors for passado, recebe {item_id: "404 not_found"} desses itens.
+    "id" é sempre pedido, senão não dá pra casar a resposta com o item.
+    O cache é por item: ids ainda no TTL saem do ML_CACHE e só os outros vão no ids=;
+    cada item que volta do lote vira uma entrada própria (a mesma do /items/{id}).
+    """
+    if not item_ids:
+        return {}
+
+    fields = fields if "id" in fields else ("id",) + tuple(fields)
+    use_cache = ML_CACHE.ttl("items") > 0
+    out: Dict[str, ItemInfo] = {}
+    ids: List[str] = []
+    for item_id in item_ids[:ML_MULTIGET_MAX]:
+        cached = ML_CACHE.get(item_cache_key(item_id, fields)) if use_cache else None
+        if cached is not None:
+            out[item_id] = _parse_item(cached.json())
+        else:
+            ids.append(item_id)
+    if not ids:
+        return out
 
-    url = f"https://api.mercadolibre.com/sites/{SITE_ID}/search"
-    params = {"catalog_product_id": catalog_product_id, "limit": limit}
-    if ML_ACCESS_TOKEN:
-        params["access_token"] = ML_ACCESS_TOKEN
+    url = f"{ML_API_BASE}/items"
+    params = {"ids": ",".join(ids)}
+    params.update(ml_attributes(fields))
+    # o lote em si não entra no cache: a combinação de ids quase nunca se repete
+    r = await _ml_send("GET", url, params=params)
 
-    r = requests.get(url, params=params, timeout=HTTP_TIMEOUT, headers=ml_headers())
+    if r.status_code != 200:
+        print(f"ML /items?ids erro {r.status_code} para {params['ids']}: {r.text[:200]}")
+        return out
 
-    if r.status_code in (401, 403):
-        ml_refresh_access_token()
-        params = {"catalog_product_id": catalog_product_id, "limit": limit}
-        if ML_ACCESS_TOKEN:
-            params["access_token"] = ML_ACCESS_TOKEN
-        r = requests.get(url, params=params, timeout=HTTP_TIMEOUT, headers=ml_headers())
+    # a resposta vem na ordem dos ids pedidos; o body de erro nem sempre traz o id
+    for requested, entry in zip(ids, r.json() or []):
+        body = entry.get("body") or {}
+        code = entry.get("code")
+        if code != 200:
+            print(f"ML /items?ids erro {code} para {requested}: {str(body.get('message') or body)[:200]}")
+            if errors is not None and code is not None and 400 <= int(code) < 500 and code != 429:
+                errors[requested] = f"{code} {body.get('error') or 'erro'}"
+            continue
+        if body.get("id"):
+            out[body["id"]] = _parse_item(body)
+            if use_cache:
+                ML_CACHE.put(item_cache_key(body["id"], fields), httpx.Response(200, json=body))
+    return out
+
+
+def chunked(seq: List[Any], size: int) -> List[List[Any]]:
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+
+async def ml_search_by_catalog(
+    catalog_product_id: str,
+    limit: int = ML_SEARCH_PAGE_MAX,
+    offset: int = 0,
+    sort: Optional[str] = None,
+    fields: Tuple[str, ...] = OFFER_FIELDS,
+) -> Optional[CatalogPage]:
+    url = f"{ML_API_BASE}/sites/{SITE_ID}/search"
+    params: Dict[str, Any] = {"catalog_product_id": catalog_product_id, "limit": limit, "offset": offset}
+    if sort:
+        params["sort"] = sort
+    attrs = ml_attributes(fields, prefix="results.")
+    if attrs:
+        params["attributes"] = attrs["attributes"] + ",paging,sort"  # paginação e ordem efetiva
+    r = await ml_request("GET", url, params=params, endpoint="search")
 
     if r.status_code != 200:
         print(f"ML /search erro {r.status_code} catalog {catalog_product_id}: {r.text[:200]}")
-        return []
+        return None
+
+    data = r.json()
+    results = data.get("results", []) or []
+    total = (data.get("paging") or {}).get("total")
+    price_sorted = (data.get("sort") or {}).get("id") == "price_asc"
+    return CatalogPage(parse_offers(results), int(total) if total is not None else offset + len(results),
+                       price_sorted)
+
+
+# a API ignorou sort=price_asc: vai direto pra varredura completa até esse horário (monotonic)
+_catalog_unsorted_until = 0.0
+
+
+async def ml_catalog_offers(catalog_product_id: str, my_seller_ids: Set[int]) -> Optional[List[Offer]]:
+    """
+    Ofertas do catálogo até achar o concorrente mais barato.
+    Pede a busca ordenada por preço em páginas pequenas (CATALOG_PAGE_SIZE) e para na
+    primeira oferta que não é de nenhum seller nosso: ela é o menor concorrente de todas
+    as linhas desse catálogo. Se a API não devolver ordenado, pagina tudo (páginas de 50,
+    até CATALOG_MAX_PAGES) e o mínimo sai da lista completa; a ordenação é testada de
+    novo depois de uma hora. None = busca falhou.
+    """
+    global _catalog_unsorted_until
+    offers: List[Offer] = []
+    offset = 0
+    if time.monotonic() < _catalog_unsorted_until:
+        sort, page_size = None, ML_SEARCH_PAGE_MAX
+    else:
+        sort, page_size = "price_asc", CATALOG_PAGE_SIZE
+    for _ in range(CATALOG_MAX_PAGES):
+        page = await ml_search_by_catalog(catalog_product_id, limit=page_size, offset=offset, sort=sort,
+                                          fields=OFFER_FIELDS)
+        if page is None:
+            return None  # lista parcial poderia esconder o concorrente mais barato
+        if sort and not page.price_sorted:
+            # sem ordenação: recomeça varrendo tudo em páginas cheias
+            METRICS.inc("catalog_scan_unsorted_total")
+            _catalog_unsorted_until = time.monotonic() + 3600
+            sort, page_size, offset, offers = None, ML_SEARCH_PAGE_MAX, 0, []
+            continue
+        offers.extend(page.offers)
+        offset += page_size
+        if sort and any(o.seller_id not in my_seller_ids for o in page.offers):
+            break  # ordenado: dali pra frente só tem preço maior
+        if offset >= page.total or not page.offers:
+            break
+    else:
+        METRICS.inc("catalog_scan_truncated_total")
+        print(f"Catálogo {catalog_product_id}: parei em {CATALOG_MAX_PAGES} páginas ({len(offers)} ofertas)")
+    return offers
+
+
+async def ml_search_by_seller(
+    seller_id: int, limit: int = ML_SEARCH_PAGE_MAX, offset: int = 0, fields: Tuple[str, ...] = SELLER_FIELDS
+) -> Optional[Tuple[List[SellerListing], int]]:
+    url = f"{ML_API_BASE}/sites/{SITE_ID}/search"
+    params: Dict[str, Any] = {"seller_id": seller_id, "limit": limit, "offset": offset}
+    attrs = ml_attributes(fields, prefix="results.")
+    if attrs:
+        params["attributes"] = attrs["attributes"] + ",paging"
+    r = await ml_request("GET", url, params=params, endpoint="search")
+
+    if r.status_code != 200:
+        print(f"ML /search erro {r.status_code} seller {seller_id}: {r.text[:200]}")
+        return None
 
     data = r.json()
-    return data.get("results", []) or []
+    listings: List[SellerListing] = []
+    for it in data.get("results", []) or []:
+        try:
+            listings.append(SellerListing(it["id"], float(it.get("price")), it.get("catalog_product_id")))
+        except:
+            continue
+    total = (data.get("paging") or {}).get("total")
+    return listings, int(total) if total is not None else offset + len(listings)
+
+
+async def ml_seller_inventory(seller_id: int) -> Optional[List[SellerListing]]:
+    """
+    Inventário MLB inteiro do seller: a 1ª página dá o total, as outras vão em paralelo
+    (o rate limiter do search segura o ritmo). Limitado a SELLER_SCAN_MAX_PAGES páginas.
+    None = alguma página falhou (índice parcial daria falso "sem concorrente").
+    """
+    first = await ml_search_by_seller(seller_id, offset=0, fields=SELLER_FIELDS)
+    if first is None:
+        return None
+    listings, total = first
+    pages = min(SELLER_SCAN_MAX_PAGES, -(-total // ML_SEARCH_PAGE_MAX))
+    rest = await asyncio.gather(*(
+        ml_search_by_seller(seller_id, offset=i * ML_SEARCH_PAGE_MAX, fields=SELLER_FIELDS) for i in range(1, pages)
+    ))
+    if any(page is None for page in rest):
+        return None
+    for page_listings, _total in rest:
+        listings.extend(page_listings)
+    if total > pages * ML_SEARCH_PAGE_MAX:
+        METRICS.inc("seller_scan_truncated_total")
+        print(f"Seller {seller_id}: {total} anúncios, varri só os primeiros {pages * ML_SEARCH_PAGE_MAX}")
+    return listings
+
+
+def parse_offers(results: List[Dict[str, Any]]) -> List[Offer]:
+    offers: List[Offer] = []
+    for it in results:
+        try:
+            it_price = float(it.get("price"))
+            it_seller = (it.get("seller") or {}).get("id")
+            it_seller = int(it_seller) if it_seller is not None else None
+        except:
+            continue
+        offers.append(Offer(it.get("id"), it_price, it_seller))
+    return offers
 
 
 def ml_item_link(item_id: str) -> str:
@@ -255,23 +1470,379 @@ def ml_item_link(item_id: str) -> str:
 # =========================
 # Telegram helpers
 # =========================
-async def tg_reply(update: Update, text: str):
+async def tg_reply(update: Update, text: str, reply_markup=None):
     if update.message:
-        await update.message.reply_text(text)
+        await update.message.reply_text(text, reply_markup=reply_markup)
 
 
-async def tg_send(app, text: str):
-    if not BOT_TOKEN or not CHAT_ID:
+async def tg_send(app, text: str, chat_id: Optional[str] = None, preview: bool = True):
+    chat_id = chat_id or CHAT_ID
+    if not BOT_TOKEN or not chat_id:
         print("ERRO: TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID não configurados no .env")
         return
-    await app.bot.send_message(chat_id=CHAT_ID, text=text, disable_web_page_preview=False)
+    await app.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=not preview)
+
+
+def split_message(parts: List[str], limit: int = TG_MAX_MESSAGE) -> List[str]:
+    # junta as partes em mensagens de até `limit` caracteres, quebrando entre partes
+    out: List[str] = []
+    cur = ""
+    for part in parts:
+        while len(part) > limit:  # parte sozinha maior que o limite: corta no braço
+            if cur:
+                out.append(cur)
+                cur = ""
+            out.append(part[:limit])
+            part = part[limit:]
+        if not cur:
+            cur = part
+        elif len(cur) + 2 + len(part) <= limit:
+            cur += "\n\n" + part
+        else:
+            out.append(cur)
+            cur = part
+    if cur:
+        out.append(cur)
+    return out
+
+
+class AlertDispatcher:
+    """
+    Fila de saída dos alertas, separada do monitor: o ciclo só enfileira (enqueue) e segue.
+    Alertas que chegam dentro de ALERT_COALESCE_SECONDS viram um digest por chat,
+    quebrado em mensagens de até 4096 caracteres. O envio respeita limite global e
+    por chat do Telegram e espera o flood-wait (RetryAfter) antes de tentar de novo.
+    """
+
+    def __init__(self):
+        self.queue: "asyncio.Queue[Tuple[str, str]]" = asyncio.Queue()
+        self.global_bucket = TokenBucket("telegram", TG_RATE_GLOBAL)
+        self.chat_buckets: Dict[str, TokenBucket] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.app = None
+
+    def enqueue(self, text: str, chat_id: Optional[str] = None) -> None:
+        self.queue.put_nowait((chat_id or CHAT_ID, text))
+
+    def start(self, app) -> None:
+        self.app = app
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # grupos (id negativo) aguentam ~20 msg/min; chats privados ~1 msg/s
+            rate = TG_RATE_GROUP if str(chat_id).startswith("-") else TG_RATE_PRIVATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(f"telegram {chat_id}", rate)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(ALERT_COALESCE_SECONDS)
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            by_chat: Dict[str, List[str]] = {}
+            for chat_id, text in batch:
+                by_chat.setdefault(chat_id, []).append(text)
+
+            for chat_id, texts in by_chat.items():
+                for chunk in split_message(texts):
+                    await self._send(chat_id, chunk, preview=len(texts) == 1)
+
+    async def _send(self, chat_id: str, text: str, preview: bool) -> None:
+        for attempt in range(TG_MAX_RETRIES + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            t0 = time.monotonic()
+            try:
+                await tg_send(self.app, text, chat_id=chat_id, preview=preview)
+                METRICS.observe("alert_send_seconds", time.monotonic() - t0)
+                METRICS.inc("alerts_sent_total", result="ok")
+                return
+            except RetryAfter as e:
+                METRICS.inc("alerts_sent_total", result="flood_wait")
+                wait = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                print(f"Telegram flood-wait: aguardando {wait}s")
+                await asyncio.sleep(float(wait) + 0.5)
+            except (BadRequest, Forbidden) as e:
+                # recusa definitiva (chat inválido, bot bloqueado, mensagem malformada): repetir
+                # só segura os alertas dos outros chats. BadRequest herda de NetworkError no PTB.
+                METRICS.inc("alerts_sent_total", result="rejected")
+                print(f"Telegram recusou a mensagem (chat {chat_id}):", e)
+                return
+            except NetworkError as e:
+                METRICS.inc("alerts_sent_total", result="network_error")
+                print("Telegram erro de rede:", e)
+                await asyncio.sleep(ml_backoff(attempt))
+            except TelegramError as e:
+                METRICS.inc("alerts_sent_total", result="rejected")
+                print("Telegram recusou a mensagem:", e)
+                return
+        print(f"Alerta descartado após {TG_MAX_RETRIES + 1} tentativas (chat {chat_id})")
+
+
+ALERTS = AlertDispatcher()
 
 
 # =========================
 # Alert logic
 # =========================
-def should_alert(my_price: float, undercut: float, competitor_price: float) -> bool:
-    return competitor_price <= (my_price - undercut)
+def cheapest_competitor(
+    offers: List[Offer], my_seller_id: Optional[int], ignore: FrozenSet[int] = frozenset()
+) -> Optional[Offer]:
+    # menor oferta do catálogo que não seja do nosso seller nem de um seller ignorado pela regra
+    best = None
+    for o in offers:
+        if my_seller_id is not None and o.seller_id == my_seller_id:
+            continue
+        if o.seller_id in ignore:
+            continue
+        if best is None or o.price < best.price:
+            best = o
+    return best
+
+
+# =========================
+# Regras de preço (motor em lote)
+# =========================
+RULE_KEYS = {
+    "margem": "margin_pct", "margin": "margin_pct",
+    "piso": "floor", "floor": "floor",
+    "teto": "ceiling", "ceiling": "ceiling",
+    "ignorar": "ignore_sellers", "ignore": "ignore_sellers",
+    "histerese": "hysteresis", "hysteresis": "hysteresis",
+}
+
+
+class PriceRule:
+    """
+    Regra compilada a partir do texto do /rule (uma vez por texto distinto):
+    margem em % do meu preço (no lugar do undercut em reais), piso/teto do preço
+    sugerido, sellers ignorados e histerese (R$) pra entrar/sair de UNDERCUT.
+    """
+    __slots__ = ("spec", "margin_pct", "floor", "ceiling", "ignore_sellers", "hysteresis")
+
+    def __init__(self, spec: str = ""):
+        self.spec = spec
+        self.margin_pct: Optional[float] = None
+        self.floor: Optional[float] = None
+        self.ceiling: Optional[float] = None
+        self.ignore_sellers: FrozenSet[int] = frozenset()
+        self.hysteresis = 0.0
+
+    def describe(self) -> str:
+        parts = []
+        if self.margin_pct is not None:
+            parts.append(f"margem {self.margin_pct:g}%")
+        if self.floor is not None:
+            parts.append(f"piso {fmt_price(self.floor)}")
+        if self.ceiling is not None:
+            parts.append(f"teto {fmt_price(self.ceiling)}")
+        if self.ignore_sellers:
+            parts.append(f"ignora {len(self.ignore_sellers)} seller(s)")
+        if self.hysteresis:
+            parts.append(f"histerese {fmt_price(self.hysteresis)}")
+        return ", ".join(parts) or "padrão (undercut em R$)"
+
+
+NO_RULE = PriceRule()
+
+
+def compile_rule(spec: str) -> PriceRule:
+    # "chave=valor" separados por espaço; chave repetida vale a última (padrão do chat + regra do item)
+    rule = PriceRule(spec)
+    for token in spec.split():
+        key, sep, value = token.partition("=")
+        field = RULE_KEYS.get(key.lower())
+        if not sep or field is None:
+            raise ValueError(f"regra desconhecida: {token} (use margem, piso, teto, ignorar, histerese)")
+        try:
+            if value.lower() in ("off", "-"):
+                setattr(rule, field, getattr(NO_RULE, field))
+            elif field == "ignore_sellers":
+                rule.ignore_sellers = frozenset(int(v) for v in value.split(",") if v.strip())
+            elif field == "margin_pct":
+                rule.margin_pct = _num(value.rstrip("%"))
+            else:
+                setattr(rule, field, _num(value))
+        except ValueError:
+            raise ValueError(f"valor inválido: {token}")
+    if rule.margin_pct is not None and not 0 <= rule.margin_pct < 100:
+        raise ValueError("margem tem que ficar entre 0% e 100%")
+    if rule.floor is not None and rule.ceiling is not None and rule.floor > rule.ceiling:
+        raise ValueError("piso maior que o teto")
+    if rule.hysteresis < 0:
+        raise ValueError("histerese negativa")
+    return rule
+
+
+class RuleBook:
+    """
+    Regras de price_rules em memória, já compiladas. refresh() no começo de cada ciclo
+    só relê a tabela se ela mudou (workers pegam o /rule do processo do bot assim).
+    A regra efetiva de (chat, item) é o padrão do chat ('*') + a do item, compilada
+    uma vez por texto e guardada por (chat, item).
+    """
+
+    def __init__(self):
+        self.specs: Dict[Tuple[str, str], str] = {}
+        self.compiled: Dict[str, PriceRule] = {}
+        self.resolved: Dict[Tuple[str, str], PriceRule] = {}
+        self.version: Optional[Tuple[Any, ...]] = None
+
+    def refresh(self, conn, force: bool = False) -> None:
+        version = tuple(conn.execute("SELECT COUNT(*), MAX(updated_at) FROM price_rules").fetchone())
+        if version == self.version and not force:
+            return
+        self.specs = {(r["chat_id"], r["item_id"]): r["spec"]
+                      for r in conn.execute("SELECT chat_id, item_id, spec FROM price_rules")}
+        self.resolved = {}
+        self.version = version
+
+    def rule_for(self, chat_id: Optional[str], item_id: str) -> PriceRule:
+        if not self.specs:
+            return NO_RULE
+        key = (chat_id or CHAT_ID, item_id)
+        rule = self.resolved.get(key)
+        if rule is None:
+            spec = " ".join(s for s in (self.specs.get((key[0], "*")), self.specs.get(key)) if s)
+            rule = self.compiled.get(spec)
+            if rule is None:
+                try:
+                    rule = self.compiled[spec] = compile_rule(spec) if spec else NO_RULE
+                except ValueError as e:
+                    print(f"Regra inválida pra {key}: {e}")
+                    rule = self.compiled[spec] = NO_RULE
+            self.resolved[key] = rule
+        return rule
+
+    def ignored(self, chat_ids: List[str], item_id: str) -> Set[int]:
+        out: Set[int] = set()
+        for chat_id in chat_ids:
+            out |= self.rule_for(chat_id, item_id).ignore_sellers
+        return out
+
+
+RULES = RuleBook()
+
+
+class RuleDecision:
+    """Resultado do lote em arrays (posição = ordem do add) + índices que mudam algo (diff)."""
+    __slots__ = ("undercut", "alert", "suggested", "below_floor", "changed")
+
+    def __init__(self, undercut, alert, suggested, below_floor, changed):
+        self.undercut = undercut
+        self.alert = alert
+        self.suggested = suggested
+        self.below_floor = below_floor
+        self.changed = changed
+
+
+class RuleBatch:
+    """
+    Avaliações de um lote em colunas: uma por (chat, item) com o preço de concorrente
+    que sobrou pra ele (NaN = nenhum). As colunas são array('d'), que o numpy lê sem
+    copiar; evaluate() decide o lote inteiro sem laço em Python e devolve em changed
+    só as posições com transição de estado ou alerta; quem aplica percorre só essas.
+    """
+
+    def __init__(self):
+        self.targets: List[Any] = []    # TrackedItem (dono) ou Subscription
+        self.meta: List[Any] = []       # o que a mensagem de alerta precisa (quem monta decide)
+        self.rules: List[PriceRule] = []
+        self.rows = array("l")          # linha do lote a que a avaliação pertence
+        self.my_price = array("d")
+        self.undercut = array("d")
+        self.margin_pct = array("d")
+        self.floor = array("d")
+        self.ceiling = array("d")
+        self.hysteresis = array("d")
+        self.competitor = array("d")
+        self.was_undercut = array("b")
+        self.last_alert = array("d")
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def add(self, target: Any, rule: PriceRule, competitor_price: Optional[float], row: int = 0, meta: Any = None) -> None:
+        nan = float("nan")
+        self.targets.append(target)
+        self.meta.append(meta)
+        self.rules.append(rule)
+        self.rows.append(row)
+        self.my_price.append(target.my_price)
+        self.undercut.append(target.undercut_reais)
+        self.margin_pct.append(nan if rule.margin_pct is None else rule.margin_pct)
+        self.floor.append(nan if rule.floor is None else rule.floor)
+        self.ceiling.append(nan if rule.ceiling is None else rule.ceiling)
+        self.hysteresis.append(rule.hysteresis)
+        self.competitor.append(nan if competitor_price is None else competitor_price)
+        self.was_undercut.append(target.last_state == "UNDERCUT")
+        self.last_alert.append(nan if target.last_alert_price is None else float(target.last_alert_price))
+
+    def evaluate(self) -> RuleDecision:
+        def col(a: array, dtype=np.float64) -> np.ndarray:
+            return np.frombuffer(a, dtype=dtype) if len(a) else np.zeros(0, dtype=dtype)
+
+        my, pct, hyst, comp = col(self.my_price), col(self.margin_pct), col(self.hysteresis), col(self.competitor)
+        floor, last = col(self.floor), col(self.last_alert)
+        was = col(self.was_undercut, np.int8).astype(bool)
+
+        # limite = meu preço - margem (% do meu preço se a regra tiver, senão o undercut em R$)
+        limit = my - np.where(np.isnan(pct), col(self.undercut), my * pct / 100.0)
+        below = comp <= limit
+        # histerese: entra em UNDERCUT no limite, só sai quando passar do limite + banda
+        undercut = below | (was & (comp <= limit + hyst))
+        # anti-spam: alerta ao cruzar o limite ou quando o concorrente mexe mais que a banda
+        # (dentro da banda, acima do limite, segue UNDERCUT mas não alerta)
+        moved = np.isnan(last) | (np.abs(comp - last) > np.maximum(hyst, 0.0001))
+        alert = below & (~was | moved)
+        suggested = np.clip(comp, np.nan_to_num(floor, nan=-np.inf), np.nan_to_num(col(self.ceiling), nan=np.inf))
+        return RuleDecision(undercut, alert, suggested, comp < floor, np.flatnonzero((undercut != was) | alert))
+
+    def undercut_rows(self, decision: RuleDecision, n_rows: int) -> np.ndarray:
+        # linha em UNDERCUT se qualquer chat dela está (pro polling adaptativo)
+        if not self.targets:
+            return np.zeros(n_rows, dtype=bool)
+        rows = np.frombuffer(self.rows, dtype=np.dtype(f"i{self.rows.itemsize}"))
+        return np.bincount(rows, weights=decision.undercut, minlength=n_rows) > 0
+
+
+def undercut_message(
+    title: Optional[str], item_id: str, mode: str, my_price: float, undercut: float,
+    competitor_price: float, competitor_item_id: Optional[str], competitor_seller_id: Optional[int],
+    rule: PriceRule = NO_RULE, suggested: Optional[float] = None, below_floor: bool = False,
+) -> str:
+    margin = f"{rule.margin_pct:g}% ({fmt_price(my_price * rule.margin_pct / 100)})" if rule.margin_pct is not None \
+        else fmt_price(undercut)
+    lines = [
+        "🔥 ALERTA (ML) — CONCORRENTE ABAIXO DO SEU PREÇO",
+        f"Produto base: {title or item_id}",
+        f"Modo: {mode}",
+        f"Seu preço: {fmt_price(my_price)}",
+        f"Concorrente: {fmt_price(competitor_price)}",
+        f"Margem: {margin}",
+    ]
+    if rule.floor is not None or rule.ceiling is not None:
+        lines.append(f"Sugerido: {fmt_price(suggested)}" + (" (concorrente abaixo do seu piso)" if below_floor else ""))
+    lines += [
+        f"Item concorrente: {competitor_item_id}",
+        f"Seller concorrente: {competitor_seller_id}",
+        f"Link: {ml_item_link(competitor_item_id or item_id)}",
+    ]
+    return "\n".join(lines)
 
 
 def fmt_price(v: Optional[float]) -> str:
@@ -281,28 +1852,232 @@ def fmt_price(v: Optional[float]) -> str:
 # =========================
 # Commands
 # =========================
+def _rehome_to_admin(cur) -> None:
+    """
+    Sem MULTI_TENANT tudo é do CHAT_ID: linhas carimbadas com outro chat que não é
+    tenant cadastrado (TELEGRAM_CHAT_ID trocado depois da migração) voltam pro CHAT_ID,
+    senão somem do /list e os alertas continuam indo pro chat antigo. Assinatura do
+    CHAT_ID num item que agora é dele mesmo vira o preço/margem da própria linha.
+    """
+    orphan = "chat_id IS NOT ? AND chat_id NOT IN (SELECT chat_id FROM tenants)"
+    cur.execute(f"UPDATE tracked_items SET chat_id=? WHERE {orphan}", (CHAT_ID, CHAT_ID))
+    for table in ("tenant_items", "price_rules"):
+        # OR IGNORE: se o CHAT_ID já tem a mesma chave, a dele vale e a órfã é descartada
+        cur.execute(f"UPDATE OR IGNORE {table} SET chat_id=? WHERE {orphan}", (CHAT_ID, CHAT_ID))
+        cur.execute(f"DELETE FROM {table} WHERE {orphan}", (CHAT_ID,))
+    own = "chat_id=? AND item_id IN (SELECT item_id FROM tracked_items WHERE chat_id=?)"
+    cur.execute(f"""
+        UPDATE tracked_items SET
+            my_price = (SELECT s.my_price FROM tenant_items s WHERE s.chat_id=? AND s.item_id=tracked_items.item_id),
+            undercut_reais = (SELECT s.undercut_reais FROM tenant_items s
+                              WHERE s.chat_id=? AND s.item_id=tracked_items.item_id)
+        WHERE chat_id=? AND item_id IN (SELECT item_id FROM tenant_items WHERE chat_id=?)
+    """, (CHAT_ID,) * 4)
+    cur.execute(f"DELETE FROM tenant_items WHERE {own}", (CHAT_ID, CHAT_ID))
+
+
+async def require_tenant(update: Update, admin: bool = False) -> Optional[str]:
+    """
+    Chat (tenant) em nome de quem o comando roda. Sem MULTI_TENANT é sempre o CHAT_ID.
+    Com MULTI_TENANT, chat sem cadastro recebe o aviso e o comando para (None);
+    admin=True deixa só o CHAT_ID passar.
+    """
+    if not MULTI_TENANT:
+        return CHAT_ID
+    chat_id = str(update.effective_chat.id)
+    if chat_id == CHAT_ID:
+        return chat_id
+    if admin:
+        await tg_reply(update, "Esse comando é só do chat admin.")
+        return None
+    if db().execute("SELECT 1 FROM tenants WHERE chat_id=?", (chat_id,)).fetchone():
+        return chat_id
+    await tg_reply(update, f"Chat sem cadastro no monitor. Peça pro admin: /tenant add {chat_id}")
+    return None
+
+
+def tenant_default_undercut(chat_id: str) -> float:
+    row = db().execute("SELECT default_undercut FROM tenants WHERE chat_id=?", (chat_id,)).fetchone()
+    return float(row["default_undercut"]) if row and row["default_undercut"] is not None else DEFAULT_UNDERCUT_REAIS
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
-        "✅ ML Tracker ON (Listing + Catalog)\n\n"
+        "✅ ML Tracker ON (Listing + Catalog + Seller)\n\n"
         "Comandos:\n"
         "/add <MLB... ou link> <meu_preco> [undercut_reais] [mode]\n"
         "mode: listing | catalog (padrão: listing)\n\n"
-        "/list\n"
+        "/list [state=OK|UNDERCUT] [mode=listing|catalog] [texto do título]\n"
         "/remove <MLB...>\n"
         "/setprice <MLB...> <meu_preco>\n"
         "/setundercut <MLB...> <reais>\n"
         "/setmode <MLB...> <listing|catalog>\n"
+        "/setpoll <MLB...> <max_segundos>\n"
+        "/rule [MLB...|*] [margem=5% piso=90 teto=150 ignorar=123,456 histerese=0.5 | off]\n"
+        "/watchseller [seller_id] [apelido] (sem args: lista)\n"
+        "/unwatchseller <seller_id>\n"
+        "/status\n"
+        "/stats\n"
+        "/import (CSV/JSON: item, my_price, undercut, mode)\n"
+        "/export\n"
+        "/tenant [undercut <reais>] | admin: /tenant add|remove <chat_id> [nome], /tenant list\n"
     )
     await tg_reply(update, msg)
 
 
-async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    args = context.args
-    if len(args) < 2:
-        await tg_reply(update, "Uso: /add <MLB... ou link> <meu_preco> [undercut_reais] [listing|catalog]")
-        return
-
-    item_id = extract_item_id(args[0])
+SQL_UPSERT_TRACKED_ITEM = """
+    INSERT INTO tracked_items (
+        item_id, title, my_price, undercut_reais, mode,
+        my_seller_id, catalog_product_id,
+        last_seen_price, last_state, updated_at,
+        poll_interval, next_check_at, changed_at, chat_id
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(item_id) DO UPDATE SET
+        title=excluded.title,
+        my_price=excluded.my_price,
+        undercut_reais=excluded.undercut_reais,
+        mode=excluded.mode,
+        my_seller_id=excluded.my_seller_id,
+        catalog_product_id=excluded.catalog_product_id,
+        last_seen_price=excluded.last_seen_price,
+        updated_at=excluded.updated_at,
+        poll_interval=excluded.poll_interval,
+        next_check_at=excluded.next_check_at,
+        changed_at=excluded.changed_at,
+        fail_count=0,
+        fail_reason=NULL,
+        failing_since=NULL,
+        fail_notified=0
+"""
+
+
+def upsert_tracked_item(
+    cur, chat_id: str, item_id: str, title: Optional[str], my_price: float, undercut: float, mode: str,
+    seller_id: Optional[int], catalog_product_id: Optional[str], price: Optional[float],
+) -> None:
+    # grava (sem commit) e agenda a primeira checagem; só é chamado pro dono (ou item novo)
+    now = int(time.time())
+    cur.execute(SQL_UPSERT_TRACKED_ITEM, (
+        item_id, title, my_price, undercut, mode,
+        seller_id, catalog_product_id,
+        price, "OK", now,
+        CHECK_INTERVAL_SECONDS, now + CHECK_INTERVAL_SECONDS, now, chat_id
+    ))
+    STORE.upsert(
+        item_id, title=title, my_price=my_price, undercut_reais=undercut, mode=mode,
+        my_seller_id=seller_id, catalog_product_id=catalog_product_id, last_seen_price=price, updated_at=now,
+        poll_interval=CHECK_INTERVAL_SECONDS, next_check_at=now + CHECK_INTERVAL_SECONDS,
+        fail_count=0, fail_reason=None, failing_since=None, fail_notified=0, chat_id=chat_id,
+    )
+
+
+def track_item(
+    cur, chat_id: str, item_id: str, title: Optional[str], my_price: float, undercut: float, mode: str,
+    seller_id: Optional[int], catalog_product_id: Optional[str], price: Optional[float],
+) -> bool:
+    """
+    /add e /import: item novo (ou do próprio chat) vai pra tracked_items com o chat
+    como dono. Item que outro chat já monitora vira só uma assinatura (tenant_items)
+    com o preço/margem deste chat: a busca no ML continua uma por item e por ciclo.
+    Devolve True se virou assinatura (modo e intervalo seguem os do dono).
+    """
+    row = cur.execute("SELECT chat_id FROM tracked_items WHERE item_id=?", (item_id,)).fetchone()
+    if row is None or row["chat_id"] == chat_id:
+        upsert_tracked_item(cur, chat_id, item_id, title, my_price, undercut, mode, seller_id, catalog_product_id, price)
+        return False
+    now = int(time.time())
+    cur.execute("""
+        INSERT INTO tenant_items (chat_id, item_id, my_price, undercut_reais, last_state, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'OK', ?, ?)
+        ON CONFLICT(chat_id, item_id) DO UPDATE SET
+            my_price=excluded.my_price, undercut_reais=excluded.undercut_reais, updated_at=excluded.updated_at
+    """, (chat_id, item_id, my_price, undercut, now, now))
+    # avalia a assinatura já no próximo ciclo; workers recarregam o item pelo changed_at
+    cur.execute("UPDATE tracked_items SET next_check_at=?, changed_at=? WHERE item_id=?", (now, now, item_id))
+    STORE.put_sub(item_id, chat_id, my_price=my_price, undercut_reais=undercut, updated_at=now)
+    STORE.update(item_id, next_check_at=now)
+    return True
+
+
+def untrack_item(cur, chat_id: str, item_id: str) -> bool:
+    """
+    Tira o item do chat (sem commit). Assinatura: some só ela. Dono: se ninguém mais
+    acompanha, apaga a linha (com lápide pros workers); senão a assinatura mais antiga
+    vira dona, levando preço/margem/estado dela pra tracked_items.
+    """
+    now = int(time.time())
+    cur.execute("DELETE FROM price_rules WHERE chat_id=? AND item_id=?", (chat_id, item_id))
+    cur.execute("DELETE FROM tenant_items WHERE chat_id=? AND item_id=?", (chat_id, item_id))
+    if cur.rowcount:
+        cur.execute("UPDATE tracked_items SET changed_at=? WHERE item_id=?", (now, item_id))
+        STORE.drop_sub(item_id, chat_id)
+        return True
+
+    if not cur.execute("SELECT 1 FROM tracked_items WHERE item_id=? AND chat_id=?", (item_id, chat_id)).fetchone():
+        return False
+    heir = cur.execute(
+        "SELECT * FROM tenant_items WHERE item_id=? ORDER BY created_at, chat_id LIMIT 1", (item_id,)
+    ).fetchone()
+    if heir is None:
+        cur.execute("DELETE FROM tracked_items WHERE item_id=?", (item_id,))
+        # workers tiram o item da memória deles pela lápide no próximo heartbeat
+        cur.execute("INSERT OR REPLACE INTO removed_items (item_id, removed_at) VALUES (?, ?)", (item_id, now))
+        STORE.remove(item_id)
+        return True
+
+    fields = dict(chat_id=heir["chat_id"], my_price=float(heir["my_price"]), undercut_reais=float(heir["undercut_reais"]),
+                  last_state=heir["last_state"] or "OK", last_alert_price=heir["last_alert_price"])
+    cur.execute("""
+        UPDATE tracked_items SET chat_id=?, my_price=?, undercut_reais=?, last_state=?, last_alert_price=?,
+                                 updated_at=?, changed_at=?
+        WHERE item_id=?
+    """, (*fields.values(), now, now, item_id))
+    cur.execute("DELETE FROM tenant_items WHERE chat_id=? AND item_id=?", (heir["chat_id"], item_id))
+    STORE.drop_sub(item_id, heir["chat_id"])
+    STORE.update(item_id, updated_at=now, **fields)
+    return True
+
+
+def update_tenant_item(conn, chat_id: str, item_id: str, **fields: Any) -> bool:
+    """
+    /setprice e /setundercut: muda o preço/margem do chat no item, seja ele o dono
+    (tracked_items) ou assinante (tenant_items), e reavalia o item já no próximo ciclo.
+    """
+    now = int(time.time())
+    sets = ", ".join(f"{name}=?" for name in fields)
+    cur = conn.cursor()
+    cur.execute(f"UPDATE tracked_items SET {sets}, updated_at=?, next_check_at=?, changed_at=? "
+                "WHERE item_id=? AND chat_id=?", (*fields.values(), now, now, now, item_id, chat_id))
+    if cur.rowcount:
+        conn.commit()
+        STORE.update(item_id, updated_at=now, next_check_at=now, **fields)  # reavalia já com o novo valor
+        return True
+    cur.execute(f"UPDATE tenant_items SET {sets}, updated_at=? WHERE chat_id=? AND item_id=?",
+                (*fields.values(), now, chat_id, item_id))
+    if not cur.rowcount:
+        return False
+    cur.execute("UPDATE tracked_items SET next_check_at=?, changed_at=? WHERE item_id=?", (now, now, item_id))
+    conn.commit()
+    STORE.put_sub(item_id, chat_id, updated_at=now, **fields)
+    STORE.update(item_id, next_check_at=now)
+    return True
+
+
+def is_subscriber(conn, chat_id: str, item_id: str) -> bool:
+    return conn.execute("SELECT 1 FROM tenant_items WHERE chat_id=? AND item_id=?", (chat_id, item_id)).fetchone() is not None
+
+
+async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    args = context.args
+    if len(args) < 2:
+        await tg_reply(update, "Uso: /add <MLB... ou link> <meu_preco> [undercut_reais] [listing|catalog]")
+        return
+
+    item_id = extract_item_id(args[0])
     if not item_id:
         await tg_reply(update, "Não consegui identificar o ITEM_ID (MLB...). Envie MLB... ou link do anúncio.")
         return
@@ -313,7 +2088,7 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await tg_reply(update, "Preço inválido. Ex: /add MLB123 299.90 1.00 catalog")
         return
 
-    undercut = DEFAULT_UNDERCUT_REAIS
+    undercut = tenant_default_undercut(tenant)
     mode = "listing"
 
     if len(args) >= 3:
@@ -333,7 +2108,8 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await tg_reply(update, "Mode inválido. Use: listing ou catalog.")
             return
 
-    title, price, seller_id, catalog_product_id = ml_get_item(item_id)
+    item = await ml_get_item(item_id, fields=ITEM_FIELDS)
+    title, price, seller_id, catalog_product_id = item.title, item.price, item.seller_id, item.catalog_product_id
     if price is None:
         await tg_reply(update, "Não consegui puxar preço via API autenticada do ML. Verifique o item e tente de novo.")
         return
@@ -347,40 +2123,18 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     conn = db()
-    cur = conn.cursor()
-    now = int(time.time())
-
-    cur.execute("""
-    INSERT INTO tracked_items (
-        item_id, title, my_price, undercut_reais, mode,
-        my_seller_id, catalog_product_id,
-        last_seen_price, last_state, updated_at
-    )
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(item_id) DO UPDATE SET
-        title=excluded.title,
-        my_price=excluded.my_price,
-        undercut_reais=excluded.undercut_reais,
-        mode=excluded.mode,
-        my_seller_id=excluded.my_seller_id,
-        catalog_product_id=excluded.catalog_product_id,
-        last_seen_price=excluded.last_seen_price,
-        updated_at=excluded.updated_at
-    """, (
-        item_id, title, my_price, undercut, mode,
-        seller_id, catalog_product_id,
-        price, "OK", now
-    ))
-
+    shared = track_item(conn.cursor(), tenant, item_id, title, my_price, undercut, mode, seller_id,
+                        catalog_product_id, price)
     conn.commit()
-    conn.close()
+    if shared:
+        mode = conn.execute("SELECT mode FROM tracked_items WHERE item_id=?", (item_id,)).fetchone()["mode"]
 
     await tg_reply(
         update,
         "✅ Adicionado:\n"
         f"{title}\n"
         f"ID: {item_id}\n"
-        f"Modo: {mode}\n"
+        f"Modo: {mode}" + (" (item já monitorado por outro chat: modo e intervalo são os dele)" if shared else "") + "\n"
         f"Preço atual: {fmt_price(price)}\n"
         f"Seu preço: {fmt_price(my_price)}\n"
         f"Margem: {fmt_price(undercut)}\n"
@@ -388,34 +2142,153 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT item_id, title, my_price, undercut_reais, mode, last_seen_price, last_state, catalog_product_id
-        FROM tracked_items
-        ORDER BY id DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        await tg_reply(update, "Nenhum item monitorado ainda. Use /add")
-        return
-
-    lines = ["📦 Itens monitorados:"]
-    for r in rows:
-        lines.append(
+def parse_list_filters(args: List[str]) -> Dict[str, Optional[str]]:
+    # state=UNDERCUT mode=catalog q=texto (ou texto solto = busca no título)
+    filters: Dict[str, Optional[str]] = {"state": None, "mode": None, "q": None}
+    words: List[str] = []
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if sep and key in ("state", "estado"):
+            filters["state"] = value.upper() or None
+        elif sep and key in ("mode", "modo"):
+            filters["mode"] = value.lower() or None
+        elif sep and key in ("q", "busca"):
+            words.append(value)
+        else:
+            words.append(arg)
+    filters["q"] = " ".join(w for w in words if w) or None
+    return filters
+
+
+# linhas que um chat enxerga: as que ele é dono + as assinaturas dele (com o preço/margem/estado dele)
+SQL_TENANT_ITEMS = """
+    SELECT t.id, t.item_id, t.title, t.mode, t.catalog_product_id, t.last_seen_price,
+           COALESCE(s.my_price, t.my_price) AS my_price,
+           COALESCE(s.undercut_reais, t.undercut_reais) AS undercut_reais,
+           COALESCE(s.last_state, t.last_state) AS last_state
+    FROM tracked_items t LEFT JOIN tenant_items s ON s.item_id = t.item_id AND s.chat_id = ?
+    WHERE t.chat_id = ? OR s.chat_id IS NOT NULL
+"""
+
+
+def _list_filter_sql(filters: Dict[str, Optional[str]]) -> Tuple[str, List[Any]]:
+    clauses, params = ["1=1"], []
+    if filters["state"]:
+        clauses.append("last_state=?")
+        params.append(filters["state"])
+    if filters["mode"]:
+        clauses.append("mode=?")
+        params.append(filters["mode"])
+    if filters["q"]:
+        q = filters["q"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        clauses.append("title LIKE ? ESCAPE '\\'")
+        params.append(f"%{q}%")
+    return " AND ".join(clauses), params
+
+
+def _list_callback(direction: str, cursor: int, filters: Dict[str, Optional[str]]) -> str:
+    # callback_data do Telegram tem no máximo 64 bytes: a busca pode ser truncada
+    data = f"list|{direction}|{cursor}|{filters['state'] or ''}|{filters['mode'] or ''}|{filters['q'] or ''}"
+    return data.encode("utf-8")[:64].decode("utf-8", "ignore")
+
+
+def render_list_page(
+    chat_id: str, filters: Dict[str, Optional[str]], cursor: Optional[int], direction: str = "n"
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Uma página do /list com paginação keyset sobre id (mais novos primeiro).
+    direction "n": ids menores que cursor; "p": ids maiores (página anterior).
+    As linhas são lidas do cursor do SQLite sob demanda e a página para antes de
+    passar de LIST_PAGE_SIZE itens ou do limite de 4096 caracteres.
+    """
+    where, params = _list_filter_sql(filters)
+    params = [chat_id, chat_id] + params
+    source = f"({SQL_TENANT_ITEMS})"
+    if direction == "p":
+        sql = f"SELECT * FROM {source} WHERE {where} AND id > ? ORDER BY id ASC LIMIT ?"
+        args = params + [cursor or 0, LIST_PAGE_SIZE]
+    elif cursor is not None:
+        sql = f"SELECT * FROM {source} WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?"
+        args = params + [cursor, LIST_PAGE_SIZE]
+    else:
+        sql = f"SELECT * FROM {source} WHERE {where} ORDER BY id DESC LIMIT ?"
+        args = params + [LIST_PAGE_SIZE]
+
+    header = "📦 Itens monitorados:"
+    active = [f"{k}={v}" for k, v in filters.items() if v]
+    if active:
+        header += f" ({' '.join(active)})"
+
+    blocks: List[Tuple[int, str]] = []
+    size = len(header)
+    cur = db().execute(sql, args)
+    for r in cur:
+        block = (
             f"\n• {r['item_id']} ({r['mode']})\n"
             f"{(r['title'] or '')[:80]}\n"
             f"Meu: {fmt_price(r['my_price'])} | Margem: {fmt_price(r['undercut_reais'])}\n"
             f"Último: {fmt_price(r['last_seen_price'])} | Estado: {r['last_state']}\n"
             f"Catalog: {r['catalog_product_id'] or '—'}"
         )
-    await tg_reply(update, "\n".join(lines))
+        if blocks and size + len(block) + 1 > TG_MAX_MESSAGE:
+            break
+        blocks.append((r["id"], block))
+        size += len(block) + 1
+    cur.close()
+
+    if not blocks:
+        if active:
+            return "Nenhum item com esses filtros.", None
+        return "Nenhum item monitorado ainda. Use /add", None
+    if direction == "p":
+        blocks.reverse()
+
+    first_id, last_id = blocks[0][0], blocks[-1][0]
+    conn = db()
+    has_prev = conn.execute(f"SELECT 1 FROM {source} WHERE {where} AND id > ? LIMIT 1",
+                            params + [first_id]).fetchone() is not None
+    has_next = conn.execute(f"SELECT 1 FROM {source} WHERE {where} AND id < ? LIMIT 1",
+                            params + [last_id]).fetchone() is not None
+
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Anteriores", callback_data=_list_callback("p", first_id, filters)))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Próximos ➡️", callback_data=_list_callback("n", last_id, filters)))
+    keyboard = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    return "\n".join([header] + [b for _, b in blocks]), keyboard
+
+
+async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    text, keyboard = render_list_page(tenant, parse_list_filters(context.args or []), None)
+    await tg_reply(update, text, reply_markup=keyboard)
+
+
+async def cb_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    try:
+        _, direction, cursor, state, mode, q = query.data.split("|", 5)
+        cursor_id = int(cursor)
+    except ValueError:
+        return
+    filters = {"state": state or None, "mode": mode or None, "q": q or None}
+    text, keyboard = render_list_page(tenant, filters, cursor_id, direction)
+    await query.edit_message_text(text, reply_markup=keyboard)
 
 
 async def cmd_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
     if not context.args:
         await tg_reply(update, "Uso: /remove <MLB...>")
         return
@@ -425,16 +2298,16 @@ async def cmd_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     conn = db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM tracked_items WHERE item_id=?", (item_id,))
-    changes = cur.rowcount
+    changes = untrack_item(conn.cursor(), tenant, item_id)
     conn.commit()
-    conn.close()
 
     await tg_reply(update, "✅ Removido." if changes else "Não encontrei esse item no monitoramento.")
 
 
 async def cmd_setprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
     if len(context.args) < 2:
         await tg_reply(update, "Uso: /setprice <MLB...> <meu_preco>")
         return
@@ -448,18 +2321,15 @@ async def cmd_setprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await tg_reply(update, "Preço inválido.")
         return
 
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE tracked_items SET my_price=?, updated_at=? WHERE item_id=?",
-                (my_price, int(time.time()), item_id))
-    conn.commit()
-    changes = cur.rowcount
-    conn.close()
+    changes = update_tenant_item(db(), tenant, item_id, my_price=my_price)
 
     await tg_reply(update, "✅ Atualizado." if changes else "Não encontrei esse item no monitoramento.")
 
 
 async def cmd_setundercut(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
     if len(context.args) < 2:
         await tg_reply(update, "Uso: /setundercut <MLB...> <reais>")
         return
@@ -473,18 +2343,15 @@ async def cmd_setundercut(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await tg_reply(update, "Valor inválido.")
         return
 
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE tracked_items SET undercut_reais=?, updated_at=? WHERE item_id=?",
-                (undercut, int(time.time()), item_id))
-    conn.commit()
-    changes = cur.rowcount
-    conn.close()
+    changes = update_tenant_item(db(), tenant, item_id, undercut_reais=undercut)
 
     await tg_reply(update, "✅ Atualizado." if changes else "Não encontrei esse item no monitoramento.")
 
 
 async def cmd_setmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
     if len(context.args) < 2:
         await tg_reply(update, "Uso: /setmode <MLB...> <listing|catalog>")
         return
@@ -496,189 +2363,1825 @@ async def cmd_setmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT catalog_product_id FROM tracked_items WHERE item_id=?", (item_id,))
+    cur.execute("SELECT catalog_product_id FROM tracked_items WHERE item_id=? AND chat_id=?", (item_id, tenant))
     row = cur.fetchone()
     if not row:
-        conn.close()
-        await tg_reply(update, "Não encontrei esse item no monitoramento.")
+        if is_subscriber(conn, tenant, item_id):
+            await tg_reply(update, "Esse item é de outro chat: só o dono muda o modo.")
+        else:
+            await tg_reply(update, "Não encontrei esse item no monitoramento.")
         return
 
     if mode == "catalog" and not row["catalog_product_id"]:
-        conn.close()
         await tg_reply(update, "⚠️ Esse item não tem catalog_product_id. Use listing ou remova e adicione outro item.")
         return
 
-    cur.execute("UPDATE tracked_items SET mode=?, updated_at=? WHERE item_id=?",
-                (mode, int(time.time()), item_id))
+    now = int(time.time())
+    cur.execute("UPDATE tracked_items SET mode=?, updated_at=?, next_check_at=?, changed_at=? WHERE item_id=?",
+                (mode, now, now, now, item_id))
     conn.commit()
-    conn.close()
+    STORE.update(item_id, mode=mode, updated_at=now, next_check_at=now)
     await tg_reply(update, "✅ Modo atualizado.")
 
 
-# =========================
-# Monitor loop
-# =========================
-async def run_check(app):
+async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await require_tenant(update) is None:
+        return
+    conn = db()
+    m = monitor_metrics(conn)  # com workers: soma dos snapshots deles
+    last_s = m.gauge("cycle_last_seconds")
+    last = f"{last_s:.1f}s, {m.gauge('cycle_last_items'):.0f} itens" if m.gauge("cycles_finished") else "—"
+    failing = conn.execute("SELECT COUNT(*) FROM tracked_items WHERE fail_count > 0").fetchone()[0]
+    open_breakers = [name for name in ML_BREAKERS if m.gauge("ml_circuit_open", endpoint=name)]
+    await tg_reply(
+        update,
+        "⏱️ Ciclos do monitor:\n"
+        f"Rodando agora: {'sim' if m.gauge('cycles_running') else 'não'}\n"
+        f"Iniciados: {m.gauge('cycles_started'):.0f} | Finalizados: {m.gauge('cycles_finished'):.0f}\n"
+        f"Pulados (ciclo anterior ainda rodando): {m.gauge('cycles_skipped'):.0f}\n"
+        f"Estouros de orçamento ({CYCLE_BUDGET_SECONDS:.0f}s): {m.gauge('cycles_overruns'):.0f}\n"
+        f"Último ciclo: {last}\n"
+        f"Itens vencidos na fila: {m.gauge('scheduler_overdue_items'):.0f}\n"
+        f"Itens recusados pelo ML (em backoff): {failing}\n"
+        f"Circuito do ML aberto: {', '.join(open_breakers) or 'não'}"
+        + (f"\nWorkers vivos: {live_workers()} (partições: {SHARD_PARTITIONS})" if MONITOR_WORKERS else "")
+    )
+
+
+def _fmt_seconds(v: Optional[float]) -> str:
+    if v is None:
+        return "—"
+    return ">30s" if v == float("inf") else f"≤{v:g}s"
+
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await require_tenant(update) is None:
+        return
+    m = monitor_metrics(db())  # com workers: bot + último snapshot de cada worker vivo
+    lines = [f"📊 Stats do bot + {live_workers()} workers" if MONITOR_WORKERS else "📊 Stats do processo"]
+
+    for endpoint in ("items", "search", "oauth"):
+        hist = m.histograms.get(("ml_request_seconds", (("endpoint", endpoint),)))
+        total = m.counter("ml_responses_total", endpoint=endpoint)
+        if not total:
+            continue
+        ok = m.counter("ml_responses_total", endpoint=endpoint, status=200)
+        lines.append(
+            f"\nML /{endpoint}: {total:.0f} req | erro {100 * (total - ok) / total:.1f}%\n"
+            f"  p50 {_fmt_seconds(hist.quantile(0.5) if hist else None)}"
+            f" | p95 {_fmt_seconds(hist.quantile(0.95) if hist else None)}"
+            f" | retries {m.counter('ml_retries_total', endpoint=endpoint):.0f}"
+            f" | 429 {m.counter('ml_responses_total', endpoint=endpoint, status=429):.0f}"
+        )
+
+    for endpoint in ("items", "search"):
+        lookups = m.counter("ml_cache_total", endpoint=endpoint)
+        if not lookups:
+            continue
+        saved = lookups - m.counter("ml_cache_total", endpoint=endpoint, result="miss")
+        lines.append(
+            f"\nCache /{endpoint} (TTL {ML_CACHE.ttl(endpoint):g}s): {100 * saved / lookups:.1f}% sem download | "
+            f"hit {m.counter('ml_cache_total', endpoint=endpoint, result='hit'):.0f}"
+            f" | 304 {m.counter('ml_cache_total', endpoint=endpoint, result='revalidated'):.0f}"
+            f" | espera {m.counter('ml_cache_total', endpoint=endpoint, result='coalesced'):.0f}"
+            f" | miss {m.counter('ml_cache_total', endpoint=endpoint, result='miss'):.0f}"
+        )
+    if m.gauge("ml_cache_entries"):
+        lines.append(f"  {m.gauge('ml_cache_entries'):.0f} respostas, {m.gauge('ml_cache_bytes') / 1024:.0f} KB"
+                     f" de {ML_CACHE.max_bytes / 1024:.0f} KB{' por processo' if MONITOR_WORKERS else ''}")
+
+    lines.append(
+        f"\nToken refresh: {m.counter('ml_token_refresh_total', result='ok'):.0f} ok, "
+        f"{m.counter('ml_token_refresh_total', result='error'):.0f} falhas"
+    )
+
+    cycle = m.histograms.get(("cycle_seconds", ()))
+    lines.append(
+        f"\nCiclos: {m.gauge('cycles_finished'):.0f} (pulados {m.gauge('cycles_skipped'):.0f}, "
+        f"estouros {m.gauge('cycles_overruns'):.0f})\n"
+        f"  último {m.gauge('cycle_last_seconds'):.1f}s, {m.gauge('cycle_last_items'):.0f} itens, "
+        f"{m.gauge('cycle_items_per_second'):.1f} itens/s\n"
+        f"  p50 {_fmt_seconds(cycle.quantile(0.5) if cycle else None)}"
+        f" | p95 {_fmt_seconds(cycle.quantile(0.95) if cycle else None)}\n"
+        f"  itens vencidos: {m.gauge('scheduler_overdue_items'):.0f}"
+    )
+
+    send = m.histograms.get(("alert_send_seconds", ()))
+    lines.append(
+        f"\nAlertas: {m.counter('alerts_sent_total', result='ok'):.0f} enviados, "
+        f"fila {m.gauge('alerts_queue_size'):.0f}, p95 envio {_fmt_seconds(send.quantile(0.95) if send else None)}"
+    )
+    await tg_reply(update, "\n".join(lines))
+
+
+async def cmd_setpoll(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    if len(context.args) < 2:
+        await tg_reply(update, "Uso: /setpoll <MLB...> <max_segundos>")
+        return
+    item_id = extract_item_id(context.args[0])
+    if not item_id:
+        await tg_reply(update, "ITEM_ID inválido.")
+        return
+    try:
+        max_interval = int(context.args[1])
+    except:
+        await tg_reply(update, "Valor inválido.")
+        return
+    if max_interval < POLL_MIN_SECONDS:
+        await tg_reply(update, f"O mínimo é {POLL_MIN_SECONDS}s.")
+        return
+
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM tracked_items")
-    rows = cur.fetchall()
+    now = int(time.time())
+    cur.execute("""
+        UPDATE tracked_items
+        SET max_poll_interval=?, poll_interval=MIN(COALESCE(poll_interval, ?), ?), updated_at=?, changed_at=?
+        WHERE item_id=? AND chat_id=?
+    """, (max_interval, CHECK_INTERVAL_SECONDS, max_interval, now, now, item_id, tenant))
+    conn.commit()
+    changes = cur.rowcount
+    rec = STORE.get(item_id)
+    if changes and rec is not None:
+        STORE.update(item_id, max_poll_interval=max_interval, updated_at=now,
+                     poll_interval=min(rec.poll_interval or CHECK_INTERVAL_SECONDS, max_interval))
 
-    for r in rows:
-        item_id = r["item_id"]
-        my_price = float(r["my_price"])
-        undercut = float(r["undercut_reais"])
-        mode = (r["mode"] or "listing").lower()
-        last_state = r["last_state"] or "OK"
-        last_alert_price = r["last_alert_price"]
-        my_seller_id = r["my_seller_id"]
-        catalog_product_id = r["catalog_product_id"]
+    if not changes and is_subscriber(conn, tenant, item_id):
+        await tg_reply(update, "Esse item é de outro chat: só o dono muda o intervalo.")
+        return
+    await tg_reply(update, "✅ Atualizado." if changes else "Não encontrei esse item no monitoramento.")
 
-        now = int(time.time())
 
-        title = None
-        competitor_price = None
-        competitor_item_id = None
-        competitor_seller_id = None
+async def cmd_watchseller(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # sellers vigiados valem pro deployment inteiro (alerta vai pro dono de cada item): só o admin mexe
+    if await require_tenant(update, admin=True) is None:
+        return
+    conn = db()
+    if not context.args:
+        rows = conn.execute("SELECT * FROM watched_sellers ORDER BY added_at").fetchall()
+        if not rows:
+            await tg_reply(update, "Nenhum seller vigiado. Uso: /watchseller <seller_id> [apelido]")
+            return
+        lines = ["👀 Sellers vigiados:"]
+        for r in rows:
+            scan = time.strftime("%d/%m %H:%M", time.localtime(r["last_scan_at"])) if r["last_scan_at"] else "—"
+            lines.append(f"{r['seller_id']} {r['nickname'] or ''} | {r['items_seen'] or 0} anúncios | varrido {scan}")
+        await tg_reply(update, "\n".join(lines))
+        return
+
+    try:
+        seller_id = int(context.args[0])
+    except ValueError:
+        await tg_reply(update, "seller_id inválido (número). Ex: /watchseller 123456789 rival")
+        return
+    nickname = " ".join(context.args[1:]).strip() or None
+    now = int(time.time())
+    conn.execute("""
+        INSERT INTO watched_sellers (seller_id, nickname, added_at, next_scan_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(seller_id) DO UPDATE SET nickname=COALESCE(excluded.nickname, nickname), next_scan_at=excluded.next_scan_at
+    """, (seller_id, nickname, now, now))
+    conn.commit()
+    await tg_reply(
+        update,
+        f"✅ Vigiando seller {seller_id}{f' ({nickname})' if nickname else ''}.\n"
+        f"O inventário dele é varrido a cada {SELLER_SCAN_INTERVAL_SECONDS}s e comparado com seus itens "
+        "(mesmo catalog_product_id ou o próprio anúncio)."
+    )
+
+
+async def cmd_unwatchseller(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await require_tenant(update, admin=True) is None:
+        return
+    try:
+        seller_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await tg_reply(update, "Uso: /unwatchseller <seller_id>")
+        return
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM watched_sellers WHERE seller_id=?", (seller_id,))
+    changes = cur.rowcount
+    cur.execute("DELETE FROM seller_alerts WHERE seller_id=?", (seller_id,))
+    conn.commit()
+    await tg_reply(update, "✅ Removido." if changes else "Esse seller não estava sendo vigiado.")
+
+
+async def cmd_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /tenant                      -> dados do próprio chat
+    /tenant undercut <reais>     -> margem padrão do /add e /import deste chat
+    /tenant add <chat_id> [nome] -> (admin) cadastra um chat
+    /tenant remove <chat_id>     -> (admin) descadastra e tira os itens dele
+    /tenant list                 -> (admin) chats cadastrados
+    """
+    args = context.args or []
+    sub = args[0].lower() if args else ""
+    conn = db()
+    now = int(time.time())
 
-        if mode == "listing":
-            title, price, seller_id, _cat = ml_get_item(item_id)
+    if sub in ("add", "remove", "list"):
+        if await require_tenant(update, admin=True) is None:
+            return
+        if sub == "list":
+            rows = conn.execute("""
+                SELECT c.chat_id, c.name,
+                       (SELECT COUNT(*) FROM tracked_items t WHERE t.chat_id = c.chat_id) AS owned,
+                       (SELECT COUNT(*) FROM tenant_items s WHERE s.chat_id = c.chat_id) AS shared
+                FROM tenants c ORDER BY c.created_at
+            """).fetchall()
+            if not rows:
+                await tg_reply(update, "Nenhum chat cadastrado além do admin. Uso: /tenant add <chat_id> [nome]")
+                return
+            lines = ["👥 Chats cadastrados:"]
+            lines += [f"{r['chat_id']} {r['name'] or ''} | {r['owned']} itens + {r['shared']} compartilhados" for r in rows]
+            await tg_reply(update, "\n".join(lines))
+            return
+        if len(args) < 2:
+            await tg_reply(update, f"Uso: /tenant {sub} <chat_id>" + (" [nome]" if sub == "add" else ""))
+            return
+        chat_id = args[1].strip()
+        if sub == "add":
+            name = " ".join(args[2:]).strip() or None
+            conn.execute("""
+                INSERT INTO tenants (chat_id, name, created_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET name=COALESCE(excluded.name, name)
+            """, (chat_id, name, now))
+            conn.commit()
+            await tg_reply(update, f"✅ Chat {chat_id} cadastrado.")
+            return
+        if chat_id == CHAT_ID:
+            await tg_reply(update, "O chat admin não pode ser removido.")
+            return
+        cur = conn.cursor()
+        item_ids = [r["item_id"] for r in cur.execute(
+            "SELECT item_id FROM tracked_items WHERE chat_id=? UNION SELECT item_id FROM tenant_items WHERE chat_id=?",
+            (chat_id, chat_id)).fetchall()]
+        for item_id in item_ids:
+            untrack_item(cur, chat_id, item_id)
+        cur.execute("DELETE FROM price_rules WHERE chat_id=?", (chat_id,))
+        cur.execute("DELETE FROM tenants WHERE chat_id=?", (chat_id,))
+        removed = cur.rowcount
+        conn.commit()
+        await tg_reply(update, f"✅ Chat {chat_id} removido ({len(item_ids)} itens)." if removed or item_ids
+                       else "Esse chat não estava cadastrado.")
+        return
+
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    if sub == "undercut":
+        try:
+            undercut = float(str(args[1]).replace(",", "."))
+        except (IndexError, ValueError):
+            await tg_reply(update, "Uso: /tenant undercut <reais>")
+            return
+        conn.execute("""
+            INSERT INTO tenants (chat_id, default_undercut, created_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET default_undercut=excluded.default_undercut
+        """, (tenant, undercut, now))
+        conn.commit()
+        await tg_reply(update, f"✅ Margem padrão: {fmt_price(undercut)} (vale pros próximos /add e /import).")
+        return
+
+    row = conn.execute("SELECT name FROM tenants WHERE chat_id=?", (tenant,)).fetchone()
+    owned = conn.execute("SELECT COUNT(*) FROM tracked_items WHERE chat_id=?", (tenant,)).fetchone()[0]
+    shared = conn.execute("SELECT COUNT(*) FROM tenant_items WHERE chat_id=?", (tenant,)).fetchone()[0]
+    await tg_reply(
+        update,
+        f"👤 Chat {tenant or '—'}{f' ({row[0]})' if row and row[0] else ''}"
+        f"{' — admin' if tenant == CHAT_ID else ''}\n"
+        f"Itens: {owned} seus + {shared} compartilhados com outros chats\n"
+        f"Margem padrão: {fmt_price(tenant_default_undercut(tenant))}"
+    )
+
+
+async def cmd_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /rule -> lista; /rule <MLB...|*> <chave=valor...> grava; /rule <MLB...|*> off apaga
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    args = context.args or []
+    conn = db()
+    if not args:
+        rows = conn.execute("SELECT item_id, spec FROM price_rules WHERE chat_id=? ORDER BY item_id != '*', item_id",
+                            (tenant,)).fetchall()
+        if not rows:
+            await tg_reply(update, "Nenhuma regra. Ex: /rule * margem=5% histerese=0.50 | /rule MLB123 piso=90 ignorar=123")
+            return
+        lines = ["📐 Regras (a do item completa/sobrescreve a padrão *):"]
+        lines += [f"{r['item_id']}: {r['spec']}" for r in rows]
+        await tg_reply(update, "\n".join(lines))
+        return
+
+    target = "*" if args[0] == "*" else extract_item_id(args[0])
+    if not target:
+        await tg_reply(update, "Uso: /rule <MLB...|*> margem=5% piso=90 teto=150 ignorar=123,456 histerese=0.50")
+        return
+    spec = " ".join(args[1:]).strip()
+    if not spec:
+        row = conn.execute("SELECT spec FROM price_rules WHERE chat_id=? AND item_id=?", (tenant, target)).fetchone()
+        RULES.refresh(conn)  # com workers o bot não roda ciclo: o cache de regras só enche aqui
+        effective = RULES.rule_for(tenant, target) if target != "*" else compile_rule(row["spec"] if row else "")
+        await tg_reply(update, f"{target}: {row['spec'] if row else '(sem regra própria)'}\nEfetiva: {effective.describe()}")
+        return
+
+    if spec.lower() == "off":
+        conn.execute("DELETE FROM price_rules WHERE chat_id=? AND item_id=?", (tenant, target))
+        text = "✅ Regra removida."
+    else:
+        try:
+            rule = compile_rule(spec)
+        except ValueError as e:
+            await tg_reply(update, f"Regra inválida: {e}")
+            return
+        conn.execute("""
+            INSERT INTO price_rules (chat_id, item_id, spec, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, item_id) DO UPDATE SET spec=excluded.spec, updated_at=excluded.updated_at
+        """, (tenant, target, spec, time.time()))
+        text = f"✅ Regra gravada: {rule.describe()}"
+    # reavalia já: o item (ou todos do chat, pra regra *) volta pra fila agora
+    now = int(time.time())
+    if target == "*":
+        ids = [r["item_id"] for r in conn.execute(
+            "SELECT item_id FROM tracked_items WHERE chat_id=? UNION SELECT item_id FROM tenant_items WHERE chat_id=?",
+            (tenant, tenant))]
+    else:
+        ids = [target]
+    for chunk in chunked(ids, 500):
+        conn.execute(f"UPDATE tracked_items SET next_check_at=? WHERE item_id IN ({','.join('?' * len(chunk))})",
+                     (now, *chunk))
+    conn.commit()
+    RULES.refresh(conn, force=True)
+    for item_id in ids:
+        STORE.update(item_id, next_check_at=now)
+    await tg_reply(update, text)
+
+
+# =========================
+# Bulk import / export
+# =========================
+EXPORT_COLUMNS = ["item", "my_price", "undercut", "mode", "title", "catalog_product_id", "last_seen_price", "last_state"]
+
+
+def _num(v: Any) -> float:
+    n = float(str(v).strip().replace(",", "."))
+    if not math.isfinite(n):
+        raise ValueError(f"número inválido: {v}")
+    return n
+
+
+def parse_import(raw: str) -> List[Dict[str, Any]]:
+    """
+    Lê o documento do /import: JSON (lista de objetos) ou CSV com cabeçalho
+    (item, my_price, undercut, mode; separador , ; ou tab).
+    """
+    raw = raw.lstrip("\ufeff").strip()
+    if raw.startswith("[") or raw.startswith("{"):
+        data = json.loads(raw)
+        return data if isinstance(data, list) else [data]
+    try:
+        dialect = csv.Sniffer().sniff(raw.splitlines()[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return [{(k or "").strip().lower(): v for k, v in row.items()} for row in csv.DictReader(io.StringIO(raw), dialect=dialect)]
+
+
+def validate_import_row(
+    row: Dict[str, Any]
+) -> Tuple[Optional[Tuple[str, float, Optional[float], str]], Optional[str]]:
+    # (item_id, my_price, undercut, mode) ou mensagem de erro; undercut None = padrão do chat
+    if not isinstance(row, dict):
+        return None, "linha não é um objeto (use {\"item\": ..., \"my_price\": ...})"
+    item_id = extract_item_id(str(row.get("item") or row.get("item_id") or row.get("link") or ""))
+    if not item_id:
+        return None, "ITEM_ID inválido"
+    try:
+        my_price = _num(row.get("my_price") if row.get("my_price") not in (None, "") else row.get("preco"))
+    except (TypeError, ValueError):
+        return None, "my_price inválido"
+    undercut = None
+    if row.get("undercut") not in (None, ""):
+        try:
+            undercut = _num(row["undercut"])
+        except ValueError:
+            return None, "undercut inválido"
+    mode = str(row.get("mode") or "listing").lower().strip()
+    if mode not in ("listing", "catalog"):
+        return None, "mode inválido (listing|catalog)"
+    return (item_id, my_price, undercut, mode), None
+
+
+async def import_items(rows: List[Dict[str, Any]], chat_id: str) -> Tuple[int, List[str]]:
+    """
+    Valida as linhas (formato + multiget no ML em paralelo) e faz upsert de todas as
+    válidas, em nome do chat, numa transação só. Devolve (importados, erros por linha).
+    """
+    errors: List[str] = []
+    parsed: Dict[str, Tuple[int, float, Optional[float], str]] = {}  # item_id -> (linha, my_price, undercut, mode)
+    for n, row in enumerate(rows, start=1):
+        ok, err = validate_import_row(row)
+        if err:
+            errors.append(f"linha {n}: {err}")
+            continue
+        item_id, my_price, undercut, mode = ok
+        parsed[item_id] = (n, my_price, undercut, mode)  # repetido: vale a última linha
+
+    sem = asyncio.Semaphore(ML_CONCURRENCY)
+    items: Dict[str, ItemInfo] = {}
+
+    async def fetch_batch(ids: List[str]):
+        try:
+            async with sem:
+                items.update(await ml_get_items(ids, fields=ITEM_FIELDS))
+        except Exception as e:
+            print(f"Erro no multiget do /import {ids[0]}..{ids[-1]}:", e)
+
+    await asyncio.gather(*(fetch_batch(b) for b in chunked(list(parsed), ML_MULTIGET_MAX)))
+
+    conn = db()
+    cur = conn.cursor()
+    imported = 0
+    default_undercut = tenant_default_undercut(chat_id)
+    done: List[str] = []
+    try:
+        for item_id, (n, my_price, undercut, mode) in parsed.items():
+            item = items.get(item_id, NO_ITEM)
+            title, price, seller_id, catalog_product_id = item.title, item.price, item.seller_id, item.catalog_product_id
             if price is None:
+                errors.append(f"linha {n}: {item_id} não encontrado / sem preço no ML")
                 continue
-            competitor_price = price
-            competitor_item_id = item_id
-            competitor_seller_id = seller_id
-
-        elif mode == "catalog":
-            base_title, _base_price, seller_id, cat_id = ml_get_item(item_id)
-            title = base_title or r["title"]
-            my_seller_id = seller_id or my_seller_id
-            catalog_product_id = cat_id or catalog_product_id
-
-            if not catalog_product_id:
-                cur.execute("""
-                    UPDATE tracked_items
-                    SET title=?, last_state=?, updated_at=?
-                    WHERE item_id=?
-                """, (title, "OK", now, item_id))
-                conn.commit()
-                time.sleep(1)
+            if mode == "catalog" and not catalog_product_id:
+                errors.append(f"linha {n}: {item_id} sem catalog_product_id (use listing)")
                 continue
+            track_item(cur, chat_id, item_id, title, my_price, default_undercut if undercut is None else undercut,
+                       mode, seller_id, catalog_product_id, price)
+            done.append(item_id)
+            imported += 1
+        conn.commit()
+    except sqlite3.Error as e:
+        # tudo ou nada: a conexão é compartilhada, então a transação aberta não pode sobrar
+        # pro próximo commit de outro lugar. A memória volta ao que ficou no banco.
+        conn.rollback()
+        for item_id in done:
+            STORE.remove(item_id)
+        for ids in chunked(done, 500):
+            STORE.load(conn, f"item_id IN ({','.join('?' * len(ids))})", tuple(ids))
+        print("Erro gravando o /import:", e)
+        return 0, [f"Erro gravando no banco, nada foi importado: {e}"]
+
+    errors.sort(key=lambda e: int(e.split(":")[0].split()[1]))
+    return imported, errors
+
+
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg:
+        return
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    document = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    text = msg.text or ""
+    if document:
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await tg_reply(update, f"Arquivo grande demais (máx {IMPORT_MAX_BYTES // 1024} KB).")
+            return
+        file = await context.bot.get_file(document.file_id)
+        raw = bytes(await file.download_as_bytearray()).decode("utf-8", "replace")
+    else:
+        raw = text.partition("\n")[2]  # CSV/JSON colado abaixo do /import
 
-            results = ml_search_by_catalog(catalog_product_id, limit=50)
+    if not raw.strip():
+        await tg_reply(
+            update,
+            "Uso: envie um CSV/JSON com legenda /import (ou responda o arquivo com /import).\n"
+            "Colunas: item, my_price, undercut, mode"
+        )
+        return
 
-            best = None
-            for it in results:
-                try:
-                    it_id = it.get("id")
-                    it_price = float(it.get("price"))
-                    it_seller = it.get("seller", {}).get("id")
-                    it_seller = int(it_seller) if it_seller is not None else None
-                except:
-                    continue
+    try:
+        rows = parse_import(raw)
+    except (ValueError, csv.Error) as e:
+        await tg_reply(update, f"Não consegui ler o arquivo: {e}")
+        return
 
-                if my_seller_id is not None and it_seller == my_seller_id:
-                    continue
+    imported, errors = await import_items(rows, tenant)
+    report = [f"📥 Import: {imported} ok, {len(errors)} com erro (de {len(rows)} linhas)"]
+    if errors:
+        report.append("\n".join(errors))
+    for chunk in split_message(report):
+        await tg_reply(update, chunk)
 
-                if best is None or it_price < best["price"]:
-                    best = {"id": it_id, "price": it_price, "seller_id": it_seller}
-
-            if not best:
-                cur.execute("""
-                    UPDATE tracked_items
-                    SET title=?, last_state=?, last_seen_price=?, updated_at=?
-                    WHERE item_id=?
-                """, (title, "OK", None, now, item_id))
-                conn.commit()
-                time.sleep(1)
-                continue
 
-            competitor_price = best["price"]
-            competitor_item_id = best["id"]
-            competitor_seller_id = best["seller_id"]
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await require_tenant(update)
+    if tenant is None:
+        return
+    # escreve direto do cursor pro arquivo temporário, sem carregar a tabela em memória
+    with tempfile.TemporaryFile() as f:
+        out = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_COLUMNS)
+        cur = db().execute(f"""
+            SELECT item_id, my_price, undercut_reais, mode, title, catalog_product_id, last_seen_price, last_state
+            FROM ({SQL_TENANT_ITEMS}) ORDER BY id
+        """, (tenant, tenant))
+        for r in cur:
+            writer.writerow(list(r))
+        cur.close()
+        out.flush()
+        f.seek(0)
+        await update.message.reply_document(document=f, filename=f"tracked_items_{time.strftime('%Y%m%d')}.csv")
+        out.detach()
 
-        else:
-            continue
 
-        undercut_now = should_alert(my_price, undercut, competitor_price)
-        state_now = "UNDERCUT" if undercut_now else "OK"
+# =========================
+# Scheduler (polling adaptativo)
+# =========================
+class PollScheduler:
+    """
+    Fila de prioridade (heap) com o próximo horário de checagem de cada item.
+    Reagendar não remove a entrada antiga do heap: ela é ignorada no pop
+    se não bater com self.due (invalidação preguiçosa).
+    """
 
-        # anti-spam
-        alert = False
-        if state_now == "UNDERCUT":
-            if last_state != "UNDERCUT":
-                alert = True
-            else:
-                if last_alert_price is None or abs(float(last_alert_price) - competitor_price) > 0.0001:
-                    alert = True
+    def __init__(self):
+        self.heap: List[Tuple[int, str]] = []
+        self.due: Dict[str, int] = {}
+        self.shards: Optional[Set[int]] = None  # None = todas (modo processo único)
 
-        if alert:
-            link = ml_item_link(competitor_item_id or item_id)
-            msg = (
-                "🔥 ALERTA (ML) — CONCORRENTE ABAIXO DO SEU PREÇO\n"
-                f"Produto base: {title or item_id}\n"
-                f"Modo: {mode}\n"
-                f"Seu preço: {fmt_price(my_price)}\n"
-                f"Concorrente: {fmt_price(competitor_price)}\n"
-                f"Margem: {fmt_price(undercut)}\n"
-                f"Item concorrente: {competitor_item_id}\n"
-                f"Seller concorrente: {competitor_seller_id}\n"
-                f"Link: {link}"
+    def owns(self, item_id: str) -> bool:
+        return self.shards is None or shard_of(item_id) in self.shards
+
+    def schedule(self, item_id: str, due_at: int) -> None:
+        if not self.owns(item_id):
+            return
+        self.due[item_id] = due_at
+        heapq.heappush(self.heap, (due_at, item_id))
+
+    def remove(self, item_id: str) -> None:
+        self.due.pop(item_id, None)
+
+    def pop_due(self, now: int, limit: Optional[int] = None) -> List[str]:
+        out: List[str] = []
+        while self.heap and self.heap[0][0] <= now and (limit is None or len(out) < limit):
+            due_at, item_id = heapq.heappop(self.heap)
+            if self.due.get(item_id) == due_at:
+                del self.due[item_id]
+                out.append(item_id)
+        return out
+
+    def has_due(self, now: int) -> bool:
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)  # entrada velha
+        return bool(self.heap) and self.heap[0][0] <= now
+
+    def overdue(self, now: int) -> int:
+        return sum(1 for d in self.due.values() if d <= now)
+
+
+SCHEDULER = PollScheduler()
+
+
+def next_poll_interval(current: Optional[int], max_interval: Optional[int], state: str, changed: bool) -> int:
+    ceiling = max(POLL_MIN_SECONDS, max_interval or POLL_MAX_SECONDS)
+    if state == "UNDERCUT" or changed:
+        return POLL_MIN_SECONDS
+    return int(min(ceiling, max(POLL_MIN_SECONDS, (current or CHECK_INTERVAL_SECONDS) * POLL_BACKOFF)))
+
+
+def item_retry_interval(fail_count: int) -> int:
+    # cache negativo: item recusado pelo ML volta a ser tentado com backoff exponencial
+    return int(min(ITEM_FAIL_BACKOFF_MAX, ITEM_FAIL_BACKOFF_BASE * 2 ** max(0, fail_count - 1)))
+
+
+# =========================
+# Tracked items em memória
+# =========================
+class TrackedItem:
+    """Uma linha de tracked_items, já com os tipos convertidos (carregada uma vez, não por ciclo)."""
+    __slots__ = (
+        "item_id", "title", "my_price", "undercut_reais", "mode", "my_seller_id", "catalog_product_id",
+        "last_seen_price", "last_alert_price", "last_state", "updated_at",
+        "poll_interval", "max_poll_interval", "next_check_at",
+        "fail_count", "fail_reason", "failing_since", "fail_notified", "pushed_at", "chat_id",
+    )
+
+    def __init__(self, item_id: str):
+        self.item_id = item_id
+        self.title = None
+        self.my_price = 0.0
+        self.undercut_reais = DEFAULT_UNDERCUT_REAIS
+        self.mode = "listing"
+        self.my_seller_id = None
+        self.catalog_product_id = None
+        self.last_seen_price = None
+        self.last_alert_price = None
+        self.last_state = "OK"
+        self.updated_at = None
+        self.poll_interval = None
+        self.max_poll_interval = None
+        self.next_check_at = None
+        self.fail_count = 0
+        self.fail_reason = None
+        self.failing_since = None
+        self.fail_notified = 0
+        self.pushed_at = None
+        self.chat_id = None
+
+
+class Subscription:
+    """Uma linha de tenant_items: preço/margem/estado de outro chat pro mesmo item."""
+    __slots__ = ("chat_id", "item_id", "my_price", "undercut_reais", "last_state", "last_alert_price", "updated_at")
+
+    def __init__(self, chat_id: str, item_id: str):
+        self.chat_id = chat_id
+        self.item_id = item_id
+        self.my_price = 0.0
+        self.undercut_reais = DEFAULT_UNDERCUT_REAIS
+        self.last_state = "OK"
+        self.last_alert_price = None
+        self.updated_at = None
+
+
+# colunas que só o monitor escreve: é o que o write-behind devolve pro banco
+STORE_WRITE_COLUMNS = (
+    "title", "my_seller_id", "catalog_product_id", "last_seen_price", "last_alert_price", "last_state",
+    "updated_at", "poll_interval", "next_check_at", "fail_count", "fail_reason", "failing_since", "fail_notified",
+)
+SUBSCRIPTION_WRITE_COLUMNS = ("last_state", "last_alert_price", "updated_at")
+
+
+class TrackedStore:
+    """
+    Cópia em memória das linhas de tracked_items deste processo (as partições dele,
+    com workers). Índices: item_id (records), catalog_product_id (by_catalog) e
+    próximo horário de checagem (o heap do SCHEDULER).
+
+    Comandos gravam no banco e atualizam a cópia na hora (update/upsert/remove).
+    O monitor só mexe na memória (set) e marca a linha como suja se algo mudou de
+    verdade; flush() grava só as sujas, no fim de cada lote. next_check_at vai junto
+    quando a linha é gravada: se o processo cair, o pior caso é checar antes da hora.
+    As assinaturas (tenant_items) ficam penduradas no item e seguem o mesmo esquema.
+    """
+
+    def __init__(self):
+        self.records: Dict[str, TrackedItem] = {}
+        self.by_catalog: Dict[str, Set[str]] = {}
+        self.dirty: Set[str] = set()
+        self.subs: Dict[str, Dict[str, Subscription]] = {}
+        self.dirty_subs: Set[Tuple[str, str]] = set()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, item_id: str) -> Optional[TrackedItem]:
+        return self.records.get(item_id)
+
+    def catalog_items(self, catalog_product_id: str) -> Set[str]:
+        return self.by_catalog.get(catalog_product_id, set())
+
+    def subscriptions(self, item_id: str) -> List[Subscription]:
+        return list(self.subs.get(item_id, {}).values())
+
+    def chats(self, rec: TrackedItem) -> List[str]:
+        # todo mundo que acompanha o item: dono primeiro, depois as assinaturas
+        return [rec.chat_id or CHAT_ID] + list(self.subs.get(rec.item_id, {}))
+
+    def _index_catalog(self, rec: TrackedItem, old: Optional[str]) -> None:
+        if old == rec.catalog_product_id:
+            return
+        if old and old in self.by_catalog:
+            self.by_catalog[old].discard(rec.item_id)
+            if not self.by_catalog[old]:
+                del self.by_catalog[old]
+        if rec.catalog_product_id:
+            self.by_catalog.setdefault(rec.catalog_product_id, set()).add(rec.item_id)
+
+    def _put_row(self, row, now: int) -> None:
+        rec = self.records.get(row["item_id"])
+        if rec is None:
+            rec = self.records[row["item_id"]] = TrackedItem(row["item_id"])
+        old_catalog = rec.catalog_product_id
+        for name in TrackedItem.__slots__[1:]:
+            setattr(rec, name, row[name])
+        rec.my_price = float(rec.my_price)
+        rec.undercut_reais = float(rec.undercut_reais)
+        rec.mode = (rec.mode or "listing").lower()
+        rec.last_state = rec.last_state or "OK"
+        rec.fail_count = rec.fail_count or 0
+        rec.fail_notified = rec.fail_notified or 0
+        self._index_catalog(rec, old_catalog)
+        SCHEDULER.schedule(rec.item_id, rec.next_check_at or now)
+
+    def load(self, conn, where: str = "", params: Tuple[Any, ...] = ()) -> int:
+        # (re)carrega do banco as linhas deste processo; sem where = tudo
+        now = int(time.time())
+        cols = ", ".join(TrackedItem.__slots__)
+        if not where:
+            self.records, self.by_catalog, self.dirty = {}, {}, set()
+            self.subs, self.dirty_subs = {}, set()
+            SCHEDULER.heap, SCHEDULER.due = [], {}
+        loaded: Set[str] = set()
+        for row in conn.execute(f"SELECT {cols} FROM tracked_items" + (f" WHERE {where}" if where else ""), params):
+            if SCHEDULER.owns(row["item_id"]):
+                self._put_row(row, now)
+                loaded.add(row["item_id"])
+        # assinaturas dos itens recarregados são trocadas inteiras (some a que foi removida)
+        for item_id in loaded:
+            self.subs.pop(item_id, None)
+        sub_cols = ", ".join(Subscription.__slots__)
+        sql = f"SELECT {sub_cols} FROM tenant_items"
+        if where:
+            sql += f" WHERE item_id IN (SELECT item_id FROM tracked_items WHERE {where})"
+        for row in conn.execute(sql, params):
+            if row["item_id"] in loaded:
+                self._put_sub(row)
+        return len(loaded)
+
+    def _put_sub(self, row) -> None:
+        sub = Subscription(row["chat_id"], row["item_id"])
+        for name in Subscription.__slots__[2:]:
+            setattr(sub, name, row[name])
+        sub.my_price = float(sub.my_price)
+        sub.undercut_reais = float(sub.undercut_reais)
+        sub.last_state = sub.last_state or "OK"
+        self.subs.setdefault(sub.item_id, {})[sub.chat_id] = sub
+
+    def set_shards(self, conn, shards: Set[int]) -> None:
+        # troca o conjunto de partições: solta itens que saíram, carrega os que entraram
+        gained = shards - (SCHEDULER.shards or set())
+        SCHEDULER.shards = set(shards)
+        for item_id in [i for i in self.records if not SCHEDULER.owns(i)]:
+            self.remove(item_id)
+        if gained:
+            self.load(conn, f"shard_of(item_id) IN ({','.join('?' * len(gained))})", tuple(gained))
+
+    def update(self, item_id: str, **fields: Any) -> bool:
+        # espelha na memória o que um comando já gravou no banco (não suja a linha)
+        rec = self.records.get(item_id)
+        if rec is None:
+            return False
+        old_catalog = rec.catalog_product_id
+        for name, value in fields.items():
+            setattr(rec, name, value)
+        self._index_catalog(rec, old_catalog)
+        if "next_check_at" in fields:
+            SCHEDULER.schedule(item_id, fields["next_check_at"])
+        return True
+
+    def upsert(self, item_id: str, **fields: Any) -> None:
+        if not SCHEDULER.owns(item_id):
+            return
+        if item_id not in self.records:
+            self.records[item_id] = TrackedItem(item_id)
+        self.update(item_id, **fields)
+
+    def remove(self, item_id: str) -> None:
+        rec = self.records.pop(item_id, None)
+        if rec is not None and rec.catalog_product_id in self.by_catalog:
+            self.by_catalog[rec.catalog_product_id].discard(item_id)
+            if not self.by_catalog[rec.catalog_product_id]:
+                del self.by_catalog[rec.catalog_product_id]
+        self.dirty.discard(item_id)
+        for chat_id in self.subs.pop(item_id, {}):
+            self.dirty_subs.discard((item_id, chat_id))
+        SCHEDULER.remove(item_id)
+
+    def put_sub(self, item_id: str, chat_id: str, **fields: Any) -> None:
+        # espelha uma assinatura gravada por comando (cria se for nova)
+        if item_id not in self.records:
+            return
+        subs = self.subs.setdefault(item_id, {})
+        sub = subs.get(chat_id) or subs.setdefault(chat_id, Subscription(chat_id, item_id))
+        for name, value in fields.items():
+            setattr(sub, name, value)
+
+    def drop_sub(self, item_id: str, chat_id: str) -> None:
+        subs = self.subs.get(item_id)
+        if subs and subs.pop(chat_id, None) is not None and not subs:
+            del self.subs[item_id]
+        self.dirty_subs.discard((item_id, chat_id))
+
+    def set(self, rec: TrackedItem, **fields: Any) -> bool:
+        # resultado do monitor: muda a memória e marca pra gravar só se algo mudou
+        changed = False
+        old_catalog = rec.catalog_product_id
+        for name, value in fields.items():
+            if getattr(rec, name) != value:
+                setattr(rec, name, value)
+                changed = True
+        if changed:
+            self._index_catalog(rec, old_catalog)
+            self.dirty.add(rec.item_id)
+        return changed
+
+    def set_sub(self, sub: Subscription, **fields: Any) -> bool:
+        changed = False
+        for name, value in fields.items():
+            if getattr(sub, name) != value:
+                setattr(sub, name, value)
+                changed = True
+        if changed:
+            self.dirty_subs.add((sub.item_id, sub.chat_id))
+        return changed
+
+    def flush(self, cur) -> int:
+        rows = [rec for rec in (self.records.get(i) for i in self.dirty) if rec is not None]
+        self.dirty = set()
+        if rows:
+            cur.executemany(
+                f"UPDATE tracked_items SET {', '.join(c + '=?' for c in STORE_WRITE_COLUMNS)} WHERE item_id=?",
+                [tuple(getattr(rec, c) for c in STORE_WRITE_COLUMNS) + (rec.item_id,) for rec in rows],
             )
-            await tg_send(app, msg)
+        subs = [sub for sub in (self.subs.get(i, {}).get(c) for i, c in self.dirty_subs) if sub is not None]
+        self.dirty_subs = set()
+        if subs:
+            cur.executemany(
+                f"UPDATE tenant_items SET {', '.join(c + '=?' for c in SUBSCRIPTION_WRITE_COLUMNS)} "
+                "WHERE chat_id=? AND item_id=?",
+                [tuple(getattr(sub, c) for c in SUBSCRIPTION_WRITE_COLUMNS) + (sub.chat_id, sub.item_id) for sub in subs],
+            )
+        METRICS.inc("store_rows_written_total", len(rows) + len(subs))
+        return len(rows) + len(subs)
 
-            cur.execute("""
-                UPDATE tracked_items
-                SET title=?, my_seller_id=?, catalog_product_id=?,
-                    last_seen_price=?, last_alert_price=?, last_state=?, updated_at=?
-                WHERE item_id=?
-            """, (title, my_seller_id, catalog_product_id,
-                  competitor_price, competitor_price, state_now, now, item_id))
+
+STORE = TrackedStore()
+
+
+# =========================
+# Price history
+# =========================
+# (item_id, competitor_item_id, competitor_seller_id, price)
+Observation = Tuple[str, Optional[str], Optional[int], float]
+
+# último run gravado por item: item_id -> (competitor_item_id, price)
+_last_runs: Optional[Dict[str, Tuple[Optional[str], float]]] = None
+
+
+def reset_history_cache() -> None:
+    # outro worker pode ter gravado runs enquanto a partição não era nossa
+    global _last_runs
+    _last_runs = None
+
+
+def _load_last_runs(cur) -> Dict[str, Tuple[Optional[str], float]]:
+    cur.execute("""
+        SELECT item_id, competitor_item_id, price FROM price_observations
+        WHERE id IN (SELECT MAX(id) FROM price_observations GROUP BY item_id)
+    """)
+    return {r["item_id"]: (r["competitor_item_id"], r["price"]) for r in cur.fetchall()}
+
+
+def record_observations(cur, observations: List[Observation], now: int) -> None:
+    """
+    Grava as observações do lote de uma vez. Preço (e concorrente) igual ao do último
+    run só estende last_seen_at; mudança abre um run novo.
+    """
+    global _last_runs
+    if not observations:
+        return
+    if _last_runs is None:
+        _last_runs = _load_last_runs(cur)
+
+    new_runs, extended = [], []
+    for item_id, comp_item_id, comp_seller_id, price in observations:
+        last = _last_runs.get(item_id)
+        if last is not None and last[0] == comp_item_id and abs(last[1] - price) <= 0.0001:
+            extended.append((now, item_id))
         else:
+            new_runs.append((item_id, comp_item_id, comp_seller_id, price, now, now))
+            _last_runs[item_id] = (comp_item_id, price)
+
+    if extended:
+        cur.executemany("""
+            UPDATE price_observations SET last_seen_at=?
+            WHERE id=(SELECT MAX(id) FROM price_observations WHERE item_id=?)
+        """, extended)
+    if new_runs:
+        cur.executemany("""
+            INSERT INTO price_observations (
+                item_id, competitor_item_id, competitor_seller_id, price, first_seen_at, last_seen_at
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """, new_runs)
+
+
+def _rollup(cur, source_sql: str, granularity: str, bucket_seconds: int, params: tuple) -> None:
+    # agrega (item_id, ts, min, max, samples) de source_sql em price_rollups, somando no bucket existente
+    cur.execute(f"""
+        INSERT INTO price_rollups (item_id, granularity, bucket_start, min_price, max_price, samples)
+        SELECT item_id, ?, (ts / {bucket_seconds}) * {bucket_seconds}, MIN(lo), MAX(hi), SUM(n)
+        FROM ({source_sql}) WHERE 1
+        GROUP BY item_id, (ts / {bucket_seconds})
+        ON CONFLICT(item_id, granularity, bucket_start) DO UPDATE SET
+            min_price=MIN(min_price, excluded.min_price),
+            max_price=MAX(max_price, excluded.max_price),
+            samples=samples + excluded.samples
+    """, (granularity,) + params)
+
+
+def history_retention(now: Optional[int] = None) -> None:
+    """
+    Bruto mais velho que HISTORY_RAW_DAYS vira min/max por hora; horário mais velho que
+    HISTORY_HOURLY_DAYS vira min/max por dia. O run mais recente de cada item nunca é
+    reduzido (ainda pode ser estendido pelo monitor).
+    """
+    now = now or int(time.time())
+    conn = db()
+    cur = conn.cursor()
+
+    raw_cutoff = now - HISTORY_RAW_DAYS * 86400
+    latest = "SELECT MAX(id) FROM price_observations GROUP BY item_id"
+    # um run cobre todas as horas entre first_seen_at e last_seen_at, não só a primeira
+    _rollup(cur, f"""
+        WITH RECURSIVE hours(item_id, ts, until, price) AS (
+            SELECT item_id, (first_seen_at / 3600) * 3600, last_seen_at, price
+            FROM price_observations WHERE last_seen_at < ? AND id NOT IN ({latest})
+            UNION ALL
+            SELECT item_id, ts + 3600, until, price FROM hours WHERE ts + 3600 <= until
+        )
+        SELECT item_id, ts, price AS lo, price AS hi, 1 AS n FROM hours
+    """, "hour", 3600, (raw_cutoff,))
+    cur.execute(f"DELETE FROM price_observations WHERE last_seen_at < ? AND id NOT IN ({latest})", (raw_cutoff,))
+    raw_removed = cur.rowcount
+
+    hourly_cutoff = now - HISTORY_HOURLY_DAYS * 86400
+    _rollup(cur, """
+        SELECT item_id, bucket_start AS ts, min_price AS lo, max_price AS hi, samples AS n
+        FROM price_rollups WHERE granularity='hour' AND bucket_start < ?
+    """, "day", 86400, (hourly_cutoff,))
+    cur.execute("DELETE FROM price_rollups WHERE granularity='hour' AND bucket_start < ?", (hourly_cutoff,))
+    hourly_removed = cur.rowcount
+
+    if HISTORY_DAILY_DAYS > 0:
+        cur.execute("DELETE FROM price_rollups WHERE granularity='day' AND bucket_start < ?",
+                    (now - HISTORY_DAILY_DAYS * 86400,))
+    # lápides do /remove só precisam durar até todo worker sincronizar
+    cur.execute("DELETE FROM removed_items WHERE removed_at < ?", (now - 86400,))
+
+    conn.commit()
+    if raw_removed or hourly_removed:
+        print(f"Histórico: {raw_removed} runs -> horário, {hourly_removed} horas -> diário")
+
+
+async def history_retention_job(context) -> None:
+    history_retention()
+
+
+# =========================
+# Sharding (workers do monitor)
+# =========================
+def shard_of(item_id: str) -> int:
+    # crc32 é estável entre processos (hash() do Python não é)
+    return zlib.crc32(item_id.encode("utf-8")) % SHARD_PARTITIONS
+
+
+class ShardLease:
+    """
+    Lease das partições deste worker na tabela shard_leases.
+    A cada heartbeat: renova os leases, solta o excesso acima da cota justa
+    (partições / workers vivos) e pega partições livres ou expiradas até a cota.
+    Worker que morre para de renovar e suas partições expiram em LEASE_TTL_SECONDS.
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.shards: Set[int] = set()
+        self.last_sync = 0
+
+    def heartbeat(self, conn) -> Set[int]:
+        now = time.time()
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO monitor_workers (worker_id, started_at, heartbeat_at) VALUES (?, ?, ?)
+            ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at=excluded.heartbeat_at
+        """, (self.worker_id, now, now))
+        cur.execute("DELETE FROM monitor_workers WHERE heartbeat_at < ?", (now - 3 * LEASE_TTL_SECONDS,))
+        live = cur.execute("SELECT COUNT(*) FROM monitor_workers WHERE heartbeat_at >= ?",
+                           (now - LEASE_TTL_SECONDS,)).fetchone()[0]
+        fair = -(-SHARD_PARTITIONS // max(1, live))
+
+        expires = now + LEASE_TTL_SECONDS
+        cur.execute("UPDATE shard_leases SET expires_at=? WHERE owner=?", (expires, self.worker_id))
+        owned = [r[0] for r in cur.execute("SELECT shard FROM shard_leases WHERE owner=? ORDER BY shard",
+                                           (self.worker_id,))]
+        if len(owned) > fair:
+            extra = owned[fair:]
+            cur.execute(f"UPDATE shard_leases SET owner=NULL, expires_at=0 WHERE owner=? AND shard IN "
+                        f"({','.join('?' * len(extra))})", [self.worker_id] + extra)
+        elif len(owned) < fair:
+            # um UPDATE só: atômico no SQLite, dois workers nunca pegam a mesma partição
             cur.execute("""
-                UPDATE tracked_items
-                SET title=?, my_seller_id=?, catalog_product_id=?,
-                    last_seen_price=?, last_state=?, updated_at=?
-                WHERE item_id=?
-            """, (title, my_seller_id, catalog_product_id,
-                  competitor_price, state_now, now, item_id))
+                UPDATE shard_leases SET owner=?, expires_at=?
+                WHERE shard IN (
+                    SELECT shard FROM shard_leases WHERE owner IS NULL OR expires_at < ?
+                    ORDER BY shard LIMIT ?
+                )
+            """, (self.worker_id, expires, now, fair - len(owned)))
+        conn.commit()
+
+        self.shards = {r[0] for r in cur.execute("SELECT shard FROM shard_leases WHERE owner=?", (self.worker_id,))}
+        return self.shards
+
+    def sync_changes(self, conn) -> None:
+        # itens adicionados/alterados/removidos por comandos no processo do bot desde o último sync
+        now = int(time.time())
+        for r in conn.execute("SELECT item_id FROM removed_items WHERE removed_at >= ?", (self.last_sync,)):
+            STORE.remove(r["item_id"])
+        # notificação do webhook (recebida no bot): o cache deste processo também não vale mais
+        pushed = conn.execute(
+            "SELECT item_id, catalog_product_id FROM tracked_items WHERE changed_at >= ? AND pushed_at >= ?",
+            (self.last_sync, self.last_sync),
+        ).fetchall()
+        if pushed:
+            ML_CACHE.invalidate([r["item_id"] for r in pushed]
+                                + list({r["catalog_product_id"] for r in pushed if r["catalog_product_id"]}))
+        STORE.load(conn, "changed_at >= ?", (self.last_sync,))
+        self.last_sync = now
+
+    def publish_metrics(self, conn) -> None:
+        # o /stats roda no processo do bot, que não faz ciclo: ele lê este snapshot
+        refresh_gauges()
+        conn.execute("UPDATE monitor_workers SET metrics=? WHERE worker_id=?",
+                     (json.dumps(METRICS.snapshot()), self.worker_id))
+        conn.commit()
+
+    def release(self, conn) -> None:
+        conn.execute("UPDATE shard_leases SET owner=NULL, expires_at=0 WHERE owner=?", (self.worker_id,))
+        conn.execute("DELETE FROM monitor_workers WHERE worker_id=?", (self.worker_id,))
+        conn.commit()
+
+
+async def lease_loop(lease: ShardLease) -> None:
+    conn = db()
+    while True:
+        try:
+            before = SCHEDULER.shards
+            shards = lease.heartbeat(conn)
+            if shards != before:
+                STORE.set_shards(conn, shards)
+                reset_history_cache()
+                print(f"Worker {lease.worker_id}: {len(shards)} partições")
+            lease.sync_changes(conn)
+            lease.publish_metrics(conn)
+        except sqlite3.Error as e:
+            print("Erro no heartbeat do worker:", e)
+        await asyncio.sleep(LEASE_HEARTBEAT_SECONDS)
+
+
+async def worker_main() -> None:
+    from telegram import Bot
+
+    init_db()
+    SCHEDULER.shards = set()
+    lease = ShardLease(f"{socket.gethostname()}:{os.getpid()}")
+    bot = Bot(BOT_TOKEN)
+    app = SimpleNamespace(bot=bot)  # o worker só envia alertas, não faz polling
+    try:
+        # SIGTERM (stop do processo pai) cai no finally e devolve os leases na hora
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:  # Windows
+        pass
+    async with bot:
+        ALERTS.start(app)
+        start_token_refresh()
+        await start_metrics_server(METRICS_PORT)
+        lease_task = asyncio.create_task(lease_loop(lease))
+        try:
+            while True:
+                await CYCLES.tick(app)
+                await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+        finally:
+            lease_task.cancel()
+            stop_token_refresh()
+            lease.release(db())
+            await ALERTS.stop()
+            await ml_close_client()
+            db_close()
+
+
+def live_workers() -> int:
+    return db().execute("SELECT COUNT(*) FROM monitor_workers WHERE heartbeat_at >= ?",
+                        (time.time() - LEASE_TTL_SECONDS,)).fetchone()[0]
+
+
+def spawn_workers(n: int) -> List[subprocess.Popen]:
+    procs = []
+    for i in range(n):
+        env = dict(os.environ)
+        env["MONITOR_WORKERS"] = str(n)  # o worker divide as taxas pelo mesmo RATE_SHARES
+        if METRICS_PORT > 0:
+            env["METRICS_PORT"] = str(METRICS_PORT + 1 + i)  # cada worker na sua porta
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker"], env=env))
+    return procs
+
+
+# =========================
+# Webhook (notificações do ML)
+# =========================
+def ml_user_id() -> str:
+    # tokens do ML terminam no user_id da conta: APP_USR-...-149015608 / TG-...-149015608
+    if ML_USER_ID:
+        return ML_USER_ID
+    for token in (ML_ACCESS_TOKEN, ML_REFRESH_TOKEN):
+        tail = token.rsplit("-", 1)[-1]
+        if "-" in token and tail.isdigit():
+            return tail
+    return ""
+
+
+class NotificationReceiver:
+    """
+    Receptor das notificações do ML (POST no WEBHOOK_PATH, JSON com topic/resource).
+    Responde 200 na hora, junta os item_ids por WEBHOOK_DEBOUNCE_SECONDS (rajadas e
+    reenvios do mesmo item viram uma checagem só) e marca as linhas afetadas como
+    vencidas agora: o item notificado e as outras linhas do mesmo catalog_product_id.
+    Com workers, eles pegam a mudança pelo changed_at no próximo heartbeat.
+    """
+
+    def __init__(self):
+        self.pending: Set[str] = set()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.app = None
+
+    def accept(self, payload: Dict[str, Any]) -> str:
+        topic = payload.get("topic")
+        if topic not in WEBHOOK_TOPICS:
+            return "ignored"
+        # o receptor escuta em 0.0.0.0: sem application_id do nosso app (e user_id da conta,
+        # quando conhecido) qualquer um marcaria itens vencidos e limparia o cache à vontade
+        if not ML_APP_ID or str(payload.get("application_id") or "") != ML_APP_ID:
+            return "ignored"
+        user_id = ml_user_id()
+        if user_id and str(payload.get("user_id") or "") != user_id:
+            return "ignored"
+        item_id = extract_item_id(str(payload.get("resource") or ""))
+        if not item_id:
+            return "ignored"
+        if item_id in self.pending:
+            return "duplicate"
+        self.pending.add(item_id)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+        return "accepted"
+
+    async def _flush_later(self) -> None:
+        # accept() não agenda outro flush enquanto este vive: o que chegar durante o
+        # debounce ou o ciclo fica em pending e é tratado na próxima volta do laço
+        while self.pending:
+            await asyncio.sleep(WEBHOOK_DEBOUNCE_SECONDS)
+            item_ids, self.pending = sorted(self.pending), set()
+            try:
+                n = self.mark_due(item_ids)
+            except sqlite3.Error as e:
+                print("Erro marcando itens notificados:", e)
+                continue
+            METRICS.inc("webhook_rechecks_total", n)
+            if n and MONITOR_WORKERS == 0 and self.app is not None:
+                await CYCLES.tick(self.app)  # ciclo já rodando pega os itens vencidos sozinho
 
+    def mark_due(self, item_ids: List[str]) -> int:
+        if not item_ids:
+            return 0
+        now = int(time.time())
+        conn = db()
+        marks = ",".join("?" * len(item_ids))
+        affected = [r[0] for r in conn.execute(f"""
+            SELECT item_id FROM tracked_items
+            WHERE item_id IN ({marks})
+               OR catalog_product_id IN (
+                   SELECT catalog_product_id FROM tracked_items
+                   WHERE item_id IN ({marks}) AND catalog_product_id IS NOT NULL
+               )
+        """, item_ids + item_ids)]
+        if not affected:
+            return 0
+        # a notificação diz que mudou: nada de resposta em cache pra esses itens/catálogos
+        catalogs = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT catalog_product_id FROM tracked_items WHERE item_id IN ({marks}) "
+            f"AND catalog_product_id IS NOT NULL", item_ids)]
+        ML_CACHE.invalidate(item_ids + catalogs)
+        conn.execute(f"UPDATE tracked_items SET pushed_at=? WHERE item_id IN ({marks})", [now] + item_ids)
+        conn.executemany("UPDATE tracked_items SET next_check_at=?, changed_at=? WHERE item_id=?",
+                         [(now, now, item_id) for item_id in affected])
         conn.commit()
-        time.sleep(1)
+        for item_id in item_ids:
+            STORE.update(item_id, pushed_at=now)
+        for item_id in affected:
+            STORE.update(item_id, next_check_at=now)
+        return len(affected)
+
+    async def _http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            length = 0
+            while True:
+                h = await asyncio.wait_for(reader.readline(), timeout=5)
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = h.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip() or 0)
+            method, path = (request_line.decode("latin-1").split(" ") + ["", ""])[:2]
+            if method != "POST" or path.split("?")[0] != WEBHOOK_PATH:
+                status = "404 Not Found"
+            elif length > 64 * 1024:
+                status = "413 Payload Too Large"
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), timeout=5)
+                try:
+                    payload = json.loads(body or b"{}")
+                    payload = payload if isinstance(payload, dict) else {}
+                    result = self.accept(payload)
+                    METRICS.inc("webhook_notifications_total", topic=payload.get("topic"), result=result)
+                    status = "200 OK"
+                except ValueError:
+                    status = "400 Bad Request"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("ascii"))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, app, port: int) -> None:
+        self.app = app
+        if port <= 0 or self.server is not None:
+            return
+        self.server = await asyncio.start_server(self._http, WEBHOOK_HOST, port)
+        print(f"Webhook de notificações do ML em http://{WEBHOOK_HOST}:{port}{WEBHOOK_PATH}")
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+
 
-    conn.close()
+NOTIFICATIONS = NotificationReceiver()
+
+
+# =========================
+# Modo seller (inventário de concorrentes)
+# =========================
+class SellerIndex:
+    """Preços de uma varredura: por item_id e, por catalog_product_id, o anúncio mais barato."""
+    __slots__ = ("by_item", "by_catalog")
+
+    def __init__(self, listings: List[SellerListing]):
+        self.by_item: Dict[str, SellerListing] = {}
+        self.by_catalog: Dict[str, SellerListing] = {}
+        for listing in listings:
+            self.by_item[listing.id] = listing
+            cat = listing.catalog_product_id
+            if cat and (cat not in self.by_catalog or listing.price < self.by_catalog[cat].price):
+                self.by_catalog[cat] = listing
+
+    def match(self, item_id: str, catalog_product_id: Optional[str]) -> Optional[SellerListing]:
+        # o próprio anúncio (linha listing apontando pro rival) ou o mais barato do mesmo catálogo
+        return self.by_item.get(item_id) or (self.by_catalog.get(catalog_product_id) if catalog_product_id else None)
+
+
+def match_seller(conn, seller_id: int, nickname: Optional[str], index: SellerIndex) -> int:
+    """
+    Cruza a varredura com tracked_items (todas as linhas, não só as partições deste
+    processo) e enfileira alerta, no chat dono da linha, quando a regra do chat pro
+    item (RuleBatch) diz que o seller está abaixo do preço dele.
+    seller_alerts faz o papel de last_state/last_alert_price: mesmo preço não repete,
+    e quando o seller sai do undercut a linha é apagada pra alertar de novo depois.
+    """
+    rows: Dict[str, sqlite3.Row] = {}
+    cols = "item_id, title, my_price, undercut_reais, mode, my_seller_id, catalog_product_id, chat_id"
+    for ids in chunked(list(index.by_item), 500):
+        for r in conn.execute(f"SELECT {cols} FROM tracked_items WHERE item_id IN ({','.join('?' * len(ids))})", ids):
+            rows[r["item_id"]] = r
+    for cats in chunked(list(index.by_catalog), 500):
+        for r in conn.execute(
+            f"SELECT {cols} FROM tracked_items WHERE catalog_product_id IN ({','.join('?' * len(cats))})", cats
+        ):
+            rows[r["item_id"]] = r
+
+    alerted = {r["item_id"]: r["price"] for r in conn.execute(
+        "SELECT item_id, price FROM seller_alerts WHERE seller_id=?", (seller_id,))}
+    now = int(time.time())
+    batch = RuleBatch()
+    for r in rows.values():
+        hit = index.match(r["item_id"], r["catalog_product_id"])
+        rule = RULES.rule_for(r["chat_id"], r["item_id"])
+        # o "rival" é o próprio dono da linha, ou a regra do chat ignora esse seller
+        if hit is None or r["my_seller_id"] == seller_id or seller_id in rule.ignore_sellers:
+            if r["item_id"] in alerted:
+                conn.execute("DELETE FROM seller_alerts WHERE seller_id=? AND item_id=?", (seller_id, r["item_id"]))
+            continue
+        last = alerted.get(r["item_id"])
+        target = SimpleNamespace(item_id=r["item_id"], chat_id=r["chat_id"], my_price=float(r["my_price"]),
+                                 undercut_reais=float(r["undercut_reais"]), last_alert_price=last,
+                                 last_state="UNDERCUT" if last is not None else "OK")
+        batch.add(target, rule, hit.price, meta=(r["title"], hit))
+    if not len(batch):
+        return 0
+
+    decision = batch.evaluate()
+    alerts = 0
+    for i in decision.changed.tolist():
+        target, rule = batch.targets[i], batch.rules[i]
+        title, hit = batch.meta[i]
+        if not decision.undercut[i]:
+            conn.execute("DELETE FROM seller_alerts WHERE seller_id=? AND item_id=?", (seller_id, target.item_id))
+            continue
+        if not decision.alert[i]:
+            continue
+        margin = f"{rule.margin_pct:g}%" if rule.margin_pct is not None else fmt_price(target.undercut_reais)
+        ALERTS.enqueue(
+            "🔥 ALERTA (ML) — SELLER VIGIADO ABAIXO DO SEU PREÇO\n"
+            f"Produto base: {title or target.item_id}\n"
+            f"Seller: {seller_id}{f' ({nickname})' if nickname else ''}\n"
+            f"Seu preço: {fmt_price(target.my_price)}\n"
+            f"Seller vigiado: {fmt_price(hit.price)}\n"
+            f"Margem: {margin}\n"
+            f"Link: {ml_item_link(hit.id)}",
+            target.chat_id,
+        )
+        conn.execute("""
+            INSERT OR REPLACE INTO seller_alerts (seller_id, item_id, competitor_item_id, price, alerted_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (seller_id, target.item_id, hit.id, hit.price, now))
+        alerts += 1
+    return alerts
+
+
+async def scan_watched_sellers(conn) -> int:
+    """
+    Varre os sellers vigiados vencidos (cada um é de uma partição: com workers, um só
+    worker varre cada seller). Um punhado de páginas por seller substitui uma linha e
+    uma checagem por anúncio do rival. Devolve quantos sellers foram varridos.
+    As escritas de cada seller são commitadas antes do próximo await: a conexão é
+    compartilhada e a trava de escrita do SQLite não pode atravessar a varredura HTTP.
+    """
+    now = int(time.time())
+    due = [r for r in conn.execute("SELECT seller_id, nickname FROM watched_sellers WHERE next_scan_at <= ?", (now,))
+           if SCHEDULER.owns(str(r["seller_id"]))]
+    scanned = 0
+    for r in due:
+        seller_id = r["seller_id"]
+        try:
+            listings = await ml_seller_inventory(seller_id)
+        except MLUnavailable:
+            break
+        except Exception as e:
+            print(f"Erro varrendo seller {seller_id}:", e)
+            listings = None
+        if listings is None:
+            conn.execute("UPDATE watched_sellers SET next_scan_at=? WHERE seller_id=?", (now + POLL_MIN_SECONDS, seller_id))
+            conn.commit()
+            continue
+        alerts = match_seller(conn, seller_id, r["nickname"], SellerIndex(listings))
+        conn.execute("""
+            UPDATE watched_sellers SET last_scan_at=?, items_seen=?, next_scan_at=? WHERE seller_id=?
+        """, (now, len(listings), now + SELLER_SCAN_INTERVAL_SECONDS, seller_id))
+        conn.commit()
+        METRICS.inc("seller_scans_total")
+        METRICS.inc("seller_alerts_total", alerts)
+        scanned += 1
+    return scanned
+
+
+# =========================
+# Monitor loop
+# =========================
+class CycleCoordinator:
+    """
+    Garante um ciclo do monitor por vez: tick que chega com ciclo rodando é pulado
+    (o próximo tick pega os itens vencidos do SCHEDULER de qualquer jeito).
+    """
+
+    def __init__(self):
+        self.running = False
+        self.stats: Dict[str, Any] = {
+            "started": 0,
+            "finished": 0,
+            "skipped": 0,
+            "overruns": 0,
+            "last_started_at": None,
+            "last_finished_at": None,
+            "last_duration": None,
+            "last_items": 0,
+        }
+
+    async def tick(self, app) -> None:
+        if self.running:
+            self.stats["skipped"] += 1
+            return
+        self.running = True
+        self.stats["started"] += 1
+        self.stats["last_started_at"] = int(time.time())
+        t0 = time.monotonic()
+        try:
+            checked, overran = await run_check(app)
+            elapsed = time.monotonic() - t0
+            self.stats["last_items"] = checked
+            METRICS.observe("cycle_seconds", elapsed, buckets=CYCLE_BUCKETS)
+            METRICS.inc("cycle_items_total", checked)
+            METRICS.set("cycle_items_per_second", checked / elapsed if elapsed > 0 else 0)
+            if overran:
+                self.stats["overruns"] += 1
+                print(f"Ciclo estourou {CYCLE_BUDGET_SECONDS}s após {checked} itens; continua no próximo tick")
+        except Exception as e:
+            METRICS.inc("cycle_errors_total")
+            print("Erro no ciclo:", e)
+        finally:
+            self.running = False
+            self.stats["finished"] += 1
+            self.stats["last_finished_at"] = int(time.time())
+            self.stats["last_duration"] = time.monotonic() - t0
+
+
+CYCLES = CycleCoordinator()
+
+
+async def run_check(app) -> Tuple[int, bool]:
+    """
+    Um ciclo: checa os itens vencidos em fatias de CYCLE_CHUNK_SIZE até esvaziar a fila
+    ou estourar CYCLE_BUDGET_SECONDS. O que sobrar continua vencido no SCHEDULER e é
+    o primeiro da fila no próximo tick. Devolve (itens checados, estourou?).
+    """
+    started = time.monotonic()
+    checked = 0
+    conn = db()
+    RULES.refresh(conn)
+    try:
+        await scan_watched_sellers(conn)
+    except sqlite3.Error as e:
+        print("Erro na varredura de sellers:", e)
+    while True:
+        now = int(time.time())
+        if time.monotonic() - started >= CYCLE_BUDGET_SECONDS:
+            return checked, SCHEDULER.has_due(now)
+        if ML_BREAKERS["items"].is_open():
+            # API fora: não adianta martelar item por item; o resto fica vencido pro próximo tick
+            METRICS.inc("cycle_breaker_stops_total")
+            print(f"Circuito do ML aberto: ciclo encerrado após {checked} itens")
+            return checked, False
+        due_ids = with_catalog_siblings(SCHEDULER.pop_due(now, limit=CYCLE_CHUNK_SIZE))
+        if not due_ids:
+            return checked, False
+        checked += await check_batch(app, conn, due_ids)
+
+
+def with_catalog_siblings(due_ids: List[str]) -> List[str]:
+    """
+    Puxa pro lote as outras linhas catalog do mesmo catalog_product_id (STORE.catalog_items).
+    O scheduler espalha as irmãs em horários diferentes; juntas, a busca do catálogo sai
+    uma vez e serve todas, em vez de uma vez por vencimento de cada linha. Linha em
+    backoff de erro (fail_count) fica no horário dela.
+    """
+    out = list(due_ids)
+    seen = set(due_ids)
+    for item_id in due_ids:
+        rec = STORE.get(item_id)
+        if rec is None or rec.mode != "catalog" or not rec.catalog_product_id:
+            continue
+        for sibling in STORE.catalog_items(rec.catalog_product_id):
+            other = STORE.get(sibling)
+            if (sibling in seen or sibling not in SCHEDULER.due or other is None
+                    or other.mode != "catalog" or other.fail_count):
+                continue
+            SCHEDULER.remove(sibling)
+            seen.add(sibling)
+            out.append(sibling)
+    return out
+
+
+async def check_batch(app, conn, due_ids: List[str]) -> int:
+    # linhas vêm da memória (STORE); o banco só recebe as que mudaram, no fim do lote
+    rows = [r for r in (STORE.get(i) for i in due_ids) if r is not None]
+
+    # Itens rodam em paralelo, limitados por ML_CONCURRENCY (nada bloqueia o loop do bot)
+    sem = asyncio.Semaphore(ML_CONCURRENCY)
+
+    # listing e catalog precisam do /items/{id}: busca tudo em lotes de 20 via multiget
+    item_ids = sorted({r.item_id for r in rows if r.mode in ("listing", "catalog")})
+    items: Dict[str, ItemInfo] = {}
+    item_errors: Dict[str, str] = {}  # recusados pelo ML (404/403...): vão pro cache negativo
+
+    async def fetch_batch(ids: List[str]):
+        try:
+            async with sem:
+                items.update(await ml_get_items(ids, fields=ITEM_FIELDS, errors=item_errors))
+        except MLUnavailable:
+            pass  # circuito aberto: itens voltam pra fila no intervalo normal
+        except Exception as e:
+            print(f"Erro no multiget {ids[0]}..{ids[-1]}:", e)
+
+    await asyncio.gather(*(fetch_batch(b) for b in chunked(item_ids, ML_MULTIGET_MAX)))
+    for item_id, it in items.items():
+        if it.status in ITEM_DEAD_STATUSES:
+            item_errors[item_id] = f"status {it.status}"
+
+    # planner do catálogo: cada catalog_product_id é buscado 1x por ciclo, mesmo que
+    # várias linhas (variações, anúncios duplicados, outros sellers nossos) apontem pra ele
+    catalog_of: Dict[str, str] = {}
+    # sellers nossos e ignorados pelas regras em cada catálogo: a varredura pula as ofertas deles
+    sellers_of: Dict[str, Set[int]] = {}
+    for r in rows:
+        if r.mode == "catalog" and r.item_id not in item_errors:
+            item = items.get(r.item_id, NO_ITEM)
+            cat_id = item.catalog_product_id or r.catalog_product_id
+            if cat_id:
+                catalog_of[r.item_id] = cat_id
+                sellers = sellers_of.setdefault(cat_id, set())
+                if item.seller_id or r.my_seller_id:
+                    sellers.add(item.seller_id or r.my_seller_id)
+                sellers |= RULES.ignored(STORE.chats(r), r.item_id)
+    offers_by_catalog: Dict[str, List[Offer]] = {}
+
+    async def fetch_catalog(cat_id: str):
+        try:
+            async with sem:
+                offers = await ml_catalog_offers(cat_id, sellers_of[cat_id])
+            if offers is not None:
+                offers_by_catalog[cat_id] = offers
+        except MLUnavailable:
+            pass
+        except Exception as e:
+            print(f"Erro buscando catalog {cat_id}:", e)
+
+    await asyncio.gather(*(fetch_catalog(c) for c in set(catalog_of.values())))
+
+    observations: List[Observation] = []
+    batch = RuleBatch()
+    outcomes: Dict[str, Optional[bool]] = {}  # item_id -> preço mudou? (None = não deu pra checar)
+
+    for row_no, r in enumerate(rows):
+        reason = item_errors.get(r.item_id)
+        if reason:
+            item_failed(r, reason)
+            continue
+        if r.fail_count:
+            if r.fail_notified:
+                for chat_id in STORE.chats(r):
+                    ALERTS.enqueue(f"✅ {r.title or r.item_id} ({r.item_id}) voltou a ser monitorado.", chat_id)
+            STORE.set(r, fail_count=0, fail_reason=None, failing_since=None, fail_notified=0)
+        try:
+            offers = offers_by_catalog.get(catalog_of.get(r.item_id, ""))
+            outcomes[r.item_id] = check_row(r, items.get(r.item_id, NO_ITEM), offers, observations, batch, row_no)
+        except Exception as e:
+            print(f"Erro checando {r.item_id}:", e)
+            outcomes[r.item_id] = None
+
+    # regras do lote inteiro de uma vez; só as transições/alertas voltam pro Python
+    undercut_rows = apply_rule_decisions(batch, len(rows))
+
+    for row_no, r in enumerate(rows):
+        if r.item_id not in outcomes:
+            continue  # recusado pelo ML: item_failed já reagendou
+        # reagenda sempre (mesmo se falhou), senão o item sai da fila
+        changed = outcomes[r.item_id]
+        if changed is None:
+            state = r.last_state
+            interval = r.poll_interval or CHECK_INTERVAL_SECONDS
+        else:
+            state = "UNDERCUT" if undercut_rows[row_no] else "OK"
+            interval = next_poll_interval(r.poll_interval, r.max_poll_interval, state, changed)
+        now = int(time.time())
+        due_at = now + interval
+        if (WEBHOOK_PORT > 0 and r.mode == "listing" and state != "UNDERCUT"
+                and r.pushed_at and now - r.pushed_at < WEBHOOK_TRUST_SECONDS):
+            # o preço monitorado é o do próprio anúncio notificado: a mudança chega pelo
+            # webhook e o polling só reconcilia de vez em quando. Catalog não: a notificação
+            # é do nosso anúncio e não diz nada do preço dos concorrentes.
+            due_at = now + max(interval, WEBHOOK_RECONCILE_SECONDS)
+        STORE.set(r, poll_interval=interval)
+        if r.item_id not in SCHEDULER.due:  # /setprice etc. podem ter reagendado durante o ciclo
+            r.next_check_at = due_at  # só vai pro banco junto com uma linha suja
+            SCHEDULER.schedule(r.item_id, due_at)
+
+    # uma transação por lote (em vez de um commit/fsync por item), só com as linhas que mudaram
+    cur = conn.cursor()
+    STORE.flush(cur)
+    record_observations(cur, observations, int(time.time()))
+    conn.commit()
+    return len(rows)
+
+
+def item_failed(r: TrackedItem, reason: str) -> None:
+    """
+    Item recusado pelo ML (apagado, pausado, sem permissão): conta a falha, joga a próxima
+    tentativa pra frente com backoff exponencial e avisa no Telegram uma vez só, quando
+    chega em ITEM_FAIL_NOTIFY_AFTER falhas seguidas.
+    """
+    item_id = r.item_id
+    now = int(time.time())
+    fail_count = r.fail_count + 1
+    notified = r.fail_notified
+    if not notified and fail_count >= ITEM_FAIL_NOTIFY_AFTER:
+        notified = 1
+        text = (
+            "⚠️ ITEM SEM MONITORAMENTO\n"
+            f"{r.title or item_id} ({item_id})\n"
+            f"O ML recusou {fail_count}x seguidas: {reason}\n"
+            f"Próxima tentativa em {item_retry_interval(fail_count) // 60} min, espaçando até "
+            f"{ITEM_FAIL_BACKOFF_MAX // 3600}h. Use /remove {item_id} se o anúncio acabou."
+        )
+        for chat_id in STORE.chats(r):
+            ALERTS.enqueue(text, chat_id)
+    METRICS.inc("item_failures_total", reason=reason)
+
+    due_at = now + item_retry_interval(fail_count)
+    # poll_interval fica como estava: quando o item voltar, segue o ritmo de antes
+    if item_id not in SCHEDULER.due:
+        r.next_check_at = due_at
+        SCHEDULER.schedule(item_id, due_at)
+    STORE.set(r, fail_count=fail_count, fail_reason=reason, failing_since=r.failing_since or now,
+              fail_notified=notified)
+
+
+def check_row(
+    r: TrackedItem, item: ItemInfo, offers: Optional[List[Offer]], observations: List[Observation],
+    batch: RuleBatch, row_no: int,
+) -> Optional[bool]:
+    """
+    Parte por linha do check, com os dados já buscados no ciclo: atualiza título,
+    seller, catálogo e último preço visto no STORE, guarda a observação (histórico)
+    e põe no lote uma avaliação pro dono e uma por assinatura de outro chat, cada
+    uma com o concorrente que sobra depois dos sellers ignorados pela regra dela.
+    A decisão (estado/alerta) sai de apply_rule_decisions, pro lote inteiro.
+    Devolve se o preço do concorrente mudou, ou None se não deu pra checar.
+    """
+    item_id = r.item_id
+    mode = r.mode
+    my_seller_id = r.my_seller_id
+    catalog_product_id = r.catalog_product_id
+    now = int(time.time())
+    evaluations = [(r, RULES.rule_for(r.chat_id, item_id))]
+    evaluations += [(sub, RULES.rule_for(sub.chat_id, item_id)) for sub in STORE.subscriptions(item_id)]
+
+    if mode == "listing":
+        title = item.title
+        if item.price is None:
+            return None
+        best = Offer(item_id, item.price, item.seller_id)
+        # listing: o concorrente é o próprio anúncio; some pra quem ignora o seller dele
+        picks = [None if best.seller_id in rule.ignore_sellers else best for _, rule in evaluations]
+
+    elif mode == "catalog":
+        title = item.title or r.title
+        my_seller_id = item.seller_id or my_seller_id
+        catalog_product_id = item.catalog_product_id or catalog_product_id
+        if catalog_product_id and offers is None:
+            return None  # busca do catálogo falhou neste ciclo
+        offers = offers if catalog_product_id else []
+        best = cheapest_competitor(offers, my_seller_id)
+        picks = [cheapest_competitor(offers, my_seller_id, rule.ignore_sellers) if rule.ignore_sellers else best
+                 for _, rule in evaluations]
+
+    else:
+        return None
+
+    for (target, rule), pick in zip(evaluations, picks):
+        batch.add(target, rule, pick.price if pick else None, row_no, meta=(title, mode, pick))
+
+    last_seen = r.last_seen_price
+    seen = best.price if best else None
+    if best:
+        observations.append((item_id, best.id, best.seller_id, best.price))
+    if STORE.set(r, title=title, my_seller_id=my_seller_id, catalog_product_id=catalog_product_id,
+                 last_seen_price=seen):
+        r.updated_at = now
+    if seen is None:
+        return last_seen is not None
+    return last_seen is None or abs(float(last_seen) - seen) > 0.0001
+
+
+def apply_rule_decisions(batch: RuleBatch, n_rows: int) -> np.ndarray:
+    """
+    Avalia o lote e aplica o diff: estado novo e último preço alertado de quem mudou,
+    e um alerta no chat de cada avaliação que pediu. Devolve, por linha do lote,
+    se algum chat dela ficou em UNDERCUT.
+    """
+    if not len(batch):
+        return np.zeros(n_rows, dtype=bool)
+    decision = batch.evaluate()
+    now = int(time.time())
+    for i in decision.changed.tolist():
+        target, rule = batch.targets[i], batch.rules[i]
+        title, mode, pick = batch.meta[i]
+        alert = bool(decision.alert[i])
+        if alert:
+            ALERTS.enqueue(undercut_message(
+                title, target.item_id, mode, target.my_price, target.undercut_reais, pick.price, pick.id,
+                pick.seller_id, rule, float(decision.suggested[i]), bool(decision.below_floor[i]),
+            ), target.chat_id)
+        fields = {"last_state": "UNDERCUT" if decision.undercut[i] else "OK"}
+        if alert:
+            fields["last_alert_price"] = pick.price
+        changed = STORE.set_sub(target, **fields) if isinstance(target, Subscription) else STORE.set(target, **fields)
+        if changed:
+            target.updated_at = now
+    METRICS.inc("rule_evaluations_total", len(batch))
+    METRICS.inc("rule_transitions_total", len(decision.changed))
+    return batch.undercut_rows(decision, n_rows)
 
 
 # =========================
 # Main
 # =========================
+_token_task: Optional[asyncio.Task] = None
+
+
+def start_token_refresh() -> None:
+    global _token_task
+    if ML_APP_ID and ML_CLIENT_SECRET and _token_task is None:
+        _token_task = asyncio.create_task(token_refresh_loop())
+
+
+def stop_token_refresh() -> None:
+    global _token_task
+    if _token_task is not None:
+        _token_task.cancel()
+        _token_task = None
+
+
+async def on_startup(app) -> None:
+    ALERTS.start(app)
+    start_token_refresh()
+    await start_metrics_server(METRICS_PORT)
+    await NOTIFICATIONS.start(app, WEBHOOK_PORT)
+
+
+async def on_shutdown(app) -> None:
+    stop_token_refresh()
+    await NOTIFICATIONS.stop()
+    await ALERTS.stop()
+    await ml_close_client(app)
+    for proc in WORKER_PROCS:
+        proc.terminate()
+    db_close()
+
+
+WORKER_PROCS: List[subprocess.Popen] = []
+
+
 def main():
     if not BOT_TOKEN:
         raise SystemExit("ERRO: TELEGRAM_BOT_TOKEN vazio no .env")
 
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        print("ML Tracker worker rodando...")
+        try:
+            asyncio.run(worker_main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        return
+
     init_db()
+    if MONITOR_WORKERS > 0:
+        SCHEDULER.shards = set()  # este processo só atende o bot; quem checa são os workers
+        WORKER_PROCS.extend(spawn_workers(MONITOR_WORKERS))
+    else:
+        STORE.load(db())
 
     # remove prints de debug se quiser
     print("ML Tracker rodando...")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("add", cmd_add))
     app.add_handler(CommandHandler("list", cmd_list))
+    app.add_handler(CallbackQueryHandler(cb_list, pattern=r"^list\|"))
     app.add_handler(CommandHandler("remove", cmd_remove))
     app.add_handler(CommandHandler("setprice", cmd_setprice))
     app.add_handler(CommandHandler("setundercut", cmd_setundercut))
     app.add_handler(CommandHandler("setmode", cmd_setmode))
+    app.add_handler(CommandHandler("setpoll", cmd_setpoll))
+    app.add_handler(CommandHandler("rule", cmd_rule))
+    app.add_handler(CommandHandler("watchseller", cmd_watchseller))
+    app.add_handler(CommandHandler("unwatchseller", cmd_unwatchseller))
+    app.add_handler(CommandHandler("tenant", cmd_tenant))
+    app.add_handler(CommandHandler("status", cmd_status))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("import", cmd_import))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import"), cmd_import))
+    app.add_handler(CommandHandler("export", cmd_export))
 
    
 
     # ✅ scheduler correto (no loop do telegram)
-    app.job_queue.run_repeating(
-        callback=lambda ctx: ctx.application.create_task(run_check(ctx.application)),
-        interval=CHECK_INTERVAL_SECONDS,
-        first=10,
-    )
+    # o tick é curto: cada run_check só checa os itens vencidos na fila do SCHEDULER
+    if MONITOR_WORKERS == 0:
+        app.job_queue.run_repeating(
+            callback=lambda ctx: ctx.application.create_task(CYCLES.tick(ctx.application)),
+            interval=SCHEDULER_TICK_SECONDS,
+            first=10,
+        )
+    app.job_queue.run_repeating(history_retention_job, interval=HISTORY_RETENTION_INTERVAL, first=60)
 
     app.run_polling()
 
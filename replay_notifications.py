@@ -0,0 +1,81 @@
+"""
+Replayer de notificações do Mercado Livre pro webhook local (WEBHOOK_PORT do main.py).
+
+    python replay_notifications.py MLB123 MLB456                     # 1 notificação "items" por item
+    python replay_notifications.py MLB123 --burst 10 --topic items_prices
+    python replay_notifications.py --file capturadas.jsonl --interval 0.1
+
+--file lê um JSON por linha no formato que o ML manda
+({"resource": "/items/MLB123", "topic": "items", "user_id": ..., "application_id": ...}).
+--burst repete cada notificação N vezes, como o ML faz quando reenvia ou quando o
+anúncio muda várias vezes seguidas; o receptor deve virar isso numa checagem só.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from typing import List, Dict, Any
+
+import httpx
+from dotenv import load_dotenv
+
+
+def build_notifications(args) -> List[Dict[str, Any]]:
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+    resource = "/items/{}/prices" if args.topic == "items_prices" else "/items/{}"
+    return [{
+        "_id": f"replay-{i}",
+        "resource": resource.format(item_id),
+        "user_id": args.user_id,
+        "topic": args.topic,
+        "application_id": args.app_id,
+        "attempts": 1,
+        "sent": now,
+        "received": now,
+    } for i, item_id in enumerate(args.items)]
+
+
+def main(argv=None) -> int:
+    load_dotenv()
+    ap = argparse.ArgumentParser(description="Reenvia notificações do ML pro webhook local")
+    ap.add_argument("items", nargs="*", help="item_ids (MLB...) pra notificar")
+    ap.add_argument("--file", help="JSON lines com notificações capturadas")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8080')}"
+                                     f"{os.getenv('WEBHOOK_PATH', '/ml/notifications')}")
+    ap.add_argument("--topic", default="items", choices=["items", "items_prices", "price_suggestion"])
+    ap.add_argument("--app-id", default=os.getenv("ML_APP_ID", ""))
+    # o receptor confere o user_id da conta: mesmo default do main.py (ML_USER_ID ou sufixo do token)
+    token_tail = os.getenv("ML_REFRESH_TOKEN", "").strip().rsplit("-", 1)[-1]
+    ap.add_argument("--user-id", type=int,
+                    default=int(os.getenv("ML_USER_ID", "").strip() or (token_tail if token_tail.isdigit() else 0)))
+    ap.add_argument("--burst", type=int, default=1, help="vezes que cada notificação é enviada")
+    ap.add_argument("--interval", type=float, default=0.0, help="pausa entre envios (s)")
+    args = ap.parse_args(argv)
+
+    notifications = build_notifications(args)
+    if not notifications:
+        ap.error("passe item_ids ou --file")
+
+    statuses: Counter = Counter()
+    t0 = time.perf_counter()
+    with httpx.Client(timeout=5) as client:
+        for n in notifications:
+            for _ in range(max(1, args.burst)):
+                try:
+                    statuses[client.post(args.url, json=n).status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                if args.interval:
+                    time.sleep(args.interval)
+    elapsed = time.perf_counter() - t0
+    print(f"{sum(statuses.values())} notificações em {elapsed:.2f}s -> {dict(statuses)}")
+    return 0 if set(statuses) <= {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())